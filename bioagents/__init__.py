@@ -1,3 +1,4 @@
+import os
 import sys
 import logging
 logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
@@ -5,6 +6,7 @@ logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
 logger = logging.getLogger('Bioagents')
 from itertools import groupby
 from collections import defaultdict
+from pysb import Model
 from indra.assemblers import EnglishAssembler
 from kqml import KQMLModule, KQMLPerformative, KQMLList
 
@@ -13,6 +15,58 @@ class BioagentException(Exception):
     pass
 
 
+def get_cache_dir(name):
+    """Return the path of a folder in which bioagents cache files.
+
+    The folder is in $BIOAGENTS_CACHE_DIR if it is set, otherwise in the
+    bioagents folder of the user cache folder ($XDG_CACHE_HOME or
+    ~/.cache). The folder isn't created.
+    """
+    cache_dir = os.environ.get('BIOAGENTS_CACHE_DIR')
+    if not cache_dir:
+        cache_dir = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'), 'bioagents')
+    return os.path.join(cache_dir, name)
+
+
+def get_data_dir(name):
+    """Return the path of a folder or file in which bioagents keep data.
+
+    The path is in $BIOAGENTS_DATA_DIR if it is set, otherwise in the
+    bioagents folder of the user data folder ($XDG_DATA_HOME or
+    ~/.local/share). The path isn't created.
+    """
+    data_dir = os.environ.get('BIOAGENTS_DATA_DIR')
+    if not data_dir:
+        data_dir = os.path.join(
+            os.environ.get('XDG_DATA_HOME') or
+            os.path.join(os.path.expanduser('~'), '.local', 'share'),
+            'bioagents')
+    return os.path.join(data_dir, name)
+
+
+def share_model(model):
+    """Return a new model with the components of a model.
+
+    Components, initials and annotations can be added to or removed from
+    the new model without changing the model, but the components
+    themselves are shared, so they are not to be changed. The components
+    still belong to the model: their model reference isn't moved to the
+    new model, so the model keeps working when the new model is dropped.
+    """
+    shared_model = Model(model.name, _export=False)
+    for component in model.components:
+        owner = component.model
+        shared_model.add_component(component)
+        component.model = owner
+    for initial in model.initials:
+        shared_model.add_initial(initial)
+    for annotation in model.annotations:
+        shared_model.add_annotation(annotation)
+    return shared_model
+
+
 class Bioagent(KQMLModule):
     """Abstract class for bioagents."""
     name = "Generic Bioagent (Should probably be overwritten)"
@@ -80,6 +134,14 @@ class Bioagent(KQMLModule):
         self.reply(msg, reply_msg)
         return
 
+    def wait_for_background(self):
+        """Block until messages being prepared in the background are sent.
+
+        Bioagents sending messages from other threads override this so that
+        their output can be read once it is complete, e.g. in tests.
+        """
+        return
+
     def tell(self, content):
         """Send a tell message."""
         msg = KQMLPerformative('tell')
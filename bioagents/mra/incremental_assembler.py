@@ -0,0 +1,287 @@
+"""Incremental assembly of PySB models from changing statement lists."""
+
+import re
+import copy
+import logging
+from collections import OrderedDict
+from pysb import Model, Monomer, Parameter, Expression
+from pysb.core import Component
+from indra.statements import ActiveForm
+from indra.assemblers import PysbAssembler
+from bioagents import share_model
+
+logger = logging.getLogger('incremental_assembler')
+
+
+class IncrementalPysbAssembler(object):
+    """Assemble PySB models by patching the previously assembled model.
+
+    The assembler keeps the last model it assembled. When asked for the
+    model of a list of statements that differs from the previous one by a
+    few added statements, each added statement is assembled on its own
+    (once, the result being cached) and its rules, observables,
+    expressions and parameters are added to the previous model. Statements
+    that were added this way can also be removed again, for instance when
+    a model expansion is undone. The model is assembled from scratch
+    whenever the changes would change the sites or states of a monomer,
+    when statements of the previous full assembly are removed, and when
+    ActiveForm statements are involved, since those change how other
+    statements are assembled.
+
+    Parameters
+    ----------
+    policies : Optional[str]
+        The assembly policies passed to PysbAssembler. Default: one_step
+    initial_amount : Optional[float]
+        The default initial amount of monomers. Default: 100.0
+    max_cached : Optional[int]
+        The number of models of single statements kept. Default: 256
+    """
+    def __init__(self, policies='one_step', initial_amount=100.0,
+                 max_cached=256):
+        self.policies = policies
+        self.initial_amount = initial_amount
+        self.max_cached = max_cached
+        self.model = None
+        self.stmt_uuids = []
+        self.signature = None
+        # The names of the components added to the model for statements
+        # that were added incrementally, and the number of such statements
+        # using each component
+        self.owned = {}
+        self.refcounts = {}
+        # Models of single statements by statement UUID, in least recently
+        # used order
+        self.stmt_models = OrderedDict()
+
+    def assemble(self, stmts):
+        """Return the PySB model of a list of statements.
+
+        The model shares its components with the model the assembler keeps
+        updating, but later calls do not add components to it or remove
+        components from it. The components have to be copied before they
+        are changed.
+        """
+        try:
+            self._update(stmts)
+        except Exception as e:
+            logger.warning('Could not update model incrementally, '
+                           'assembling it again.')
+            logger.exception(e)
+            self._assemble_full(stmts)
+        return share_model(self.model)
+
+    def _update(self, stmts):
+        uuids = [st.uuid for st in stmts]
+        if self.model is None or \
+                any(isinstance(st, ActiveForm) for st in stmts):
+            self._assemble_full(stmts)
+            return
+        old_uuids = set(self.stmt_uuids)
+        new_uuids = set(uuids)
+        removed = [uuid for uuid in self.stmt_uuids if uuid not in new_uuids]
+        added = [st for st in stmts if st.uuid not in old_uuids]
+        if any(uuid not in self.owned for uuid in removed):
+            self._assemble_full(stmts)
+            return
+        added_models = [self._get_stmt_model(st) for st in added]
+        for stmt_model in added_models:
+            if not _is_subsignature(get_signature(stmt_model),
+                                    self.signature):
+                self._assemble_full(stmts)
+                return
+        if removed:
+            self._remove(removed)
+        for st, stmt_model in zip(added, added_models):
+            self._add(st.uuid, stmt_model)
+        self.stmt_uuids = uuids
+        if added or removed:
+            logger.info('Updated model with %d added and %d removed '
+                        'statements.' % (len(added), len(removed)))
+
+    def _assemble_full(self, stmts):
+        pa = PysbAssembler(policies=self.policies)
+        pa.add_statements(stmts)
+        pa.make_model()
+        pa.add_default_initial_conditions(self.initial_amount)
+        self.model = pa.model
+        self.stmt_uuids = [st.uuid for st in stmts]
+        self.signature = get_signature(self.model)
+        self.owned = {}
+        self.refcounts = {}
+
+    def _get_stmt_model(self, stmt):
+        stmt_model = self.stmt_models.get(stmt.uuid)
+        if stmt_model is not None:
+            self.stmt_models.move_to_end(stmt.uuid)
+            return stmt_model
+        pa = PysbAssembler(policies=self.policies)
+        pa.add_statements([stmt])
+        stmt_model = pa.make_model()
+        self.stmt_models[stmt.uuid] = stmt_model
+        while len(self.stmt_models) > self.max_cached:
+            self.stmt_models.popitem(last=False)
+        return stmt_model
+
+    def _add(self, uuid, stmt_model):
+        """Add the components of the model of a statement to the model.
+
+        Components other than parameters are shared with the model by name.
+        Parameters are only added if the new components use them, and those
+        created for each statement get a numbered name, so they are added
+        under a free name if the model already has one by that name. The
+        statement owns the components it uses, and those they refer to.
+        """
+        model = self.model
+        # The components are changed to fit the model, so the cached model
+        # of the statement is left as it is
+        stmt_model = copy.deepcopy(stmt_model)
+        initial_params = set(initial.value.name
+                             for initial in stmt_model.initials)
+        added = []
+        used = []
+        for component in stmt_model.components:
+            if isinstance(component, (Monomer, Parameter)):
+                continue
+            existing = model.components.get(component.name)
+            if existing is None:
+                added.append(component)
+            else:
+                used.append(existing)
+        needed = set(ref.name for component in added
+                     for ref in _get_references(component))
+        renamed = {}
+        for param in stmt_model.parameters:
+            if param.name not in needed or param.name in initial_params:
+                continue
+            if param.name in model.components.keys():
+                match = re.match(r'^(.*)_(\d+)$', param.name)
+                if not match:
+                    continue
+                new_name = _get_free_name(model, match.group(1))
+                renamed[param.name] = Parameter(new_name, param.value,
+                                                _export=False)
+                param = renamed[param.name]
+            # Parameters are added right away so that free names are free
+            model.add_component(param)
+            added.append(param)
+        for component in added:
+            if not isinstance(component, Parameter):
+                _remap_monomers(component, model)
+                model.add_component(component)
+        # Renamed parameters are referred to by their original name, other
+        # components by their name in the model
+        for component in added:
+            _remap_references(component, model, renamed)
+        new_names = set(component.name for component in added)
+        owned = set()
+        stack = added + used
+        while stack:
+            component = stack.pop()
+            if component.name not in owned:
+                owned.add(component.name)
+                stack += _get_references(component)
+        for name in owned:
+            if name in new_names:
+                self.refcounts[name] = 1
+            elif name in self.refcounts:
+                self.refcounts[name] += 1
+        for annotation in stmt_model.annotations:
+            if _get_subject_name(annotation) in new_names:
+                model.add_annotation(annotation)
+        self.owned[uuid] = sorted(name for name in owned
+                                  if name in self.refcounts)
+
+    def _remove(self, uuids):
+        """Rebuild the model without the components only used by the given
+        statements."""
+        dropped = set()
+        for uuid in uuids:
+            for name in self.owned.pop(uuid):
+                self.refcounts[name] -= 1
+                if not self.refcounts[name]:
+                    del self.refcounts[name]
+                    dropped.add(name)
+        model = Model(self.model.name, _export=False)
+        for component in self.model.components:
+            if component.name not in dropped:
+                model.add_component(component)
+        for initial in self.model.initials:
+            model.add_initial(initial)
+        for annotation in self.model.annotations:
+            if _get_subject_name(annotation) not in dropped:
+                model.add_annotation(annotation)
+        self.model = model
+
+
+def get_signature(model):
+    """Return the sites and site states of the monomers of a model."""
+    return {m.name: (set(m.sites),
+                     dict((site, set(states))
+                          for site, states in m.site_states.items()))
+            for m in model.monomers}
+
+
+def _is_subsignature(sig, ref_sig):
+    for name, (sites, site_states) in sig.items():
+        if name not in ref_sig:
+            return False
+        ref_sites, ref_site_states = ref_sig[name]
+        if not sites <= ref_sites:
+            return False
+        for site, states in site_states.items():
+            if not states <= ref_site_states.get(site, set()):
+                return False
+    return True
+
+
+def _get_free_name(model, prefix):
+    idx = 1
+    while ('%s_%d' % (prefix, idx)) in model.components.keys():
+        idx += 1
+    return '%s_%d' % (prefix, idx)
+
+
+def _get_subject_name(annotation):
+    return getattr(annotation.subject, 'name', annotation.subject)
+
+
+def _get_references(component):
+    """Return the components a component refers to, other than monomers."""
+    refs = []
+    for attr in ('rate_forward', 'rate_reverse'):
+        rate = getattr(component, attr, None)
+        if rate is not None:
+            refs.append(rate)
+    if isinstance(component, Expression):
+        refs += [symbol for symbol in component.expr.atoms(Component)]
+    return refs
+
+
+def _remap_references(component, model, renamed):
+    """Make a component refer to the components of a model."""
+    def get_target(ref):
+        if ref.name in renamed:
+            return renamed[ref.name]
+        return model.components[ref.name]
+    for attr in ('rate_forward', 'rate_reverse'):
+        rate = getattr(component, attr, None)
+        if rate is not None:
+            setattr(component, attr, get_target(rate))
+    if isinstance(component, Expression):
+        component.expr = component.expr.xreplace(
+            dict((symbol, get_target(symbol))
+                 for symbol in component.expr.atoms(Component)))
+
+
+def _remap_monomers(component, model):
+    """Make the patterns of a component refer to the monomers of a model."""
+    patterns = []
+    for attr in ('reactant_pattern', 'product_pattern', 'reaction_pattern'):
+        pattern = getattr(component, attr, None)
+        if pattern is not None:
+            patterns.append(pattern)
+    for reaction_pattern in patterns:
+        for cp in reaction_pattern.complex_patterns:
+            for mp in cp.monomer_patterns:
+                mp.monomer = model.monomers[mp.monomer.name]
@@ -0,0 +1,323 @@
+"""A persistent store of model versions sharing their statements."""
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict, Counter, defaultdict
+from indra.statements import stmts_to_json, stmts_from_json
+from indra.preassembler.hierarchy_manager import hierarchies
+
+logger = logging.getLogger('model_store')
+
+
+class ModelStore(object):
+    """Store versions of models as deltas over their parent versions.
+
+    Each version records the statements added to its parent and the UUIDs
+    of the statements removed from it, so a new version takes memory
+    proportional to the edit rather than to the size of the model. Once a
+    version is more than max_chain deltas away from a full copy of its
+    statements, it is stored as a full copy instead, which bounds the
+    work of materializing a version. Versions are appended to a SQLite
+    database so they outlive the agent, and the statement lists of the
+    most recently used versions are kept in memory along with a count of
+    the matches keys of their statements, which makes checking whether a
+    version has a statement matching a given one O(1), and a
+    RefinementIndex of their statements, built when first needed. Once
+    there are more than max_versions versions, the oldest ones are
+    removed, the oldest remaining versions being stored as full copies if
+    they were stored as deltas over removed ones.
+
+    Parameters
+    ----------
+    db_path : Optional[str]
+        The path of the SQLite database file, whose folder is created if
+        it doesn't exist. By default, versions are only kept in memory.
+    max_materialized : Optional[int]
+        The number of materialized statement lists kept in memory.
+        Default: 8
+    max_chain : Optional[int]
+        The maximal number of deltas between a version and a full copy.
+        Default: 20
+    max_versions : Optional[int]
+        The maximal number of versions kept. Default: 1000
+    """
+    def __init__(self, db_path=None, max_materialized=8, max_chain=20,
+                 max_versions=1000):
+        self.db_path = db_path if db_path else ':memory:'
+        self.max_materialized = max_materialized
+        self.max_chain = max_chain
+        self.max_versions = max_versions
+        self.lock = threading.RLock()
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS versions ('
+                          'model_id INTEGER PRIMARY KEY, '
+                          'parent_id INTEGER, '
+                          'chain INTEGER NOT NULL, '
+                          'added TEXT NOT NULL, '
+                          'removed TEXT NOT NULL)')
+        self.conn.commit()
+        # Deltas of versions by model ID, loaded from the database on demand
+        self.deltas = {}
+        # Statement lists and matches key counts of versions, in least
+        # recently used order
+        self.materialized = OrderedDict()
+        # Matches keys of statements by UUID
+        self.stmt_keys = {}
+        self.num_versions = self.conn.execute('SELECT COUNT(*) '
+                                              'FROM versions').fetchone()[0]
+
+    def add_version(self, model_id, parent_id=None, added=None,
+                    removed=None):
+        """Add a version of a model.
+
+        Parameters
+        ----------
+        model_id : int
+            The ID of the new version.
+        parent_id : Optional[int]
+            The ID of the version the new one is derived from, None for a
+            new model.
+        added : Optional[list[indra.statements.Statement]]
+            The statements added to the parent.
+        removed : Optional[list[indra.statements.Statement]]
+            The statements removed from the parent.
+        """
+        added = list(added) if added else []
+        removed_uuids = set(st.uuid for st in removed) if removed else set()
+        with self.lock:
+            if model_id in self:
+                raise ValueError('Model %d already exists.' % model_id)
+            if parent_id is None:
+                chain = 0
+            else:
+                chain = self._get_delta(parent_id)[1] + 1
+            if chain > self.max_chain:
+                # Compact the version into a full copy of its statements
+                added = [st for st in self[parent_id]
+                         if st.uuid not in removed_uuids] + added
+                removed_uuids = set()
+                chain = 0
+            delta = (parent_id, chain, added, removed_uuids)
+            self.conn.execute('INSERT INTO versions VALUES (?, ?, ?, ?, ?)',
+                              (model_id, parent_id, chain,
+                               json.dumps(stmts_to_json(added)),
+                               json.dumps(sorted(removed_uuids))))
+            self.conn.commit()
+            self.deltas[model_id] = delta
+            self.num_versions += 1
+            if self.num_versions > self.max_versions:
+                self._prune()
+
+    def clear(self):
+        """Remove all the versions."""
+        with self.lock:
+            self.conn.execute('DELETE FROM versions')
+            self.conn.commit()
+            self.deltas = {}
+            self.materialized = OrderedDict()
+            self.stmt_keys = {}
+            self.num_versions = 0
+
+    def get_max_id(self):
+        """Return the largest model ID in the store, 0 if it is empty."""
+        with self.lock:
+            row = self.conn.execute('SELECT MAX(model_id) '
+                                    'FROM versions').fetchone()
+        return row[0] if row[0] is not None else 0
+
+    def __contains__(self, model_id):
+        with self.lock:
+            if model_id in self.deltas:
+                return True
+            row = self.conn.execute('SELECT 1 FROM versions '
+                                    'WHERE model_id = ?',
+                                    (model_id,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, model_id):
+        """Return a new list of the statements of a version."""
+        with self.lock:
+            return list(self._materialize(model_id)[0])
+
+    def has_match(self, model_id, stmt):
+        """Return True if a version has a statement matching a given one."""
+        with self.lock:
+            keys = self._materialize(model_id)[1]
+            return keys[stmt.matches_key()] > 0
+
+    def get_refinements(self, model_id, stmt):
+        """Return the statements of a version that are refinements of a
+        given one."""
+        with self.lock:
+            entry = self._materialize(model_id)
+            if entry[2] is None:
+                entry[2] = RefinementIndex(entry[0])
+            refinement_index = entry[2]
+        return refinement_index.get_refinements(stmt)
+
+    def _materialize(self, model_id):
+        entry = self.materialized.get(model_id)
+        if entry is not None:
+            self.materialized.move_to_end(model_id)
+            return entry
+        # Collect the deltas back to a materialized version or a full copy
+        chain = []
+        stmts = []
+        keys = Counter()
+        version_id = model_id
+        while True:
+            if version_id in self.materialized:
+                stmts, keys, _ = self.materialized[version_id]
+                stmts = list(stmts)
+                keys = Counter(keys)
+                break
+            delta = self._get_delta(version_id)
+            chain.append(delta)
+            if delta[1] == 0:
+                break
+            version_id = delta[0]
+        for _, _, added, removed_uuids in reversed(chain):
+            if removed_uuids:
+                kept = []
+                for st in stmts:
+                    if st.uuid in removed_uuids:
+                        keys[self._get_key(st)] -= 1
+                    else:
+                        kept.append(st)
+                stmts = kept
+            stmts += added
+            keys.update(self._get_key(st) for st in added)
+        entry = [stmts, keys, None]
+        self.materialized[model_id] = entry
+        while len(self.materialized) > self.max_materialized:
+            self.materialized.popitem(last=False)
+        return entry
+
+    def _prune(self):
+        """Remove the oldest versions beyond max_versions."""
+        rows = self.conn.execute('SELECT model_id FROM versions '
+                                 'ORDER BY model_id DESC LIMIT 1 OFFSET ?',
+                                 (self.max_versions - 1,)).fetchall()
+        if not rows:
+            return
+        min_kept_id = rows[0][0]
+        # Kept versions stored as deltas over removed versions are stored
+        # as full copies instead
+        rows = self.conn.execute('SELECT model_id FROM versions '
+                                 'WHERE model_id >= ? AND chain > 0 '
+                                 'AND parent_id < ? ORDER BY model_id',
+                                 (min_kept_id, min_kept_id)).fetchall()
+        for (model_id,) in rows:
+            stmts = self._materialize(model_id)[0]
+            self.conn.execute('UPDATE versions SET parent_id = NULL, '
+                              'chain = 0, added = ?, removed = ? '
+                              'WHERE model_id = ?',
+                              (json.dumps(stmts_to_json(stmts)), '[]',
+                               model_id))
+            self.deltas[model_id] = (None, 0, list(stmts), set())
+        self.conn.execute('DELETE FROM versions WHERE model_id < ?',
+                          (min_kept_id,))
+        self.conn.commit()
+        for model_id in list(self.deltas):
+            if model_id < min_kept_id:
+                del self.deltas[model_id]
+        for model_id in list(self.materialized):
+            if model_id < min_kept_id:
+                del self.materialized[model_id]
+        self.stmt_keys = {}
+        self.num_versions = self.conn.execute('SELECT COUNT(*) '
+                                              'FROM versions').fetchone()[0]
+        logger.info('Removed model versions older than %d.' % min_kept_id)
+
+    def _get_key(self, stmt):
+        key = self.stmt_keys.get(stmt.uuid)
+        if key is None:
+            key = stmt.matches_key()
+            self.stmt_keys[stmt.uuid] = key
+        return key
+
+    def _get_delta(self, model_id):
+        delta = self.deltas.get(model_id)
+        if delta is not None:
+            return delta
+        row = self.conn.execute('SELECT parent_id, chain, added, removed '
+                                'FROM versions WHERE model_id = ?',
+                                (model_id,)).fetchone()
+        if row is None:
+            raise KeyError(model_id)
+        delta = (row[0], row[1], stmts_from_json(json.loads(row[2])),
+                 set(json.loads(row[3])))
+        self.deltas[model_id] = delta
+        return delta
+
+
+class RefinementIndex(object):
+    """Find the statements of a list that refine a given statement.
+
+    Statements are bucketed by type and by the name, grounding and
+    ontology component of each of their agents. An agent can only refine
+    another one with the same name or grounding, or in the same component
+    of the entity hierarchy, so the only statements checked with
+    refinement_of are those of the same type as the given one having, for
+    each of its agents, an agent sharing one of these keys.
+
+    Parameters
+    ----------
+    stmts : list[indra.statements.Statement]
+        The statements to index.
+    """
+    def __init__(self, stmts):
+        self.stmts = stmts
+        self.by_type = defaultdict(set)
+        self.by_agent = defaultdict(set)
+        for idx, stmt in enumerate(stmts):
+            stmt_type = type(stmt)
+            self.by_type[stmt_type].add(idx)
+            for agent in stmt.agent_list():
+                if agent is None:
+                    continue
+                for key in get_agent_keys(agent):
+                    self.by_agent[(stmt_type, key)].add(idx)
+
+    def get_candidates(self, stmt):
+        """Return the indexed statements that may refine a given one."""
+        stmt_type = type(stmt)
+        candidates = self.by_type.get(stmt_type, set())
+        for agent in stmt.agent_list():
+            if not candidates:
+                break
+            if agent is None:
+                continue
+            agent_candidates = set()
+            for key in get_agent_keys(agent):
+                agent_candidates |= self.by_agent.get((stmt_type, key), set())
+            candidates = candidates & agent_candidates
+        return [self.stmts[idx] for idx in sorted(candidates)]
+
+    def get_refinements(self, stmt):
+        """Return the indexed statements that refine a given one."""
+        return [st for st in self.get_candidates(stmt)
+                if st.refinement_of(stmt, hierarchies)]
+
+
+def get_agent_keys(agent):
+    """Return the keys under which an agent is indexed.
+
+    These are its name, its grounding and the ID of the component of the
+    entity hierarchy it is in, if any.
+    """
+    keys = [('name', agent.name)]
+    a_ns, a_id = agent.get_grounding()
+    if (a_ns is not None) and (a_id is not None):
+        keys.append(('grounding', a_ns, a_id))
+        eh = hierarchies['entity']
+        comp_id = eh.components.get(eh.get_uri(a_ns, a_id))
+        if comp_id is not None:
+            keys.append(('component', comp_id))
+    return keys
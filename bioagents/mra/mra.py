@@ -8,30 +8,57 @@ import copy
 import json
 import logging
 import networkx
+import threading
 import subprocess
-import kappy
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from indra.sources import trips
 from indra.statements import Complex, Activation, IncreaseAmount, \
                             AddModification, stmts_from_json
 from indra.databases import uniprot_client
-from indra.preassembler.hierarchy_manager import hierarchies
 from indra.assemblers import pysb_assembler, PysbAssembler
-from pysb.bng import BngInterfaceError
+from pysb.bng import BngInterfaceError, generate_equations
 from pysb.tools import render_reactions
 from pysb.export import export
 from indra.util.kappa_util import im_json_to_graph, cm_json_to_graph
+from bioagents.tra import kappa_client
+from .model_store import ModelStore
+from .incremental_assembler import IncrementalPysbAssembler
 
 
 logger = logging.getLogger('MRA')
 
 
 class MRA(object):
-    def __init__(self):
-        self.models = {}
+    """The mechanistic reasoning agent.
+
+    Parameters
+    ----------
+    model_db : Optional[str]
+        The path of a SQLite database in which model versions are kept
+        across restarts. By default, models are only kept in memory.
+    max_undo : Optional[int]
+        The number of model transformations that can be undone.
+        Default: 100
+    max_versions : Optional[int]
+        The number of model versions kept. Default: 1000
+    """
+    def __init__(self, model_db=None, max_undo=100, max_versions=1000):
+        self.models = ModelStore(model_db, max_versions=max_versions)
         self.transformations = []
-        self.id_counter = 0
+        self.max_undo = max_undo
+        self.id_counter = self.models.get_max_id()
         self.default_policy = 'one_step'
         self.default_initial_amount = 100.0
+        self.assembler = \
+            IncrementalPysbAssembler(self.default_policy,
+                                     self.default_initial_amount)
+        self.diagram_queue = DiagramQueue()
+
+    def reset(self):
+        """Forget all models, e.g. when a new conversation starts."""
+        self.models.clear()
+        self.transformations = []
+        self.id_counter = 0
 
     def get_new_id(self):
         self.id_counter += 1
@@ -43,11 +70,9 @@ class MRA(object):
         return False
 
     def assemble_pysb(self, stmts):
-        pa = PysbAssembler(policies=self.default_policy)
-        pa.add_statements(stmts)
-        pa.make_model()
-        pa.add_default_initial_conditions(self.default_initial_amount)
-        return pa.model
+        # The previously assembled model is updated with the changes and a
+        # snapshot of it is returned
+        return self.assembler.assemble(stmts)
 
     def build_model_from_ekb(self, model_ekb):
         """Build a model using DRUM extraction knowledge base."""
@@ -64,7 +89,6 @@ class MRA(object):
         res['ambiguities'] = ambiguities
         model_exec = self.assemble_pysb(stmts)
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, model_id)
         return res
 
     def build_model_from_json(self, model_json):
@@ -77,7 +101,6 @@ class MRA(object):
             return res
         model_exec = self.assemble_pysb(stmts)
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, model_id)
         return res
 
     def expand_model_from_ekb(self, model_ekb, model_id):
@@ -99,7 +122,6 @@ class MRA(object):
         res['model_new'] = new_stmts
         model_exec = self.assemble_pysb(model_stmts)
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, new_model_id)
         return res
 
     def expand_model_from_json(self, model_json, model_id):
@@ -116,7 +138,6 @@ class MRA(object):
         res['model_new'] = new_stmts
         model_exec = self.assemble_pysb(model_stmts)
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, new_model_id)
         return res
 
     def has_mechanism(self, mech_ekb, model_id):
@@ -128,28 +149,23 @@ class MRA(object):
             return res
         query_st = tp.statements[0]
         res['query'] = query_st
-        model_stmts = self.models[model_id]
-        for model_st in model_stmts:
-            if model_st.refinement_of(query_st, hierarchies):
-                res['has_mechanism'] = True
-                return res
-        res['has_mechanism'] = False
+        refinements = self.models.get_refinements(model_id, query_st)
+        res['has_mechanism'] = bool(refinements)
         return res
 
     def remove_mechanism(self, mech_ekb, model_id):
         """Return a new model with the given mechanism having been removed."""
         tp = trips.process_xml(mech_ekb)
         rem_stmts = tp.statements
+        rem_uuids = set()
+        for rem_st in rem_stmts:
+            rem_uuids |= set(st.uuid for st in
+                             self.models.get_refinements(model_id, rem_st))
         new_stmts = []
         removed_stmts = []
         model_stmts = self.models[model_id]
         for model_st in model_stmts:
-            found = False
-            for rem_st in rem_stmts:
-                if model_st.refinement_of(rem_st, hierarchies):
-                    found = True
-                    break
-            if not found:
+            if model_st.uuid not in rem_uuids:
                 new_stmts.append(model_st)
             else:
                 removed_stmts.append(model_st)
@@ -159,8 +175,12 @@ class MRA(object):
         res['model_exec'] = model_exec
         if removed_stmts:
             res['removed'] = removed_stmts
-        res['diagrams'] = make_diagrams(model_exec, model_id)
-        self.new_model(new_stmts)
+        # The new model is stored as a delta over the original one, its
+        # undo history is that of a new model
+        new_model_id = self.get_new_id()
+        self.models.add_version(new_model_id, model_id,
+                                removed=removed_stmts)
+        self.add_transformation(('add_stmts', new_stmts, None, new_model_id))
         return res
 
     def model_undo(self):
@@ -170,20 +190,28 @@ class MRA(object):
             stmts_added = forward_action[1]
             old_model_id = forward_action[2]
             new_model_id = self.get_new_id()
-            stmts = self.models[old_model_id] \
-                if old_model_id is not None else []
-            self.models[new_model_id] = stmts
+            self.models.add_version(new_model_id, old_model_id)
+            stmts = self.models[new_model_id]
             undo_action = {'action': 'remove_stmts', 'statements': stmts_added}
         res = {'model_id': new_model_id,
                'model': stmts,
                'action': undo_action}
-        model_exec = self.assemble_pysb(stmts)
         if not stmts:
             return res
         res['ambiguities'] = []
-        res['diagrams'] = make_diagrams(model_exec, new_model_id)
+        res['model_exec'] = self.assemble_pysb(stmts)
         return res
 
+    def request_diagrams(self, model_exec, model_id, callback=None):
+        """Start making the diagrams of a model in the background.
+
+        The diagrams of earlier models that haven't been made yet are
+        cancelled. callback, if given, is called with the type and resource
+        of each diagram as soon as it is made. A future of the dict of all
+        the diagrams is returned.
+        """
+        return self.diagram_queue.submit(model_exec, model_id, callback)
+
     def get_upstream(self, target, model_id):
         """Get upstream agents in model."""
         stmts = self.models[model_id]
@@ -196,23 +224,25 @@ class MRA(object):
 
     def new_model(self, stmts):
         model_id = self.get_new_id()
-        self.models[model_id] = stmts
-        self.transformations.append(('add_stmts', stmts, None, model_id))
+        self.models.add_version(model_id, added=stmts)
+        self.add_transformation(('add_stmts', stmts, None, model_id))
         return model_id
 
     def extend_model(self, stmts, model_id):
-        old_stmts = self.models[model_id]
+        new_stmts = [st for st in stmts
+                     if not self.models.has_match(model_id, st)]
         new_model_id = self.get_new_id()
-        self.models[new_model_id] = [st for st in self.models[model_id]]
-        new_stmts = []
-        for st in stmts:
-            if not stmt_exists(self.models[model_id], st):
-                self.models[new_model_id].append(st)
-                new_stmts.append(st)
-        self.transformations.append(('add_stmts', new_stmts, model_id,
-                                     new_model_id))
+        self.models.add_version(new_model_id, model_id, added=new_stmts)
+        self.add_transformation(('add_stmts', new_stmts, model_id,
+                                 new_model_id))
         return new_model_id, new_stmts
 
+    def add_transformation(self, transformation):
+        """Record a transformation, forgetting the oldest ones beyond
+        max_undo."""
+        self.transformations.append(transformation)
+        del self.transformations[:-self.max_undo]
+
     def replace_agent(self, agent_name, agent_replacement_names, model_id):
         """Replace an agent in a model with other agents.
 
@@ -238,6 +268,59 @@ class MRA(object):
         return model
 
 
+class DiagramQueue(object):
+    """Make model diagrams in the background, one model at a time.
+
+    Submitting the diagrams of a model supersedes those of earlier models:
+    jobs that haven't started are cancelled, and a job that is already
+    running stops reporting diagrams through its callback.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.generation = 0
+
+    def submit(self, pysb_model, model_id, callback=None):
+        """Schedule making the diagrams of a model and return a future.
+
+        The diagrams are made from a copy of the model taken right away,
+        so the model can be changed once this returns.
+        """
+        pysb_model = copy.deepcopy(pysb_model)
+        with self.lock:
+            for job in self.jobs:
+                if job.cancel():
+                    logger.info('Cancelled stale diagrams.')
+            self.generation += 1
+            future = self.executor.submit(self._make_diagrams, pysb_model,
+                                          model_id, self.generation,
+                                          callback)
+            self.jobs = [future]
+        return future
+
+    def wait(self):
+        """Block until the latest submitted diagrams have been made."""
+        with self.lock:
+            jobs = list(self.jobs)
+        for job in jobs:
+            if not job.cancelled():
+                job.result()
+
+    def is_current(self, generation):
+        with self.lock:
+            return generation == self.generation
+
+    def _make_diagrams(self, pysb_model, model_id, generation, callback):
+        if not self.is_current(generation):
+            return None
+
+        def report(diagram_type, resource):
+            if callback is not None and self.is_current(generation):
+                callback(diagram_type, resource)
+        return _make_model_diagrams(pysb_model, model_id, report)
+
+
 def get_ambiguities(tp):
     terms = tp.tree.findall('TERM')
     all_ambiguities = {}
@@ -249,21 +332,92 @@ def get_ambiguities(tp):
     return all_ambiguities
 
 
-def make_diagrams(pysb_model, model_id):
-    sbgn = make_sbgn(pysb_model, model_id)
-    rxn = draw_reaction_network(pysb_model, model_id)
-    cm = draw_contact_map(pysb_model, model_id)
-    im = draw_influence_map(pysb_model, model_id)
-    diagrams = {'reactionnetwork': rxn, 'contactmap': cm,
-                'influencemap': im, 'sbgn': sbgn}
+# Diagrams are drawn in parallel, mostly by separate dot processes
+_diagram_executor = ThreadPoolExecutor(max_workers=4)
+
+
+def make_diagrams(pysb_model, model_id, callback=None):
+    """Return the diagrams of a model.
+
+    The reaction network of the model is generated once for both the
+    reaction network diagram and SBGN, and the model is exported to and
+    parsed by Kappa once for both the contact map and the influence map.
+    The four diagrams are then produced in parallel, and callback, if
+    given, is called with the type and resource of each diagram that is
+    made, as soon as it is made. The diagrams are made from a copy of the
+    model, which is left unchanged.
+    """
+    return _make_model_diagrams(copy.deepcopy(pysb_model), model_id,
+                                callback)
+
+
+def _make_model_diagrams(pysb_model, model_id, callback):
+    for m in pysb_model.monomers:
+        pysb_assembler.set_extended_initial_condition(pysb_model, m, 0)
+    futures = {}
+    try:
+        generate_equations(pysb_model)
+    except Exception as e:
+        logger.error('Reaction network could not be generated.')
+        logger.error(e)
+    else:
+        futures['sbgn'] = _diagram_executor.submit(_export_sbgn, pysb_model)
+        futures['reactionnetwork'] = \
+            _diagram_executor.submit(_draw_reactions, pysb_model, model_id)
+    try:
+        imap, cmap = get_kappa_maps(pysb_model)
+    except Exception as e:
+        logger.exception('Could not make Kappa maps for model.')
+        logger.exception(e)
+    else:
+        futures['influencemap'] = \
+            _diagram_executor.submit(draw_influence_map, pysb_model,
+                                     model_id, imap)
+        futures['contactmap'] = \
+            _diagram_executor.submit(draw_contact_map, pysb_model, model_id,
+                                     cmap)
+    diagrams = {'reactionnetwork': None, 'contactmap': None,
+                'influencemap': None, 'sbgn': None}
+    future_keys = {future: key for key, future in futures.items()}
+    for future in as_completed(future_keys):
+        key = future_keys[future]
+        diagrams[key] = future.result()
+        if callback is not None and diagrams[key]:
+            callback(key, diagrams[key])
     return diagrams
 
 
+def get_diagram_path(model_id, diagram_type):
+    """Return the path of the PNG of a model diagram.
+
+    diagram_type is one of 'reactionnetwork', 'contactmap' and
+    'influencemap'.
+    """
+    suffixes = {'reactionnetwork': 'rxn', 'contactmap': 'cm',
+                'influencemap': 'im'}
+    fname = 'model%d_%s.png' % (model_id, suffixes[diagram_type])
+    return os.path.join(os.path.abspath(os.getcwd()), fname)
+
+
+def get_kappa_maps(pysb_model):
+    """Return the influence map and contact map JSON of a model from a
+    single Kappa export and parse."""
+    model_str = export(pysb_model, 'kappa')
+    with kappa_client.get_runtime_pool().session(model_str) as kappa:
+        kappa.load_model(model_str)
+        return kappa.influence_map(), kappa.contact_map()
+
+
 def make_sbgn(pysb_model, model_id):
-    pa = PysbAssembler()
-    pa.model = pysb_model
+    pysb_model = copy.deepcopy(pysb_model)
     for m in pysb_model.monomers:
         pysb_assembler.set_extended_initial_condition(pysb_model, m, 0)
+    return _export_sbgn(pysb_model)
+
+
+def _export_sbgn(pysb_model):
+    pa = PysbAssembler()
+    pa.model = pysb_model
     try:
         sbgn_str = pa.export_model('sbgn')
     except BngInterfaceError:
@@ -272,13 +426,11 @@ def make_sbgn(pysb_model, model_id):
     return sbgn_str
 
 
-def draw_influence_map(pysb_model, model_id):
+def draw_influence_map(pysb_model, model_id, imap=None):
     """Generate a Kappa influence map, draw it and save it as a PNG."""
     try:
-        im = make_influence_map(pysb_model)
-        fname = 'model%d_im' % model_id
-        abs_path = os.path.abspath(os.getcwd())
-        full_path = os.path.join(abs_path, fname + '.png')
+        im = make_influence_map(pysb_model, imap)
+        full_path = get_diagram_path(model_id, 'influencemap')
         im_agraph = networkx.nx_agraph.to_agraph(im)
         im_agraph.draw(full_path, prog='dot')
     except Exception as e:
@@ -288,13 +440,16 @@ def draw_influence_map(pysb_model, model_id):
     return full_path
 
 
-def make_influence_map(pysb_model):
-    """Return a Kappa influence map."""
-    kappa = kappy.KappaStd()
-    model_str = export(pysb_model, 'kappa')
-    kappa.add_model_string(model_str)
-    kappa.project_parse()
-    imap = kappa.analyses_influence_map()
+def make_influence_map(pysb_model, imap=None):
+    """Return a Kappa influence map.
+
+    If the influence map JSON is not given, it is obtained from Kappa.
+    """
+    if imap is None:
+        model_str = export(pysb_model, 'kappa')
+        with kappa_client.get_runtime_pool().session(model_str) as kappa:
+            kappa.load_model(model_str)
+            imap = kappa.influence_map()
     im = im_json_to_graph(imap)
     for param in pysb_model.parameters:
         try:
@@ -304,12 +459,10 @@ def make_influence_map(pysb_model):
     return im
 
 
-def draw_contact_map(pysb_model, model_id):
+def draw_contact_map(pysb_model, model_id, cmap=None):
     try:
-        cm = make_contact_map(pysb_model)
-        fname = 'model%d_cm' % model_id
-        abs_path = os.path.abspath(os.getcwd())
-        full_path = os.path.join(abs_path, fname + '.png')
+        cm = make_contact_map(pysb_model, cmap)
+        full_path = get_diagram_path(model_id, 'contactmap')
         cm.draw(full_path, prog='dot')
     except Exception as e:
         logger.exception('Could not draw contact map for model.')
@@ -318,22 +471,30 @@ def draw_contact_map(pysb_model, model_id):
     return full_path
 
 
-def make_contact_map(pysb_model):
-    """Return a Kappa contact map."""
-    kappa = kappy.KappaStd()
-    model_str = export(pysb_model, 'kappa')
-    kappa.add_model_string(model_str)
-    kappa.project_parse()
-    cmap = kappa.analyses_contact_map()
+def make_contact_map(pysb_model, cmap=None):
+    """Return a Kappa contact map.
+
+    If the contact map JSON is not given, it is obtained from Kappa.
+    """
+    if cmap is None:
+        model_str = export(pysb_model, 'kappa')
+        with kappa_client.get_runtime_pool().session(model_str) as kappa:
+            kappa.load_model(model_str)
+            cmap = kappa.contact_map()
     cm = cm_json_to_graph(cmap)
     return cm
 
 
 def draw_reaction_network(pysb_model, model_id):
     """Generate a PySB/BNG reaction network as a PNG file."""
+    pysb_model = copy.deepcopy(pysb_model)
+    for m in pysb_model.monomers:
+        pysb_assembler.set_extended_initial_condition(pysb_model, m, 0)
+    return _draw_reactions(pysb_model, model_id)
+
+
+def _draw_reactions(pysb_model, model_id):
     try:
-        for m in pysb_model.monomers:
-            pysb_assembler.set_extended_initial_condition(pysb_model, m, 0)
         fname = 'model%d_rxn' % model_id
         diagram_dot = render_reactions.run(pysb_model)
     # TODO: use specific PySB/BNG exceptions and handle them
@@ -4,6 +4,8 @@ import json
 import pickle
 import random
 import logging
+import threading
+from collections import defaultdict
 import pysb.export
 
 from indra.statements import stmts_to_json
@@ -11,8 +13,8 @@ from indra.sources.trips.processor import TripsProcessor
 from indra.preassembler.hierarchy_manager import hierarchies
 
 from kqml import KQMLPerformative, KQMLList, KQMLString
-from bioagents import Bioagent, BioagentException
-from .mra import MRA
+from bioagents import Bioagent, BioagentException, get_data_dir
+from .mra import MRA, get_diagram_path
 
 
 logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
@@ -27,29 +29,45 @@ class MRA_Module(Bioagent):
              'MODEL-UNDO', 'MODEL-GET-UPSTREAM']
 
     def __init__(self, **kwargs):
-        # Instantiate a singleton MRA agent
-        self.mra = MRA()
+        # Instantiate a singleton MRA agent. Model versions are kept in the
+        # user data folder by default so that they survive restarts within
+        # a conversation, and only in memory in tests.
+        model_db = kwargs.pop('model_db', None) or get_data_dir('models.db')
+        if kwargs.get('testing'):
+            model_db = None
+        self.mra = MRA(model_db)
         try:
             self.background_stmts = load_statements()
         except Exception as e:
             logger.warning('Could not load background information.')
             self.background_stmts = []
+        self.background_index = BackgroundIndex(self.background_stmts)
+        # Diagrams are displayed from the diagram thread so sending
+        # messages needs to be synchronized
+        self.send_lock = threading.Lock()
+        # The models whose diagrams to make once the reply to a request is
+        # sent
+        self.display_models = []
         super(MRA_Module, self).__init__(**kwargs)
 
     def receive_tell(self, msg, content):
         tell_content = content.head().upper()
         if tell_content == 'START-CONVERSATION':
             logger.info('MRA resetting')
+            self.mra.reset()
 
     def receive_request(self, msg, content):
         """Handle request messages and respond.
 
         If a "request" message is received, decode the task and the content
         and call the appropriate function to prepare the response. A reply
-        message is then sent back.
+        message is then sent back. The diagrams of the models in the
+        response are made and displayed once the reply has been sent.
         """
+        self.display_models = []
         try:
             super(MRA_Module, self).receive_request(msg, content)
+            self._request_diagrams()
             return
         except InvalidModelDescriptionError as e:
             logger.error('Invalid model description.')
@@ -59,6 +77,7 @@ class MRA_Module(Bioagent):
             logger.error('Invalid model ID.')
             logger.error(e)
             reply_content = self.make_failure('INVALID_MODEL_ID')
+        self.display_models = []
         self.reply_with_content(msg, reply_content)
         return
 
@@ -90,13 +109,8 @@ class MRA_Module(Bioagent):
         model_msg = encode_indra_stmts(model)
         msg.sets('model', model_msg)
         # Add the diagrams
-        diagrams = res.get('diagrams')
         if not no_display:
-            if diagrams:
-                rxn_diagram = diagrams.get('reactionnetwork')
-                if rxn_diagram:
-                    msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
+            self.display_model(res, msg)
         ambiguities = res.get('ambiguities')
         if ambiguities:
             ambiguities_msg = get_ambiguities_msg(ambiguities)
@@ -138,12 +152,7 @@ class MRA_Module(Bioagent):
             msg.sets('model-new', model_new_msg)
         # Add the diagram
         if not no_display:
-            diagrams = res.get('diagrams')
-            if diagrams:
-                rxn_diagram = diagrams.get('reactionnetwork')
-                if rxn_diagram:
-                    msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
+            self.display_model(res, msg)
         ambiguities = res.get('ambiguities')
         if ambiguities:
             ambiguities_msg = get_ambiguities_msg(ambiguities)
@@ -180,13 +189,8 @@ class MRA_Module(Bioagent):
         msg.set('action', actionl)
 
         # Add the diagram
-        diagrams = res.get('diagrams')
         if not no_display:
-            if diagrams:
-                rxn_diagram = diagrams.get('reactionnetwork')
-                if rxn_diagram:
-                    msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
+            self.display_model(res, msg)
         return msg
 
     def respond_has_mechanism(self, content):
@@ -236,13 +240,8 @@ class MRA_Module(Bioagent):
             removed_msg = encode_indra_stmts(removed)
             msg.sets('removed', removed_msg)
         # Add the diagram
-        diagrams = res.get('diagrams')
         if not no_display:
-            if diagrams:
-                rxn_diagram = diagrams.get('reactionnetwork')
-                if rxn_diagram:
-                    msg.sets('diagram', rxn_diagram)
-                self.send_display_model(rxn_diagram)
+            self.display_model(res, msg)
         return msg
 
     def respond_model_get_upstream(self, content):
@@ -266,6 +265,35 @@ class MRA_Module(Bioagent):
         reply.set('upstream-names', KQMLList(names))
         return reply
 
+    def display_model(self, res, msg):
+        """Display the diagrams of a model once the reply is sent.
+
+        The reply message refers to the reaction network diagram at the
+        path where it is made in the background. Each diagram is displayed
+        as soon as it has been made, after the reply, so a display message
+        tells when the file is on disk.
+        """
+        model_exec = res.get('model_exec')
+        if model_exec is None:
+            return
+        model_id = res['model_id']
+        msg.sets('diagram', get_diagram_path(model_id, 'reactionnetwork'))
+        self.display_models.append((model_exec, model_id))
+
+    def _request_diagrams(self):
+        def display(diagram_type, resource):
+            self.send_display_model({diagram_type: resource})
+        for model_exec, model_id in self.display_models:
+            self.mra.request_diagrams(model_exec, model_id, display)
+        self.display_models = []
+
+    def send(self, msg):
+        with self.send_lock:
+            return super(MRA_Module, self).send(msg)
+
+    def wait_for_background(self):
+        self.mra.diagram_queue.wait()
+
     def send_display_model(self, diagrams):
         for diagram_type, resource in diagrams.items():
             if not resource:
@@ -289,7 +317,7 @@ class MRA_Module(Bioagent):
     def send_background_support(self, stmts):
         logger.info('Sending support for %d statements' % len(stmts))
         for stmt in stmts:
-            matched = _get_matching_stmts(self.background_stmts, stmt)
+            matched = self.background_index.get_matching_stmts(stmt)
             if matched:
                 self.send_provenance_for_stmts(matched,
                                                "the mechanism you added")
@@ -387,16 +415,73 @@ def get_ambiguities_msg(ambiguities):
     return ambiguities_msg
 
 
+# Entity hierarchy components by grounding
+_grounding_comps = {}
+
+
 def _get_agent_comp(agent):
-    eh = hierarchies['entity']
     a_ns, a_id = agent.get_grounding()
     if (a_ns is None) or (a_id is None):
         return None
+    try:
+        return _grounding_comps[(a_ns, a_id)]
+    except KeyError:
+        pass
+    eh = hierarchies['entity']
     uri = eh.get_uri(a_ns, a_id)
     comp_id = eh.components.get(uri)
+    _grounding_comps[(a_ns, a_id)] = comp_id
     return comp_id
 
 
+def _get_agent_match_key(agent):
+    # Agents match if they are in the same component or, if neither is in
+    # a component, have the same name
+    comp_id = _get_agent_comp(agent)
+    if comp_id is not None:
+        return ('comp', comp_id)
+    return ('name', agent.name)
+
+
+class BackgroundIndex(object):
+    """Index background statements for _get_matching_stmts queries.
+
+    Statements are keyed by their type and the match key of each of their
+    agents, so the statements matching a given one are found without
+    scanning all of them.
+
+    Parameters
+    ----------
+    stmts : list[indra.statements.Statement]
+        The background statements.
+    """
+    def __init__(self, stmts):
+        self.stmts = stmts
+        self.index = defaultdict(list)
+        for idx, stmt in enumerate(stmts):
+            agents = stmt.agent_list()
+            # Statements with missing agents never match
+            if any(agent is None for agent in agents):
+                continue
+            key = tuple(_get_agent_match_key(agent) for agent in agents)
+            self.index[(type(stmt), key)].append(idx)
+        self.stmt_types = set(stmt_type for stmt_type, _ in self.index)
+
+    def get_matching_stmts(self, stmt_ref):
+        """Return the background statements matching a statement, in the
+        same order as _get_matching_stmts."""
+        agents = stmt_ref.agent_list()
+        if any(agent is None for agent in agents):
+            return []
+        key = tuple(_get_agent_match_key(agent) for agent in agents)
+        ref_type = stmt_ref.__class__
+        indices = []
+        for stmt_type in self.stmt_types:
+            if issubclass(stmt_type, ref_type):
+                indices += self.index.get((stmt_type, key), [])
+        return [self.stmts[idx] for idx in sorted(indices)]
+
+
 def _get_matching_stmts(stmts_in, stmt_ref):
     # Filter by statement type.
     ref_type = stmt_ref.__class__
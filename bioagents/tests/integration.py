@@ -182,12 +182,19 @@ class _IntegrationTest(TestCase):
 
     def setUp(self):
         """Set the start of the logs"""
+        self.bioagent.wait_for_background()
         self.this_test_log_start = self.bioagent.out.tell()
 
     def run_test(self):
         for request_args, check_resp in self._get_messages():
             self.bioagent.receive_request(*request_args)
-            output = self.get_output_log()[-1].get('content')
+            # Messages sent from background threads, which may come before
+            # or after the reply, are waited for so that the log isn't read
+            # while it is being written
+            self.bioagent.wait_for_background()
+            replies = [msg for msg in self.get_output_log()
+                       if msg.head() == 'reply']
+            output = replies[-1].get('content')
             if check_resp is not None:
                 check_resp(self, output)
         return
@@ -0,0 +1,203 @@
+import numpy
+from nose.tools import raises
+from bioagents.tra import ltl_nodes
+from bioagents.tra import model_checker as mc
+
+
+def _make_states(vals):
+    states = numpy.zeros(len(vals), dtype=[('X', float)])
+    states['X'] = vals
+    return states
+
+
+def _tree_truth(fstr, states):
+    checker = mc.ModelChecker(fstr)
+    for t, s in enumerate(states):
+        tf = checker.update(s, (t == (len(states)-1)))
+        if tf is not None:
+            break
+    return tf
+
+
+def _all_formulas():
+    formulas = [mc.transient_formula('X'), mc.sustained_formula('X'),
+                mc.noact_formula('X'), '!F[X,1,1]', 'G[X,0,0] | F[X,1,1]']
+    for val in (0, 1):
+        formulas += [mc.always_formula('X', val),
+                     mc.eventual_formula('X', val),
+                     mc.sometime_formula('X', val)]
+    return formulas
+
+
+def test_check_formula_simple():
+    states = _make_states([0, 1, 1, 0, 0])
+    assert mc.check_formula(mc.transient_formula('X'), states)
+    assert not mc.check_formula(mc.sustained_formula('X'), states)
+    assert mc.check_formula(mc.sometime_formula('X', 1), states)
+    assert not mc.check_formula(mc.always_formula('X', 0), states)
+    assert mc.check_formula(mc.eventual_formula('X', 0), states)
+
+
+def test_check_formula_empty():
+    assert mc.check_formula('F[X,1,1]', _make_states([])) is None
+
+
+def test_check_formula_same_as_tree():
+    rng = numpy.random.RandomState(0)
+    for _ in range(50):
+        states = _make_states(rng.randint(0, 2, rng.randint(1, 12)))
+        for fstr in _all_formulas():
+            assert mc.ModelChecker(fstr, states).truth == \
+                _tree_truth(fstr, states), (fstr, states)
+
+
+def test_check_formulas_batch():
+    rng = numpy.random.RandomState(1)
+    values = rng.randint(0, 2, (6, 10))
+    formulas = _all_formulas()
+    truths = mc.check_formulas(formulas, values)
+    assert truths.shape == (len(formulas), 6)
+    for i, fstr in enumerate(formulas):
+        for j in range(6):
+            states = _make_states(values[j])
+            assert truths[i, j] == mc.check_formula(fstr, states)
+    named_truths = mc.check_formulas(formulas, {'X': values})
+    assert (named_truths == truths).all()
+
+
+def test_parse_formula():
+    formula = ltl_nodes.parse_formula(mc.transient_formula('X'))
+    lf = ltl_nodes.LtlFormula
+    atom1 = lf('atomic', ('X', 1, 1))
+    atom0 = lf('atomic', ('X', 0, 0))
+    expected = lf('&', (lf('F', (atom1,)), lf('F', (lf('G', (atom0,)),))))
+    assert formula == expected
+    # Parsing is cached by formula string
+    assert ltl_nodes.parse_formula(mc.transient_formula('X')) is formula
+
+
+def test_parse_formula_parentheses():
+    formula = ltl_nodes.parse_formula('(F[X,1,1] | G[X,0,0]) & !F[X,0,0]')
+    assert formula.op == '&'
+    assert formula.args[0].op == '|'
+    assert formula.args[1].op == '!'
+
+
+@raises(ValueError)
+def test_parse_formula_unbalanced():
+    ltl_nodes.parse_formula('(F[X,1,1] | G[X,0,0]')
+
+
+def test_check_formulas_partial():
+    rng = numpy.random.RandomState(2)
+    values = rng.randint(0, 2, (20, 12))
+    formulas = _all_formulas()
+    full_truths = mc.check_formulas(formulas, values)
+    complete_truths = mc.check_formulas_partial(formulas, values, True)
+    assert (complete_truths == full_truths).all()
+    for prefix_len in range(13):
+        truths = mc.check_formulas_partial(formulas, values[:, :prefix_len])
+        decided = (truths >= 0)
+        # Decisions made on prefixes agree with the full trajectories
+        assert (truths[decided] == full_truths[decided]).all()
+
+
+def test_check_formulas_partial_early():
+    values = numpy.array([[0, 0, 1, 0]])
+    truths = mc.check_formulas_partial([mc.noact_formula('X'),
+                                        mc.sometime_formula('X', 1),
+                                        mc.sustained_formula('X')], values)
+    assert truths[:, 0].tolist() == [0, 1, -1]
+    # With uncertain values nothing is decided
+    truths = mc.check_formulas_partial([mc.noact_formula('X')],
+                                       numpy.zeros((1, 4)),
+                                       states_upper=numpy.ones((1, 4)))
+    assert truths[0, 0] == -1
+
+
+def _make_joint_states(x_vals, y_vals):
+    states = numpy.zeros(len(x_vals), dtype=[('X', float), ('Y', float)])
+    states['X'] = x_vals
+    states['Y'] = y_vals
+    return states
+
+
+def test_check_until_formula():
+    fstr = mc.until_formula('X', 1, 'Y', 0)
+    assert ltl_nodes.parse_formula(fstr).op == 'U'
+    assert mc.check_formula(fstr, _make_joint_states([1, 1, 0], [1, 1, 0]))
+    assert mc.check_formula(fstr, _make_joint_states([0, 0], [0, 1]))
+    assert not mc.check_formula(fstr,
+                                _make_joint_states([1, 0, 0], [1, 1, 0]))
+    assert not mc.check_formula(fstr, _make_joint_states([1, 1], [1, 1]))
+
+
+def test_check_joint_formulas_same_as_tree():
+    rng = numpy.random.RandomState(3)
+    formulas = [mc.until_formula('X', 1, 'Y', 0), 'F([X,1,1] U G[Y,1,1])',
+                mc.and_formula([mc.sustained_formula('X'),
+                                mc.noact_formula('Y')]),
+                '!([X,0,0] U [Y,1,1]) | F[X,1,1]']
+    for _ in range(50):
+        num_times = rng.randint(1, 10)
+        states = _make_joint_states(rng.randint(0, 2, num_times),
+                                    rng.randint(0, 2, num_times))
+        for fstr in formulas:
+            assert mc.ModelChecker(fstr, states).truth == \
+                _tree_truth(fstr, states), (fstr, states)
+        # Decisions on prefixes agree with the complete trajectory
+        truths = mc.check_formulas(formulas, states)
+        assert (mc.check_formulas_partial(formulas, states, True) ==
+                truths).all()
+        for prefix_len in range(num_times + 1):
+            partial = mc.check_formulas_partial(formulas,
+                                                states[:prefix_len])
+            decided = (partial >= 0)
+            assert (partial[decided] == truths[decided]).all()
+
+
+def test_parse_bounded_formula():
+    formula = ltl_nodes.parse_formula('F{2,5}[X,1,1]')
+    assert formula.op == 'F'
+    assert formula.bounds == (2, 5)
+    assert ltl_nodes.parse_formula('F[X,1,1]').bounds is None
+
+
+@raises(ValueError)
+def test_parse_bounded_formula_invalid():
+    ltl_nodes.parse_formula('G{5,2}[X,1,1]')
+
+
+def test_check_bounded_formulas():
+    states = _make_states([0, 0, 1, 0, 0, 0])
+    assert mc.check_formula('F{1,2}[X,1,1]', states)
+    assert not mc.check_formula('F{3,4}[X,1,1]', states)
+    assert mc.check_formula('G{3,4}[X,0,0]', states)
+    assert not mc.check_formula('G{0,2}[X,0,0]', states)
+    # Windows are cut to the last time point
+    assert mc.check_formula('G{4,10}[X,0,0]', states)
+    assert not mc.check_formula('F{7,10}[X,1,1]', states)
+    # Bounded operators can be decided before the end of a trajectory
+    truths = mc.check_formulas_partial(['G{0,2}[X,0,0]', 'F{1,2}[X,1,1]',
+                                        'G{3,4}[X,0,0]'], states[:3])
+    assert truths.tolist() == [0, 1, -1]
+
+
+def test_check_bounded_formulas_same_as_tree():
+    rng = numpy.random.RandomState(4)
+    formulas = ['F{1,3}[X,1,1]', 'G{0,2}[X,0,0]', 'G{2,4}F{0,1}[X,1,1]',
+                'F{2,2}G[X,1,1] | [X,0,0] U G{1,2}[X,1,1]', 'F{0,0}[X,1,1]']
+    for _ in range(50):
+        num_times = rng.randint(1, 10)
+        states = _make_states(rng.randint(0, 2, num_times))
+        for fstr in formulas:
+            assert mc.ModelChecker(fstr, states).truth == \
+                _tree_truth(fstr, states), (fstr, states)
+        truths = mc.check_formulas(formulas, states)
+        assert (mc.check_formulas_partial(formulas, states, True) ==
+                truths).all()
+        for prefix_len in range(num_times + 1):
+            partial = mc.check_formulas_partial(formulas,
+                                                states[:prefix_len])
+            decided = (partial >= 0)
+            assert (partial[decided] == truths[decided]).all()
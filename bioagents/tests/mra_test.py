@@ -1,13 +1,22 @@
+import os
 import json
+import random
+import tempfile
 import xml.etree.ElementTree as ET
 from kqml.kqml_list import KQMLList
 from kqml.kqml_performative import KQMLPerformative
 import indra.statements as sts
 from bioagents.tests.util import ekb_from_text, ekb_kstring_from_text, get_request
 from bioagents.tests.integration import _IntegrationTest, _FailureTest
-from bioagents.mra.mra import MRA, make_influence_map, make_contact_map
+from bioagents.mra.mra import MRA, make_influence_map, make_contact_map, \
+    get_kappa_maps, make_diagrams, get_diagram_path
+from bioagents.mra.model_store import ModelStore, RefinementIndex
+from bioagents.mra.incremental_assembler import IncrementalPysbAssembler, \
+    get_signature
+from indra.assemblers import PysbAssembler
+from pysb import Parameter
 from bioagents.mra.mra_module import MRA_Module, ekb_from_agent, get_target, \
-    _get_matching_stmts
+    _get_matching_stmts, BackgroundIndex
 
 # ################
 # MRA unit tests
@@ -97,19 +106,219 @@ def test_model_undo():
     assert action.get('statements') == stmts1
 
 
+def test_model_store():
+    stmts = [sts.Phosphorylation(sts.Agent('A%d' % i), sts.Agent('B'))
+             for i in range(10)]
+    db_path = os.path.join(tempfile.mkdtemp(), 'models.db')
+    store = ModelStore(db_path, max_materialized=2, max_chain=3)
+    store.add_version(1, added=stmts[:2])
+    store.add_version(2, 1, added=stmts[2:3])
+    store.add_version(3, 2, removed=stmts[:1])
+    for model_id in range(4, 10):
+        store.add_version(model_id, model_id - 1, added=[stmts[model_id]])
+    assert store[2] == stmts[:3]
+    assert store[3] == stmts[1:3]
+    assert store[9] == stmts[1:3] + stmts[4:10]
+    # Versions far from a full copy are compacted
+    assert store.deltas[5][1] == 0
+    # Versions are kept across instances
+    store = ModelStore(db_path)
+    assert store.get_max_id() == 9
+    assert [st.uuid for st in store[9]] == \
+        [st.uuid for st in stmts[1:3] + stmts[4:10]]
+    assert 10 not in store
+
+
+def test_model_store_prune():
+    stmts = [sts.Phosphorylation(sts.Agent('A%d' % i), sts.Agent('B'))
+             for i in range(10)]
+    store = ModelStore(max_chain=3, max_versions=4)
+    store.add_version(1, added=stmts[:2])
+    for model_id in range(2, 9):
+        store.add_version(model_id, model_id - 1, added=[stmts[model_id]])
+    # Only the latest versions are kept
+    assert 4 not in store
+    assert 5 in store
+    assert store.num_versions == 4
+    assert store[8] == stmts[:9]
+    # The oldest kept version doesn't depend on removed versions
+    assert store.deltas[5][1] == 0
+    assert store[5] == stmts[:6]
+    store.clear()
+    assert 8 not in store
+    assert store.get_max_id() == 0
+
+
+def test_extend_model_dedup():
+    m = MRA()
+    stmts = [sts.Phosphorylation(sts.Agent('A%d' % i), sts.Agent('B'))
+             for i in range(100)]
+    m.new_model(stmts[:60])
+    new_stmts = [sts.Phosphorylation(sts.Agent('A%d' % i), sts.Agent('B'))
+                 for i in range(50, 100)]
+    new_model_id, added = m.extend_model(new_stmts, 1)
+    assert added == new_stmts[10:]
+    assert len(m.models[new_model_id]) == 100
+    assert m.models.has_match(new_model_id, stmts[99])
+    assert not m.models.has_match(1, stmts[99])
+    # Removed statements are no longer matched
+    m.models.add_version(3, new_model_id, removed=stmts[:1])
+    assert not m.models.has_match(3, stmts[0])
+    assert m.models.has_match(3, stmts[1])
+
+
+def test_refinement_index():
+    map2k1 = sts.Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mek = sts.Agent('MEK', db_refs={'FPLX': 'MEK'})
+    mapk1 = sts.Agent('MAPK1', db_refs={'HGNC': '6871'})
+    braf = sts.Agent('BRAF', db_refs={'HGNC': '1097'})
+    stmts = [sts.Phosphorylation(map2k1, mapk1),
+             sts.Activation(braf, map2k1),
+             sts.Phosphorylation(braf, map2k1)]
+    ri = RefinementIndex(stmts)
+    query = sts.Phosphorylation(mek, mapk1)
+    assert ri.get_candidates(query) == stmts[:1]
+    assert ri.get_refinements(query) == stmts[:1]
+    query = sts.Phosphorylation(None, map2k1)
+    assert ri.get_refinements(query) == stmts[2:]
+    assert not ri.get_candidates(sts.Phosphorylation(mapk1, braf))
+
+
+def _assemble_full(stmts):
+    pa = PysbAssembler(policies='one_step')
+    pa.add_statements(stmts)
+    pa.make_model()
+    pa.add_default_initial_conditions(100.0)
+    return pa.model
+
+
+def _get_model_summary(model):
+    """Return the contents of a model with its parameters replaced by
+    their values, and check that it only refers to its own components."""
+    def get_value(component):
+        if component is None:
+            return None
+        assert model.components[component.name] is component
+        if isinstance(component, Parameter):
+            return component.value
+        return component.name
+    rules = sorted((rule.name, str(rule.rule_expression),
+                    get_value(rule.rate_forward),
+                    get_value(rule.rate_reverse)) for rule in model.rules)
+    observables = sorted((obs.name, str(obs.reaction_pattern))
+                         for obs in model.observables)
+    expressions = sorted((expr.name, str(expr.expr.xreplace(
+        dict((symbol, get_value(symbol))
+             for symbol in expr.expr.atoms(Parameter)))))
+        for expr in model.expressions)
+    # The order of the sites of a monomer depends on the order of the
+    # statements, so the sites of initial patterns are sorted
+    initials = sorted((str([(mp.monomer.name,
+                             sorted(mp.site_conditions.items()))
+                            for mp in initial.pattern.monomer_patterns]),
+                       get_value(initial.value))
+                      for initial in model.initials)
+    return get_signature(model), rules, observables, expressions, initials
+
+
+def test_incremental_assembly():
+    stmts = [sts.Phosphorylation(sts.Agent('MAP2K1'), sts.Agent('MAPK1')),
+             sts.Complex([sts.Agent('BRAF'), sts.Agent('MAP2K1')]),
+             sts.Phosphorylation(sts.Agent('BRAF'), sts.Agent('MAP2K1'))]
+    new_stmts = [sts.Complex([sts.Agent('MAP2K1'), sts.Agent('BRAF')]),
+                 sts.Phosphorylation(sts.Agent('BRAF'), sts.Agent('MAP2K1'))]
+    assembler = IncrementalPysbAssembler()
+    for stmts_in, num_added in ((stmts, 0), (stmts + new_stmts, 2),
+                                (stmts, 0)):
+        model = assembler.assemble(stmts_in)
+        # Statements added to the previous model are patched in
+        assert len(assembler.owned) == num_added
+        assert _get_model_summary(model) == \
+            _get_model_summary(_assemble_full(stmts_in))
+    # The cached models of single statements are left unchanged
+    for stmt_model in assembler.stmt_models.values():
+        for param in stmt_model.parameters:
+            assert stmt_model.parameters[param.name] is param
+
+
+def test_incremental_assembly_snapshot():
+    stmts = [sts.Phosphorylation(sts.Agent('MAP2K1'), sts.Agent('MAPK1')),
+             sts.Complex([sts.Agent('BRAF'), sts.Agent('MAP2K1')]),
+             sts.Phosphorylation(sts.Agent('BRAF'), sts.Agent('MAP2K1'))]
+    new_stmts = [sts.Complex([sts.Agent('MAP2K1'), sts.Agent('BRAF')]),
+                 sts.Phosphorylation(sts.Agent('BRAF'), sts.Agent('MAP2K1'))]
+    assembler = IncrementalPysbAssembler()
+    model = assembler.assemble(stmts)
+    summary = _get_model_summary(model)
+    new_model = assembler.assemble(stmts + new_stmts)
+    assert len(assembler.owned) == 2
+    # Models returned earlier are not changed by later calls
+    assert _get_model_summary(model) == summary
+    assert _get_model_summary(model) != _get_model_summary(new_model)
+
+
+def test_incremental_assembly_random():
+    names = ('MAP2K1', 'MAPK1', 'BRAF')
+    # New statements are made on every draw so that a statement can be
+    # added again with a new UUID
+    pool = []
+    for subj in names:
+        for obj in names:
+            if subj != obj:
+                pool += [lambda s=subj, o=obj: sts.Phosphorylation(
+                             sts.Agent(s), sts.Agent(o)),
+                         lambda s=subj, o=obj: sts.Dephosphorylation(
+                             sts.Agent(s), sts.Agent(o)),
+                         lambda s=subj, o=obj: sts.Complex(
+                             [sts.Agent(s), sts.Agent(o)])]
+    rng = random.Random(0)
+    assembler = IncrementalPysbAssembler()
+    history = [[make() for make in rng.sample(pool, 6)]]
+    for _ in range(40):
+        stmts = list(history[-1])
+        action = rng.choice(['add', 'remove', 'undo'])
+        if action == 'add':
+            stmts += [make() for make in rng.sample(pool, rng.randint(1, 3))]
+        elif action == 'remove' and len(stmts) > 1:
+            stmts.remove(rng.choice(stmts))
+        elif action == 'undo' and len(history) > 1:
+            history.pop()
+            stmts = list(history[-1])
+        history.append(stmts)
+        model = assembler.assemble(stmts)
+        assert _get_model_summary(model) == \
+            _get_model_summary(_assemble_full(stmts))
+
+
+def test_mra_model_db():
+    db_path = os.path.join(tempfile.mkdtemp(), 'models.db')
+    m = MRA(db_path)
+    stmts = [sts.Phosphorylation(sts.Agent('A'), sts.Agent('B'))]
+    m.new_model(stmts)
+    m.extend_model([sts.Phosphorylation(sts.Agent('C'), sts.Agent('D'))], 1)
+    m = MRA(db_path)
+    assert m.has_id(2)
+    assert len(m.models[2]) == 2
+    assert m.new_model(stmts) == 3
+    # Models are forgotten when a new conversation starts
+    m.reset()
+    assert not m.has_id(2)
+    assert m.new_model(stmts) == 1
+
+
 def test_sbgn():
     m = MRA()
     ekb = ekb_from_text('KRAS activates BRAF.')
     res = m.build_model_from_ekb(ekb)
     ekb = ekb_from_text('NRAS activates BRAF.')
     res = m.expand_model_from_ekb(ekb, 1)
-    sbgn = res['diagrams']['sbgn']
+    sbgn = make_diagrams(res['model_exec'], res['model_id'])['sbgn']
     tree = ET.fromstring(sbgn)
     glyphs = tree.findall('s:map/s:glyph',
                           namespaces={'s': 'http://sbgn.org/libsbgn/pd/0.1'})
     assert len(glyphs) == 6
     res = m.model_undo()
-    sbgn = res['diagrams']['sbgn']
+    sbgn = make_diagrams(res['model_exec'], res['model_id'])['sbgn']
     tree = ET.fromstring(sbgn)
     glyphs = tree.findall('s:map/s:glyph',
                           namespaces={'s': 'http://sbgn.org/libsbgn/pd/0.1'})
@@ -120,7 +329,7 @@ def test_make_diagrams():
     m = MRA()
     ekb = ekb_from_text('KRAS activates BRAF. Active BRAF binds MEK.')
     res = m.build_model_from_ekb(ekb)
-    diagrams = res['diagrams']
+    diagrams = make_diagrams(res['model_exec'], res['model_id'])
     assert diagrams['reactionnetwork']
     assert diagrams['reactionnetwork'].endswith('.png')
     assert diagrams['contactmap']
@@ -129,6 +338,24 @@ def test_make_diagrams():
     assert diagrams['influencemap'].endswith('.png')
 
 
+def test_request_diagrams():
+    m = MRA()
+    ekb = ekb_from_text('KRAS activates BRAF.')
+    res = m.build_model_from_ekb(ekb)
+    ekb = ekb_from_text('NRAS activates BRAF.')
+    res2 = m.expand_model_from_ekb(ekb, 1)
+    displayed = []
+    m.request_diagrams(res['model_exec'], res['model_id'],
+                       lambda key, resource: displayed.append(1))
+    future = m.request_diagrams(res2['model_exec'], res2['model_id'],
+                                lambda key, resource: displayed.append(2))
+    diagrams = future.result()
+    assert diagrams['reactionnetwork'] == \
+        get_diagram_path(res2['model_id'], 'reactionnetwork')
+    # Only the diagrams of the latest model are displayed
+    assert displayed == [2, 2, 2, 2]
+
+
 def test_make_im():
     m = MRA()
     ekb = ekb_from_text('KRAS activates BRAF. Active BRAF binds MEK.')
@@ -149,6 +376,19 @@ def test_make_cm():
     assert len(list(cm.edges())) == 2
 
 
+def test_get_kappa_maps():
+    m = MRA()
+    ekb = ekb_from_text('KRAS activates BRAF. Active BRAF binds MEK.')
+    res = m.build_model_from_ekb(ekb)
+    pysb_model = res['model_exec']
+    imap, cmap = get_kappa_maps(pysb_model)
+    im = make_influence_map(pysb_model, imap)
+    assert len(list(im.nodes())) == 3
+    assert len(list(im.edges())) == 3
+    cm = make_contact_map(pysb_model, cmap)
+    assert len(list(cm.nodes())) == 3
+
+
 # #####################
 # MRA_Module unit tests
 # #####################
@@ -228,6 +468,25 @@ def test_get_matching_statements():
         "Expected 2 matching for at least one name, got matching: %s" % (matching)
 
 
+def test_background_index():
+    braf = sts.Agent('BRAF', db_refs={'HGNC': '1097'})
+    raf = sts.Agent('RAF', db_refs={'FPLX': 'RAF'})
+    map2k1 = sts.Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mek = sts.Agent('MEK', db_refs={'FPLX': 'MEK'})
+    x = sts.Agent('X')
+    stmts = [sts.Phosphorylation(braf, mek), sts.Phosphorylation(raf, map2k1),
+             sts.Phosphorylation(None, map2k1), sts.Activation(braf, mek),
+             sts.Phosphorylation(x, map2k1), sts.Dephosphorylation(raf, mek),
+             sts.Complex([braf, mek]), sts.Complex([braf, mek, x])]
+    index = BackgroundIndex(stmts)
+    refs = [sts.Phosphorylation(braf, map2k1), sts.Modification(raf, mek),
+            sts.Phosphorylation(sts.Agent('X'), mek),
+            sts.Complex([raf, map2k1]), sts.Activation(None, mek)]
+    for stmt_ref in refs:
+        assert index.get_matching_stmts(stmt_ref) == \
+            _get_matching_stmts(stmts, stmt_ref), stmt_ref
+
+
 # #####################
 # MRA integration tests
 # #####################
@@ -277,6 +536,17 @@ class TestBuildModelAmbiguity(_IntegrationTest):
         assert output.get('diagram') is not None, 'Got None for diagram.'
         assert output.gets('diagram').endswith('png'), \
             'Wrong format for diagram.'
+        # The diagram is displayed after the reply, once it has been made
+        displayed = [msg.get('content') for msg in self.get_output_log()
+                     if msg.head() == 'tell' and
+                     msg.get('content').head() == 'display-image' and
+                     msg.get('content').get('type') == 'reactionnetwork']
+        assert len(displayed) == 1, 'Expected 1 diagram, got %d.' % \
+            len(displayed)
+        assert displayed[0].gets('path') == output.gets('diagram'), \
+            'Displayed diagram is not the one in the reply.'
+        assert os.path.exists(displayed[0].gets('path')), \
+            'Diagram was not made.'
 
 
 class TestBuildModelBoundCondition(_IntegrationTest):
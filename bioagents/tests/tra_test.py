@@ -1,14 +1,24 @@
+import gc
+import os
+import time
 import json
+import numpy
+import tempfile
 from nose.tools import raises
 import sympy.physics.units as units
+from bioagents import get_cache_dir
 from bioagents.tra import tra_module
 from bioagents.tra import tra
+from bioagents.tra import kappa_client
+from bioagents.tra.figure_renderer import FigureRenderer
+from bioagents.tra.sim_cache import SimulationCache, get_sim_key
 from pysb import Model, Rule, Monomer, Parameter, Initial, SelfExporter
 from indra.statements import stmts_to_json, Agent, Phosphorylation, \
                              Dephosphorylation, Activation, Inhibition, \
                              ActivityCondition, ModCondition
 from kqml import KQMLPerformative, KQMLList
-from bioagents.tests.integration import _StringCompareTest, _IntegrationTest
+from bioagents.tests.integration import _StringCompareTest, \
+    _IntegrationTest, _FailureTest
 from bioagents.tests.util import stmts_kstring_from_text, ekb_kstring_from_text, \
                                 get_request
 
@@ -255,6 +265,24 @@ def test_apply_condition_decrease():
     assert model.parameters['MAP2K1_0'].value < pold
 
 
+def test_get_condition_params():
+    model = _get_gk_model()
+    lst = KQMLList.from_string('(:type "multiple" :value 2.5 ' +
+                               ':quantity (:type "total" ' +
+                               ':entity (:description %s)))' % ekb_map2k1)
+    mc = tra_module.get_molecular_condition(lst)
+    param_values = tra.get_condition_params(model, [mc, mc])
+    assert param_values == {'MAP2K1_0': 625}
+    assert model.parameters['MAP2K1_0'].value == 100
+
+
+def test_pysb_to_kappa_param_values():
+    model = _get_gk_model()
+    kappa_model = tra.pysb_to_kappa(model, {'MAP2K1_0': 625.0})
+    assert "%var: 'MAP2K1_0' 625.0" in kappa_model
+    assert "%var: 'MAPK1_0' 100" in kappa_model
+
+
 def test_get_molecular_entity():
     me = KQMLList.from_string('(:description %s)' % ekb_complex)
     ent = tra_module.get_molecular_entity(me)
@@ -305,6 +333,129 @@ def test_get_temporal_pattern_eventual():
     assert pattern.value.value == 'high'
 
 
+def test_get_temporal_pattern_until():
+    pattern_msg = '(:type "until" :entities ((:description %s) ' % \
+        ekb_map2k1 + '(:description %s)) ' % ekb_braf + \
+        ':value (:type "qualitative" :value "high") ' + \
+        ':until-value (:type "qualitative" :value "low"))'
+    lst = KQMLList.from_string(pattern_msg)
+    pattern = tra_module.get_temporal_pattern(lst)
+    assert pattern.pattern_type == 'until'
+    assert len(pattern.entities) == 2
+    assert pattern.value.value == 'high'
+    assert pattern.until_value.value == 'low'
+
+
+def test_get_joint_ltl_from_pattern():
+    model = _get_gk_model()
+    observables = [tra.get_create_observable(model, Agent(name))
+                   for name in ('MAPK1', 'MAP2K1')]
+    high = tra.MolecularQuantity('qualitative', 'high')
+    low = tra.MolecularQuantity('qualitative', 'low')
+    pattern = tra.TemporalPattern('until', [Agent('MAPK1'), Agent('MAP2K1')],
+                                  None, value=high, until_value=low)
+    fstr = tra.get_joint_ltl_from_pattern(pattern, observables)
+    assert fstr == '[%s,1,1] U [%s,0,0]' % (observables[0].name,
+                                           observables[1].name)
+    pattern = tra.TemporalPattern('sustained',
+                                  [Agent('MAPK1'), Agent('MAP2K1')], None)
+    fstr = tra.get_joint_ltl_from_pattern(pattern, observables)
+    assert fstr == '(FG[%s,1,1]) & (FG[%s,1,1])' % (observables[0].name,
+                                                     observables[1].name)
+
+
+def test_check_property_ode_single_simulation():
+    model = _get_gk_model()
+    t = tra.TRA(use_kappa=False, min_sim=4)
+    num_sims = []
+    run_simulations = t.run_simulations
+
+    def count_simulations(model, conditions, num_sim, *args, **kwargs):
+        num_sims.append(num_sim)
+        return run_simulations(model, conditions, num_sim, *args, **kwargs)
+    t.run_simulations = count_simulations
+    high = tra.MolecularQuantity('qualitative', 'high')
+    pattern = tra.TemporalPattern('eventual_value', [Agent('MAPK1')], None,
+                                  value=high)
+    sat_rate, num_sim, _, _, _ = t.check_property(model, pattern)
+    # ODE simulations are deterministic so only one is run
+    assert num_sims == [1]
+    assert num_sim == 1
+    assert sat_rate in (0.0, 1.0)
+
+
+def test_simulate_odes_batch():
+    model = _get_gk_model()
+    t = tra.TRA(use_kappa=False)
+    obs = tra.get_create_observable(
+        model, Agent('MAPK1', mods=[ModCondition('phosphorylation')]))
+    param_values_list = [{}, {'MAP2K1_0': 2 * model.parameters[
+        'MAP2K1_0'].value}]
+    sims = [(model, param_values, None)
+            for param_values in param_values_list]
+    runs = []
+    t.simulate_batch(sims[:1], 1000.0, 100.0)
+    sol = list(t.ode_solvers.values())[0]
+    run = sol.run
+
+    def count_runs(*args, **kwargs):
+        runs.append(1)
+        return run(*args, **kwargs)
+    sol.run = count_runs
+    results = t.simulate_batch(sims, 1000.0, 100.0)
+    # All the parameter values are integrated by one solver call
+    assert len(runs) == 1
+    for param_values, (ts, yobs) in zip(param_values_list, results):
+        _, single_yobs = t.simulate_odes(model, 1000.0, 100.0, param_values)
+        assert numpy.allclose(yobs[obs.name], single_yobs[obs.name])
+    assert not numpy.allclose(results[0][1][obs.name],
+                              results[1][1][obs.name])
+
+
+def test_get_joint_patterns():
+    patterns = tra.get_joint_patterns(['X', 'Y'])
+    assert [pat for _, pat in patterns] == \
+        [pat for _, pat in tra.get_all_patterns('X')]
+    assert patterns[0][0] == '(G[X,0,0]) & (G[Y,0,0])'
+    assert tra.get_joint_patterns(['X']) == tra.get_all_patterns('X')
+
+
+def test_get_sim_grid():
+    assert tra.get_sim_grid(None) == (10000.0, 100.0, None)
+    # Time limits within the default horizon share its simulations
+    time_limit = tra.TimeInterval(100, 150, 'minute')
+    assert tra.get_sim_grid(time_limit) == (10000.0, 100.0, (60, 90))
+    assert tra.get_sim_grid(time_limit, shared=False) == \
+        (9000.0, 90, (66, 100))
+    # Short or long time limits get their own simulations
+    time_limit = tra.TimeInterval(10, 50, 'minute')
+    assert tra.get_sim_grid(time_limit) == (3000.0, 30, (20, 100))
+    time_limit = tra.TimeInterval(0, 200, 'second')
+    assert tra.get_sim_grid(time_limit) == (200.0, 2, (0, 100))
+    time_limit = tra.TimeInterval(0, 10, 'hour')
+    assert tra.get_sim_grid(time_limit) == (36000.0, 360, (0, 100))
+
+
+def test_get_sim_grid_past_horizon():
+    # Without an upper bound, a time limit past the default horizon gets
+    # simulations going on for the default horizon after its lower bound
+    time_limit = tra.TimeInterval(10, None, 'hour')
+    assert tra.get_sim_grid(time_limit) == (46000.0, 460, (78, 100))
+
+
+@raises(tra.InvalidTimeIntervalError)
+def test_get_sim_grid_empty():
+    time_limit = tra.TimeInterval(50, 10, 'minute')
+    tra.get_sim_grid(time_limit)
+
+
+def test_get_all_patterns_window():
+    patterns = tra.get_all_patterns('X', (2, 5))
+    assert len(patterns) == len(tra.get_all_patterns('X'))
+    assert patterns[0][0] == 'G{2,5}[X,0,0]'
+    assert patterns[2][0] == 'G{5,5}[X,0,0]'
+
+
 def test_get_all_patterns():
     patterns = tra.get_all_patterns('MAPK1')
     print(patterns)
@@ -356,6 +507,68 @@ def test_assemble_model_chemical_agents():
     assert model.parameters['DRUG_0'].value == 10000.0
 
 
+def test_assemble_model_cached():
+    stmts = [Activation(Agent('BRAF'), Agent('KRAS')),
+             Inhibition(Agent('DRUG'), Agent('BRAF'))]
+    model1 = tra_module.assemble_model(stmts)
+    tra.get_create_observable(model1, Agent('BRAF'))
+    # The same assembled model is shared for identical statements, and
+    # components added to earlier models are not in it
+    stmts2 = [Activation(Agent('BRAF'), Agent('KRAS')),
+              Inhibition(Agent('DRUG'), Agent('BRAF'))]
+    assert tra_module.get_stmts_hash(stmts) == \
+        tra_module.get_stmts_hash(stmts2)
+    model2 = tra_module.assemble_model(stmts2)
+    assert model2 is not model1
+    assert model2.parameters['BRAF_0'] is model1.parameters['BRAF_0']
+    assert len(model2.observables) == len(model1.observables) - 1
+    assert len(model2.initials) == len(model1.initials)
+    tra.get_create_observable(model2, Agent('BRAF'))
+
+
+def test_assemble_model_snapshot_dropped():
+    stmts = [Phosphorylation(Agent('MAP2K1'), Agent('MAPK1'))]
+    model = tra_module.assemble_model(stmts)
+    del model
+    gc.collect()
+    # The components of the cached model still belong to it once the
+    # models sharing them are gone, so it can be used again
+    cached_model = \
+        tra_module._assembled_models[tra_module.get_stmts_hash(stmts)]
+    for component in cached_model.components:
+        assert component.model() is cached_model
+    model = tra_module.assemble_model(stmts)
+    tra.get_create_observable(model, Agent('MAPK1'))
+    assert tra.pysb_to_kappa(model)
+
+
+def test_classify_agents():
+    stmts = [Activation(Agent('BRAF'), Agent('KRAS')),
+             Inhibition(Agent('DRUG', db_refs={'CHEBI': '123'}),
+                        Agent('BRAF')),
+             Phosphorylation(Agent('MEK',
+                             activity=ActivityCondition('activity', True)),
+                             Agent('ERK'))]
+    targeted, no_upstream_active, chemicals = \
+        tra_module.classify_agents(stmts)
+    assert targeted == {'BRAF'}
+    assert no_upstream_active == {'MEK'}
+    assert chemicals == {'DRUG'}
+
+
+def test_classify_agents_error():
+    bad_agent = Agent('MEK')
+    bad_agent.db_refs = None
+    stmts = [Activation(Agent('BRAF'), Agent('KRAS')),
+             Inhibition(Agent('DRUG', db_refs={'CHEBI': '123'}),
+                        Agent('BRAF')),
+             Phosphorylation(bad_agent, Agent('ERK'))]
+    # An agent that can't be classified doesn't affect the others
+    targeted, _, chemicals = tra_module.classify_agents(stmts)
+    assert targeted == {'BRAF'}
+    assert chemicals == {'DRUG'}
+
+
 @raises(tra.MissingMonomerError)
 def test_missing_monomer():
     stmts = [Activation(Agent('BRAF'), Agent('KRAS'))]
@@ -383,6 +596,364 @@ def test_missing_monomer_condition():
     tra.apply_condition(model, condition)
 
 
+def test_get_seeds():
+    t1 = tra.TRA(use_kappa=False, seed=1)
+    t2 = tra.TRA(use_kappa=False, seed=1)
+    seeds = t1.get_seeds(5)
+    assert len(seeds) == 5
+    assert seeds == t2.get_seeds(5)
+
+
+def test_get_replicate_seeds():
+    # With a cache, replicate seeds don't depend on the process or the
+    # order of requests
+    t1 = tra.TRA(use_kappa=False, sim_cache_dir=tempfile.mkdtemp())
+    t2 = tra.TRA(use_kappa=False, sim_cache_dir=tempfile.mkdtemp())
+    seeds = t1.get_replicate_seeds(0, 4)
+    assert t2.get_replicate_seeds(2, 2) == seeds[2:]
+    assert t2.get_replicate_seeds(0, 2) == seeds[:2]
+    assert t1.get_replicate_seeds(0, 4) == seeds
+    # Without a cache, repeated requests get new seeds
+    t3 = tra.TRA(use_kappa=False)
+    assert t3.get_replicate_seeds(0, 4) != t3.get_replicate_seeds(0, 4)
+
+
+def test_get_sat_interval():
+    lb, ub = tra.get_sat_interval(0, 2)
+    assert lb == 0 and 0.5 < ub < 0.7
+    lb, ub = tra.get_sat_interval(2, 2)
+    assert 0.3 < lb < 0.5 and ub == 1
+    lb, ub = tra.get_sat_interval(10, 20)
+    assert lb < 0.5 < ub
+
+
+def test_sat_rates_resolved():
+    # The given pattern is clearly satisfied
+    truths = numpy.array([[1, 1], [0, 0]], dtype=bool)
+    assert tra.sat_rates_resolved(truths, True)
+    # Two unsatisfied simulations are not enough to resolve anything
+    truths = numpy.zeros((3, 2), dtype=bool)
+    assert not tra.sat_rates_resolved(truths, True)
+    truths = numpy.zeros((3, 16), dtype=bool)
+    assert tra.sat_rates_resolved(truths, True)
+
+
+def test_sat_rates_resolved_early():
+    # Unanimous outcomes are resolved well before max_sim simulations
+    for value in (False, True):
+        truths = numpy.full((3, 4), value, dtype=bool)
+        assert tra.sat_rates_resolved(truths, True)
+        assert tra.sat_rates_resolved(truths[1:], False)
+    # Mixed outcomes need more simulations
+    truths = numpy.array([[1, 0, 0, 1]] * 3, dtype=bool)
+    assert not tra.sat_rates_resolved(truths, True)
+    assert tra.decide_sat_rate(0, 4, 0.5) is False
+    assert tra.decide_sat_rate(4, 4, 0.5) is True
+    assert tra.decide_sat_rate(2, 4, 0.5) is None
+
+
+class _FakeKappaInstance(object):
+    def __init__(self, num_running):
+        self.num_running = num_running
+        self.paused = False
+
+    def simulation_info(self):
+        self.num_running -= 1
+        return {'simulation_progress_is_running': self.num_running >= 0}
+
+    def simulation_pause(self):
+        self.paused = True
+
+
+def test_run_to_completion():
+    kappa = object.__new__(kappa_client.KappaRuntime)
+    kappa.kappa_instance = _FakeKappaInstance(3)
+    statuses = []
+    status = kappa.run_to_completion(min_interval=0.001,
+                                     callback=statuses.append)
+    assert not status['simulation_progress_is_running']
+    assert len(statuses) == 3
+
+
+@raises(tra.SimulatorError)
+def test_run_to_completion_timeout():
+    kappa = object.__new__(kappa_client.KappaRuntime)
+    kappa.kappa_instance = _FakeKappaInstance(10**6)
+    try:
+        kappa.run_to_completion(timeout=0.05)
+    finally:
+        assert kappa.kappa_instance.paused
+
+
+def test_run_to_completion_stop():
+    kappa = object.__new__(kappa_client.KappaRuntime)
+    kappa.kappa_instance = _FakeKappaInstance(10**6)
+    statuses = []
+
+    def callback(status_json):
+        statuses.append(status_json)
+        return len(statuses) == 2
+    status = kappa.run_to_completion(min_interval=0.001, callback=callback)
+    assert status['simulation_progress_is_running']
+    assert len(statuses) == 2
+    assert kappa.kappa_instance.paused
+
+
+class _FakeParsingKappaInstance(object):
+    def __init__(self):
+        self.num_parsed = 0
+        self.healthy = True
+
+    def reset_project(self):
+        pass
+
+    def add_model_string(self, code_str):
+        pass
+
+    def project_parse(self):
+        self.num_parsed += 1
+        return {}
+
+    def get_info(self):
+        if not self.healthy:
+            raise Exception('Kappa runtime stopped.')
+        return {}
+
+
+class _FakeRuntimePool(kappa_client.KappaRuntimePool):
+    def _start_runtime(self):
+        kappa = object.__new__(kappa_client.KappaRuntime)
+        kappa.kappa_instance = _FakeParsingKappaInstance()
+        kappa.model_str = None
+        kappa.parse_content = None
+        return kappa
+
+
+def test_load_model_cached():
+    kappa = _FakeRuntimePool()._start_runtime()
+    kappa.load_model('%init: 10 A()')
+    kappa.load_model('%init: 10 A()')
+    assert kappa.kappa_instance.num_parsed == 1
+    kappa.load_model('%init: 20 A()')
+    assert kappa.kappa_instance.num_parsed == 2
+
+
+def test_runtime_pool():
+    pool = _FakeRuntimePool(max_size=2)
+    with pool.session('model1') as kappa1:
+        kappa1.load_model('model1')
+    with pool.session('model2') as kappa2:
+        kappa2.load_model('model2')
+    # The same runtime is reused for sequential sessions
+    assert kappa2 is kappa1
+    with pool.session() as kappa2:
+        kappa2.load_model('model2')
+        with pool.session() as kappa3:
+            assert kappa3 is not kappa2
+            kappa3.load_model('model3')
+    # Runtimes that already parsed a model are preferred
+    with pool.session('model2') as kappa:
+        assert kappa is kappa2
+    with pool.session('model3') as kappa:
+        assert kappa is kappa3
+    # Runtimes that don't respond are replaced
+    kappa3.kappa_instance.healthy = False
+    with pool.session('model3') as kappa:
+        assert kappa is not kappa3
+    assert pool.num_runtimes == 2
+
+
+@raises(tra.SimulatorError)
+def test_runtime_pool_timeout():
+    pool = _FakeRuntimePool(max_size=1)
+    with pool.session():
+        pool.checkout(timeout=0.01)
+
+
+def test_formula_stop_check():
+    yobs = numpy.zeros(4, dtype=[('X', float)])
+    stop_check = tra.FormulaStopCheck(['G[X,0,0]'], ['X'])
+    assert not stop_check(yobs)
+    # Starting low, the threshold is fixed so the observable is known to
+    # be high
+    yobs['X'] = [0, 10, 50, 20]
+    assert stop_check(yobs)
+    # Trajectories not reaching the window are not checked
+    assert not tra.FormulaStopCheck(['G[X,0,0]'], ['X'], (4, 6))(yobs)
+    # Starting high, the threshold can still grow
+    yobs['X'] = [100, 100, 180, 100]
+    assert not stop_check(yobs)
+    assert tra.FormulaStopCheck(['G[X,1,1]'], ['X'])(yobs)
+
+
+def test_model_structure_hash():
+    model1 = _get_gk_model()
+    model2 = _get_gk_model()
+    model2.parameters['MAP2K1_0'].value = 500
+    assert tra.get_model_structure_hash(model1) == \
+        tra.get_model_structure_hash(model2)
+    tra.get_create_observable(model2, Agent('MAPK1'))
+    assert tra.get_model_structure_hash(model1) != \
+        tra.get_model_structure_hash(model2)
+
+
+def test_model_hash():
+    model1 = _get_gk_model()
+    model2 = _get_gk_model()
+    assert tra.get_model_hash(model1) == tra.get_model_hash(model2)
+    model2.parameters['MAP2K1_0'].value = 500
+    assert tra.get_model_hash(model1) != tra.get_model_hash(model2)
+    assert tra.get_model_hash(model1, {'MAP2K1_0': 500}) == \
+        tra.get_model_hash(model2)
+
+
+def test_sim_cache():
+    cache = SimulationCache(tempfile.mkdtemp(), max_bytes=3000)
+    tspan = numpy.linspace(0, 100, 11)
+    yobs = numpy.zeros(11, dtype=[('X', float), ('Y', float)])
+    yobs['X'] = tspan ** 2
+    key = get_sim_key('abc', 100, 10, 1, 'kappa')
+    assert key != get_sim_key('abc', 100, 10, 2, 'kappa')
+    assert cache.get(key) is None
+    cache.put(key, tspan, yobs)
+    cached_tspan, cached_yobs = cache.get(key)
+    assert (cached_tspan == tspan).all()
+    assert (cached_yobs['X'] == yobs['X']).all()
+    assert cached_yobs.dtype.names == ('X', 'Y')
+    # Least recently used trajectories are removed above the size limit
+    for seed in range(2, 10):
+        cache.put(get_sim_key('abc', 100, 10, seed, 'kappa'), tspan, yobs)
+    assert cache.get(key) is None
+    assert cache.get(get_sim_key('abc', 100, 10, 9, 'kappa')) is not None
+
+
+def test_discretize_obs():
+    t = tra.TRA(use_kappa=False)
+    obs_values = numpy.array([[0, 10, 50, 20],
+                              [100, 100, 180, 100]], dtype=float)
+    obs_disc, thresholds = t.discretize_obs(None, obs_values)
+    assert obs_disc.dtype == numpy.uint8
+    assert list(thresholds) == [30, 140]
+    assert obs_disc.tolist() == [[0, 0, 1, 0], [0, 0, 1, 0]]
+    # The input values are not changed
+    assert obs_values[0, 2] == 50
+    # Thresholds are computed within the window
+    obs_disc, thresholds = t.discretize_obs(None, obs_values, (2, 3))
+    assert list(thresholds) == [65, 220]
+    assert obs_disc.tolist() == [[0, 0, 0, 0], [0, 0, 0, 0]]
+
+
+def test_figure_renderer():
+    fig_dir = tempfile.mkdtemp()
+    renderer = FigureRenderer(fig_dir)
+
+    def draw(fig, ts, values):
+        fig.gca().plot(ts, values)
+    ts = numpy.linspace(0, 10, 11)
+    fig_path = renderer.render('test', draw, ts, ts**2)
+    # Identical data is rendered only once, to the same file
+    assert renderer.render('test', draw, ts, ts**2) == fig_path
+    assert renderer.render('test', draw, ts, ts**3) != fig_path
+    renderer.wait(fig_path)
+    assert os.path.exists(fig_path)
+    paths = []
+    renderer.add_done_callback(fig_path, paths.append)
+    renderer.wait_all()
+    assert paths == [fig_path]
+
+
+def test_figure_renderer_prepare():
+    renderer = FigureRenderer(tempfile.mkdtemp())
+
+    def draw(fig, values):
+        fig.gca().plot(values)
+    fig_path = renderer.prepare('test', draw, numpy.arange(3))
+    # Prepared figures are only rendered when asked for
+    assert fig_path not in renderer.jobs
+    paths = []
+    renderer.add_done_callback(fig_path, paths.append)
+    renderer.wait_all()
+    assert paths == [fig_path]
+    # Callbacks are never called right away, even for saved figures
+    renderer.executor.submit(time.sleep, 0.1)
+    renderer.add_done_callback(fig_path, paths.append)
+    assert paths == [fig_path]
+    renderer.wait_all()
+    assert paths == [fig_path, fig_path]
+
+
+def test_figure_renderer_eviction():
+    fig_dir = tempfile.mkdtemp()
+    renderer = FigureRenderer(fig_dir, max_files=2)
+
+    def draw(fig, values):
+        fig.gca().plot(values)
+    paths = [renderer.render('test', draw, numpy.arange(i + 2))
+             for i in range(2)]
+    renderer.wait(paths[1])
+    # Reusing a figure marks it as recently used
+    os.utime(paths[0], (0, 0))
+    os.utime(paths[1], (1, 1))
+    assert renderer.render('test', draw, numpy.arange(2)) == paths[0]
+    new_path = renderer.render('test', draw, numpy.arange(5))
+    renderer.wait(new_path)
+    assert os.path.exists(paths[0])
+    assert not os.path.exists(paths[1])
+    assert os.path.exists(new_path)
+
+
+def test_get_sim_result():
+    kappa_plot = {'legend': ['[T]', 'A', 'B'],
+                  'series': [[10.0, 5, 6], [0.0, 1, 2], [20.0, 3, 4]]}
+    tspan, yobs = tra.get_sim_result(kappa_plot)
+    assert list(tspan) == [0, 10, 20]
+    assert list(yobs['A']) == [1, 5, 3]
+    assert list(yobs['B']) == [2, 6, 4]
+    assert yobs.dtype.names == ('A', 'B')
+
+
+def test_sim_result_decoder_partial():
+    decoder = tra.SimResultDecoder()
+    plot1 = {'legend': ['[T]', 'A'], 'series': [[0.0, 1], [10.0, 2]]}
+    plot2 = {'legend': ['[T]', 'A'],
+             'series': [[0.0, 1], [10.0, 2], [20.0, 3]]}
+    assert decoder.update(plot1) == 2
+    assert decoder.update(plot2) == 1
+    tspan, yobs = decoder.get_result()
+    assert list(tspan) == [0, 10, 20]
+    assert list(yobs['A']) == [1, 2, 3]
+
+
+def test_get_int_arg():
+    kwargs = {'argv': ['--sim_workers', '4']}
+    assert tra_module.get_int_arg('sim_workers', kwargs) == 4
+    kwargs = {'sim_workers': 2}
+    assert tra_module.get_int_arg('sim_workers', kwargs, 1) == 2
+    assert 'sim_workers' not in kwargs
+    assert tra_module.get_int_arg('sim_workers', {}, 1) == 1
+
+
+def test_get_str_arg():
+    kwargs = {'argv': ['--sim_cache_dir', '/tmp/sims']}
+    assert tra_module.get_str_arg('sim_cache_dir', kwargs) == '/tmp/sims'
+    kwargs = {'sim_cache_dir': '/tmp/other'}
+    assert tra_module.get_str_arg('sim_cache_dir', kwargs) == '/tmp/other'
+    assert 'sim_cache_dir' not in kwargs
+    assert tra_module.get_str_arg('sim_cache_dir', {}, 'x') == 'x'
+
+
+def test_get_cache_dir():
+    old_dir = os.environ.get('BIOAGENTS_CACHE_DIR')
+    os.environ['BIOAGENTS_CACHE_DIR'] = '/tmp/bioagents_cache'
+    try:
+        assert get_cache_dir('figures') == '/tmp/bioagents_cache/figures'
+    finally:
+        if old_dir is None:
+            del os.environ['BIOAGENTS_CACHE_DIR']
+        else:
+            os.environ['BIOAGENTS_CACHE_DIR'] = old_dir
+
+
 # Module level TRA tests
 
 def test_module():
@@ -1001,6 +1572,55 @@ class TestCompareConditions(_IntegrationTest):
         assert satisfied == 'no_change'
 
 
+class TestSweepConditions(_IntegrationTest):
+    def __init__(self, *args, **kwargs):
+        super(TestSweepConditions, self).__init__(tra_module.TRA_Module,
+                                                  use_kappa=False)
+        model_txt = 'Vemurafenib inhibits ERK. MEK activates ERK.'
+        self.model = \
+            stmts_kstring_from_text(model_txt)
+
+    def create_message(self):
+        condition_entity = ekb_kstring_from_text('Vemurafenib')
+        target_entity = ekb_kstring_from_text('Active ERK')
+        content = KQMLList('MODEL-SWEEP-CONDITIONS')
+        content.set('model', self.model)
+        content.set('agents', KQMLList([condition_entity]))
+        content.set('affected', target_entity)
+        content.set('multipliers', KQMLList.from_string('(0 1 10 100)'))
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message(self, output):
+        assert output.head() == 'SUCCESS'
+        assert len(output.get('conditions')) == 4
+        aucs = [float(auc.to_string()) for auc in output.get('auc')]
+        assert len(aucs) == 4
+        # More inhibitor means less active ERK
+        assert aucs[0] >= aucs[-1]
+
+
+class TestSweepConditionsInvalid(_FailureTest):
+    def __init__(self, *args, **kwargs):
+        super(TestSweepConditionsInvalid, self).__init__(
+            tra_module.TRA_Module, use_kappa=False)
+        model_txt = 'Vemurafenib inhibits ERK.'
+        self.model = stmts_kstring_from_text(model_txt)
+        self.expected_reason = 'INVALID_CONDITION'
+
+    def create_message(self):
+        condition_entity = ekb_kstring_from_text('Vemurafenib')
+        target_entity = ekb_kstring_from_text('ERK')
+        content = KQMLList('MODEL-SWEEP-CONDITIONS')
+        content.set('model', self.model)
+        content.set('agents', KQMLList([condition_entity]))
+        content.set('affected', target_entity)
+        # Negative multipliers are not valid conditions
+        content.set('multipliers', KQMLList.from_string('(1 -1)'))
+        msg = get_request(content)
+        return msg, content
+
+
 class TestCompareConditionsMissing(_IntegrationTest):
     def __init__(self, *args, **kwargs):
         super(TestCompareConditionsMissing, self).__init__(
@@ -0,0 +1,193 @@
+"""Background rendering of content-addressed figures."""
+
+import os
+import numpy
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+logger = logging.getLogger('figure_renderer')
+
+
+class FigureRenderer(object):
+    """Render figures on a background thread.
+
+    Figures are saved under a file name derived from a hash of the data
+    they are drawn from, so that a figure of data that was already plotted
+    is not rendered again. Figures are drawn on standalone matplotlib
+    Figure objects rather than through pyplot, so no figure outlives its
+    rendering job. A figure can also be prepared, so that its path is known,
+    and only rendered later, e.g. once a reply referring to it is sent.
+    When there are more than max_files figures in the folder, the least
+    recently used ones are removed.
+
+    Parameters
+    ----------
+    fig_dir : str
+        The folder in which figures are saved. It is created if it doesn't
+        exist.
+    max_files : Optional[int]
+        The maximal number of figures kept in the folder. Default: 200
+    """
+    def __init__(self, fig_dir, max_files=200):
+        self.fig_dir = fig_dir
+        self.max_files = max_files
+        if not os.path.exists(fig_dir):
+            os.makedirs(fig_dir)
+        # Rendering jobs are run one at a time, in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.jobs = {}
+        # Figures whose rendering hasn't been started, by path
+        self.prepared = OrderedDict()
+        self.max_prepared = 32
+        self.lock = threading.Lock()
+
+    def render(self, name, draw, *args):
+        """Schedule the rendering of a figure and return its path.
+
+        The arguments are those of prepare.
+        """
+        fig_path = self.prepare(name, draw, *args)
+        self.start(fig_path)
+        return fig_path
+
+    def prepare(self, name, draw, *args):
+        """Return the path of a figure to be rendered by start or
+        add_done_callback.
+
+        Parameters
+        ----------
+        name : str
+            A prefix for the file name of the figure.
+        draw : function
+            A function taking a matplotlib Figure and args, which draws
+            the figure.
+        *args
+            The data from which the figure is drawn.
+
+        Returns
+        -------
+        fig_path : str
+            The path at which the figure is, or will be, saved.
+        """
+        key = get_data_hash((draw.__name__,) + args)
+        fig_path = os.path.join(self.fig_dir, '%s_%s.png' % (name, key))
+        with self.lock:
+            self.prepared[fig_path] = (draw, args)
+            while len(self.prepared) > self.max_prepared:
+                self.prepared.popitem(last=False)
+        return fig_path
+
+    def start(self, fig_path):
+        """Schedule the rendering of a prepared figure, unless the figure
+        is already saved or being rendered."""
+        with self.lock:
+            job = self.prepared.pop(fig_path, None)
+            if fig_path in self.jobs:
+                logger.info('Reusing figure %s' % fig_path)
+                return
+            try:
+                # Mark the figure as recently used
+                os.utime(fig_path, None)
+                logger.info('Reusing figure %s' % fig_path)
+                return
+            except OSError:
+                pass
+            if job is not None:
+                draw, args = job
+                self.jobs[fig_path] = self.executor.submit(
+                    self._render, fig_path, draw, args)
+
+    def add_done_callback(self, fig_path, callback):
+        """Start rendering a figure if it was only prepared, and call
+        callback with fig_path once the figure has been saved.
+
+        callback is always called from the rendering thread, after the
+        figures scheduled before it. If rendering the figure fails,
+        callback is not called.
+        """
+        self.start(fig_path)
+        self.executor.submit(self._notify, fig_path, callback)
+
+    def wait_all(self):
+        """Block until the figures and callbacks scheduled so far are
+        done."""
+        self.executor.submit(lambda: None).result()
+
+    def wait(self, fig_path):
+        """Block until the figure at the given path has been rendered."""
+        with self.lock:
+            future = self.jobs.get(fig_path)
+        if future is not None:
+            future.result()
+
+    def _notify(self, fig_path, callback):
+        if not os.path.exists(fig_path):
+            return
+        try:
+            callback(fig_path)
+        except Exception as e:
+            logger.error('Could not report figure %s' % fig_path)
+            logger.exception(e)
+
+    def _render(self, fig_path, draw, args):
+        try:
+            fig = Figure()
+            FigureCanvasAgg(fig)
+            draw(fig, *args)
+            # Save under a temporary name so that a figure file only exists
+            # once it is complete
+            tmp_path = fig_path + '.tmp'
+            fig.savefig(tmp_path, format='png')
+            os.replace(tmp_path, fig_path)
+        except Exception as e:
+            logger.error('Could not render figure %s' % fig_path)
+            logger.exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.jobs.pop(fig_path, None)
+        with self.lock:
+            self._evict()
+        return fig_path
+
+    def _evict(self):
+        entries = []
+        for fname in os.listdir(self.fig_dir):
+            path = os.path.join(self.fig_dir, fname)
+            if not fname.endswith('.png') or path in self.jobs:
+                continue
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+        num_evicted = len(entries) - self.max_files
+        for _, path in sorted(entries)[:max(num_evicted, 0)]:
+            logger.info('Removing figure %s' % path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_data_hash(data):
+    """Return a hash of a nested structure of lists, tuples and arrays."""
+    h = hashlib.md5()
+    _update_hash(h, data)
+    return h.hexdigest()
+
+
+def _update_hash(h, data):
+    if isinstance(data, numpy.ndarray):
+        h.update(('array%s%s' % (data.dtype, data.shape)).encode('utf-8'))
+        h.update(numpy.ascontiguousarray(data).tobytes())
+    elif isinstance(data, (list, tuple)):
+        h.update(('seq%d' % len(data)).encode('utf-8'))
+        for elem in data:
+            _update_hash(h, elem)
+    else:
+        h.update(repr(data).encode('utf-8'))
@@ -1,7 +1,12 @@
 """Web API client for a Kappa simulator."""
 
+import os
 import kappy
+import threading
+from time import sleep, time
+from contextlib import contextmanager
 from logging import getLogger, DEBUG
+from bioagents import BioagentException
 
 logger = getLogger('kappa_client')
 
@@ -20,6 +25,9 @@ class KappaRuntime(object):
             self.kappa_instance.get_info()
         else:
             self.kappa_instance = kappy.KappaStd()
+        # The model last loaded in the project and the result of parsing it
+        self.model_str = None
+        self.parse_content = None
         return
 
     def add_code(self, code_str, name=None):
@@ -44,8 +52,24 @@ class KappaRuntime(object):
         for code_str in [] if code_list is None else code_list:
             self.kappa_instance.add_model_string(code_str)
         content = self.kappa_instance.project_parse()
+        self.model_str = None
         return content
 
+    def load_model(self, code_str):
+        """Make a model string the only code in the project and return the
+        result of parsing it.
+
+        The project is only parsed again if the model is different from the
+        last one loaded.
+        """
+        if self.model_str is not None and code_str == self.model_str:
+            return self.parse_content
+        self.reset_project()
+        self.kappa_instance.add_model_string(code_str)
+        self.parse_content = self.kappa_instance.project_parse()
+        self.model_str = code_str
+        return self.parse_content
+
     def start_sim(self, **parameters):
         """Start a simulation with given parameters.
 
@@ -71,10 +95,9 @@ class KappaRuntime(object):
             'seed': None,
             'store_trace': True
             }
+        complete_params.update(parameters)
         sim_params = kappy.SimulationParameter(**complete_params)
-        self.kappa_instance.simulaiton_start(sim_params)
-        resp = complete_params.update(parameters)
-        return resp.json()
+        return self.kappa_instance.simulation_start(sim_params)
 
     def pause_sim(self):
         """Pause a given simulation."""
@@ -88,6 +111,209 @@ class KappaRuntime(object):
         """Return status of running simulation."""
         return self.kappa_instance.simulation_info()
 
+    def run_to_completion(self, timeout=None, min_interval=0.01,
+                          max_interval=1.0, callback=None):
+        """Block until the running simulation finishes and return its status.
+
+        The simulation status is polled immediately and then at intervals
+        that grow exponentially from min_interval up to max_interval, so that
+        short simulations return as soon as they are finished.
+
+        Parameters
+        ----------
+        timeout : float or None
+            The number of seconds after which the simulation is paused and
+            a SimulatorError is raised. None by default, meaning no timeout.
+        min_interval : float
+            The initial polling interval in seconds. Default: 0.01
+        max_interval : float
+            The maximal polling interval in seconds. Default: 1.0
+        callback : function or None
+            A function called with the status of the simulation every time
+            it is polled while the simulation is still running. If it
+            returns True, the simulation is paused and its status returned
+            without waiting for it to finish.
+        """
+        start = time()
+        interval = min_interval
+        while True:
+            status_json = self.sim_status()
+            if not status_json.get('simulation_progress_is_running'):
+                return status_json
+            if callback is not None and callback(status_json):
+                self.pause_sim()
+                return status_json
+            elapsed = time() - start
+            if timeout is not None and elapsed >= timeout:
+                self.pause_sim()
+                raise SimulatorError('Simulation did not finish in %g '
+                                     'seconds.' % timeout)
+            if timeout is not None:
+                interval = min(interval, timeout - elapsed)
+            sleep(interval)
+            interval = min(2 * interval, max_interval)
+
     def sim_plot(self):
         """Get the data from the simulation."""
         return self.kappa_instance.simulation_plot()
+
+    def delete_sim(self):
+        """Delete the simulation, keeping the parsed project."""
+        self.kappa_instance.simulation_delete()
+
+    def influence_map(self):
+        """Return the influence map of the parsed project."""
+        return self.kappa_instance.analyses_influence_map()
+
+    def contact_map(self):
+        """Return the contact map of the parsed project."""
+        return self.kappa_instance.analyses_contact_map()
+
+    def reset_project(self):
+        """Remove all files and simulations from the project."""
+        self.model_str = None
+        self.parse_content = None
+        self.kappa_instance.reset_project()
+
+    def is_healthy(self):
+        """Return True if the Kappa runtime responds to requests."""
+        try:
+            self.kappa_instance.get_info()
+            return True
+        except Exception as e:
+            logger.warning('Kappa runtime is not healthy: %s' % e)
+            return False
+
+    def close(self):
+        """Stop the Kappa runtime."""
+        shutdown = getattr(self.kappa_instance, 'shutdown', None)
+        if shutdown is not None:
+            try:
+                shutdown()
+            except Exception as e:
+                logger.warning('Could not stop Kappa runtime: %s' % e)
+
+
+class KappaRuntimePool(object):
+    """A bounded pool of standard Kappa runtimes shared between callers.
+
+    Runtimes are started on demand, up to max_size of them, and are returned
+    to the pool after use so that their processes are reused. A runtime
+    keeps the last model it parsed, and runtimes that already parsed the
+    model asked for are checked out first. Runtimes are checked for health
+    when they are checked out and replaced if they don't respond.
+
+    Parameters
+    ----------
+    max_size : Optional[int]
+        The maximal number of runtimes. Default: 4
+    project_name : Optional[str]
+        The project name given to the runtimes.
+    """
+    def __init__(self, max_size=4, project_name=None):
+        self.max_size = max_size
+        self.project_name = project_name
+        self.idle = []
+        self.num_runtimes = 0
+        self.condition = threading.Condition()
+
+    def checkout(self, model_str=None, timeout=None):
+        """Return a runtime for exclusive use until it is checked in.
+
+        Parameters
+        ----------
+        model_str : Optional[str]
+            The model the runtime will be used with, if known.
+        timeout : Optional[float]
+            The number of seconds after which a SimulatorError is raised if
+            all the runtimes are still in use. None by default, meaning no
+            timeout.
+        """
+        deadline = None if timeout is None else time() + timeout
+        with self.condition:
+            while not self.idle and self.num_runtimes >= self.max_size:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    raise SimulatorError('No Kappa runtime available in %g '
+                                         'seconds.' % timeout)
+                self.condition.wait(remaining)
+            if self.idle:
+                runtime = self._pop_idle(model_str)
+            else:
+                runtime = None
+                self.num_runtimes += 1
+        if runtime is not None and not runtime.is_healthy():
+            logger.warning('Replacing Kappa runtime.')
+            runtime.close()
+            runtime = None
+        if runtime is None:
+            try:
+                runtime = self._start_runtime()
+            except Exception:
+                with self.condition:
+                    self.num_runtimes -= 1
+                    self.condition.notify()
+                raise
+        return runtime
+
+    def checkin(self, runtime, discard=False):
+        """Return a runtime to the pool, or stop it if discard is True."""
+        if discard:
+            runtime.close()
+            with self.condition:
+                self.num_runtimes -= 1
+                self.condition.notify()
+            return
+        with self.condition:
+            self.idle.append(runtime)
+            self.condition.notify()
+
+    @contextmanager
+    def session(self, model_str=None, timeout=None):
+        """Check out a runtime for the duration of a with block.
+
+        The runtime is discarded if the block raises an exception and the
+        runtime doesn't respond anymore.
+        """
+        runtime = self.checkout(model_str, timeout)
+        is_ok = False
+        try:
+            yield runtime
+            is_ok = True
+        finally:
+            self.checkin(runtime,
+                         discard=not (is_ok or runtime.is_healthy()))
+
+    def _start_runtime(self):
+        return KappaRuntime(self.project_name)
+
+    def _pop_idle(self, model_str):
+        for i, runtime in enumerate(self.idle):
+            if model_str is not None and runtime.model_str == model_str:
+                return self.idle.pop(i)
+        return self.idle.pop()
+
+
+# The runtime pool of the current process
+_runtime_pool = None
+_runtime_pool_pid = None
+_runtime_pool_lock = threading.Lock()
+
+
+def get_runtime_pool(max_size=4):
+    """Return the pool of standard Kappa runtimes shared within a process.
+
+    A process forked from one that has a pool gets a new pool, since the
+    runtimes of a pool are child processes of the process that started
+    them. max_size is only used when the pool is created.
+    """
+    global _runtime_pool, _runtime_pool_pid
+    with _runtime_pool_lock:
+        if _runtime_pool is None or _runtime_pool_pid != os.getpid():
+            _runtime_pool = KappaRuntimePool(max_size, 'bioagents')
+            _runtime_pool_pid = os.getpid()
+        return _runtime_pool
+
+
+class SimulatorError(BioagentException):
+    pass
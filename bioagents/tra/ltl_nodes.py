@@ -1,64 +1,156 @@
 import re
 from copy import deepcopy
+from functools import lru_cache
+from collections import namedtuple
+
+
+# An immutable, hashable representation of a parsed LTL formula. The op is
+# one of 'atomic', '!', 'F', 'G', '&', '|' and 'U'. For atomic formulas,
+# args is a (var_id, lb, ub) tuple, otherwise it is the tuple of child
+# formulas. For time-bounded F and G, bounds is the (lb, ub) window of time
+# points relative to the current one, otherwise it is None.
+LtlFormula = namedtuple('LtlFormula', ['op', 'args', 'bounds'])
+LtlFormula.__new__.__defaults__ = (None,)
+
+
+_token_pattern = re.compile(
+    r'\s*(?:(\[[^\[\]]*\]|\{[^{}]*\})|([FGU!&|()]))')
+
+
+def tokenize(formula_str):
+    """Return the list of tokens in a formula string in a single pass."""
+    tokens = []
+    fstr = formula_str.rstrip()
+    pos = 0
+    while pos < len(fstr):
+        match = _token_pattern.match(fstr, pos)
+        if match is None:
+            raise ValueError('Invalid LTL formula "%s" at position %d' %
+                             (formula_str, pos))
+        tokens.append(match.group(1) or match.group(2))
+        pos = match.end()
+    return tokens
+
+
+@lru_cache(maxsize=1024)
+def parse_formula(formula_str):
+    """Return the LtlFormula corresponding to a formula string.
+
+    Binary operators are right-associative with U (until) binding tighter
+    than & and & binding tighter than |, and the unary operators !, F and G
+    bind tighter than all of them. F and G can be bounded to a window of
+    time points relative to the current one, e.g. F{2,5}[X,1,1] means that
+    X is high at some point 2 to 5 time points later. Results are cached by
+    formula string.
+    """
+    parser = _FormulaParser(tokenize(formula_str), formula_str)
+    return parser.parse()
+
+
+class _FormulaParser(object):
+    def __init__(self, tokens, formula_str):
+        self.tokens = tokens
+        self.formula_str = formula_str
+        self.pos = 0
+
+    def parse(self):
+        formula = self.parse_or()
+        if self.pos != len(self.tokens):
+            self.error('Unexpected token %s' % self.tokens[self.pos])
+        return formula
+
+    def error(self, msg):
+        raise ValueError('Invalid LTL formula "%s": %s' %
+                         (self.formula_str, msg))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            self.error('Unexpected end of formula')
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        child1 = self.parse_and()
+        if self.peek() == '|':
+            self.pos += 1
+            return LtlFormula('|', (child1, self.parse_or()))
+        return child1
+
+    def parse_and(self):
+        child1 = self.parse_until()
+        if self.peek() == '&':
+            self.pos += 1
+            return LtlFormula('&', (child1, self.parse_and()))
+        return child1
+
+    def parse_until(self):
+        child1 = self.parse_unary()
+        if self.peek() == 'U':
+            self.pos += 1
+            return LtlFormula('U', (child1, self.parse_until()))
+        return child1
+
+    def parse_unary(self):
+        token = self.next()
+        if token in ('F', 'G') and (self.peek() or '').startswith('{'):
+            bounds = self.parse_bounds(self.next())
+            return LtlFormula(token, (self.parse_unary(),), bounds)
+        elif token in ('!', 'F', 'G'):
+            return LtlFormula(token, (self.parse_unary(),))
+        elif token == '(':
+            formula = self.parse_or()
+            if self.next() != ')':
+                self.error('Unbalanced parentheses')
+            return formula
+        elif token.startswith('['):
+            parts = token[1:-1].split(',')
+            if len(parts) != 3:
+                self.error('Invalid atomic proposition %s' % token)
+            var_id, lb, ub = parts
+            try:
+                lb = int(lb)
+                ub = int(ub)
+            except ValueError:
+                self.error('Invalid bounds in %s' % token)
+            return LtlFormula('atomic', (var_id.strip(), lb, ub))
+        self.error('Unexpected token %s' % token)
+
+    def parse_bounds(self, token):
+        parts = token[1:-1].split(',')
+        if len(parts) != 2:
+            self.error('Invalid time bounds %s' % token)
+        try:
+            lb = int(parts[0])
+            ub = int(parts[1])
+        except ValueError:
+            self.error('Invalid time bounds %s' % token)
+        if lb < 0 or ub < lb:
+            self.error('Invalid time bounds %s' % token)
+        return (lb, ub)
 
-def is_balanced(s, lc='(', rc=')'):
-    is_bal = 0
-    for i in range(len(s))[1:]:
-        is_bal += (s[i] == lc) - (s[i-1] == rc)
-    return is_bal
 
 def build_tree(formula_str, time_lim=None):
-    root = None
-    fstr = formula_str.strip()
-
-    str_r = fstr
-    str_l = None
-    while True:
-        parts = re.split('\|', fstr)
-        if len(parts) == 1:
-            break
-        str_l, str_r = parts[0], '|'.join(parts[1:])
-        if (is_balanced(str_l) == 0):
-            child1 = build_tree(str_l, time_lim)
-            child2 = build_tree(str_r, time_lim)
-            root = OrNode(time_lim, child1, child2)
-            return root
-
-    str_r = fstr
-    str_l = None
-    while True:
-        parts = re.split('&', fstr)
-        if len(parts) == 1:
-            break
-        str_l, str_r = parts[0], '&'.join(parts[1:])
-        if (is_balanced(str_l) == 0):
-            child1 = build_tree(str_l, time_lim)
-            child2 = build_tree(str_r, time_lim)
-            root = AndNode(time_lim, child1, child2)
-            return root
-
-    first_ch = fstr[0]
-    last_ch = fstr[-1]
-    if first_ch == '!':
-        child1 = build_tree(fstr[1:], time_lim)
-        root = NotNode(time_lim, child1)
-    elif first_ch == 'F':
-        child1 = build_tree(fstr[1:], time_lim)
-        root = FNode(time_lim, child1)
-    elif first_ch == 'G':
-        child1 = build_tree(fstr[1:], time_lim)
-        root = GNode(time_lim, child1)
-    elif first_ch == '[':
-        if last_ch == ']':
-            var_id, lb, ub = fstr[1:-1].split(',')
-            lb = int(lb)
-            ub = int(ub)
-            root = AtomicNode(var_id, lb, ub)
-    elif first_ch == '(':
-        if last_ch == ')':
-            root = build_tree(fstr[1:-1], time_lim)
-    if root is not None:
-        return root
+    """Return a new tree of Nodes for incremental checking of a formula."""
+    return _build_node(parse_formula(formula_str), time_lim)
+
+
+def _build_node(formula, time_lim):
+    if formula.op == 'atomic':
+        var_id, lb, ub = formula.args
+        return AtomicNode(var_id, lb, ub)
+    children = [_build_node(child, time_lim) for child in formula.args]
+    if formula.bounds is not None:
+        node_class = {'F': BoundedFNode, 'G': BoundedGNode}[formula.op]
+        return node_class(formula.bounds, *children)
+    node_class = {'!': NotNode, 'F': FNode, 'G': GNode,
+                  '&': AndNode, '|': OrNode, 'U': UntilNode}[formula.op]
+    return node_class(time_lim, *children)
 
 
 class Node(object):
@@ -150,6 +242,55 @@ class GNode(Node):
                     self.truth = tfx
         return self.truth
 
+class BoundedFNode(Node):
+    """Node of an F operator bounded to a window of time points.
+
+    Windows going beyond the last time point are cut to the last time
+    point. The truth of the child in the window is read from the nodes of
+    the following time points through next_node.
+    """
+    # The truth of the child that decides the truth of the node
+    decisive = True
+
+    def __init__(self, bounds, child1=None):
+        super(BoundedFNode, self).__init__(None, child1)
+        self.lb, self.ub = bounds
+
+    def eval_node(self):
+        if self.truth is not None:
+            return self.truth
+        node = self
+        time = 0
+        # Go to the start of the window or to the last time point
+        while time < self.lb and not node.is_last:
+            if node.next_node is None:
+                return None
+            node = node.next_node
+            time += 1
+        is_undecided = False
+        while True:
+            tf = node.child1.eval_node()
+            if tf is self.decisive:
+                self.truth = tf
+                return self.truth
+            elif tf is None:
+                is_undecided = True
+            if time >= self.ub or node.is_last:
+                break
+            if node.next_node is None:
+                return None
+            node = node.next_node
+            time += 1
+        if not is_undecided:
+            self.truth = not self.decisive
+        return self.truth
+
+
+class BoundedGNode(BoundedFNode):
+    """Node of a G operator bounded to a window of time points."""
+    decisive = False
+
+
 class AndNode(Node):
     def eval_node(self):
         if self.truth is not None:
@@ -185,6 +326,22 @@ class OrNode(Node):
         return self.truth
 
 
+class UntilNode(Node):
+    def eval_node(self):
+        if self.truth is not None:
+            return self.truth
+        tf2 = self.child2.eval_node()
+        if tf2 is True:
+            self.truth = True
+        elif tf2 is False:
+            tf1 = self.child1.eval_node()
+            if tf1 is False or self.is_last:
+                self.truth = False
+            elif tf1 is True and self.next_node is not None:
+                self.truth = self.next_node.eval_node()
+        return self.truth
+
+
 class NotNode(Node):
     def eval_node(self):
         # If thruth is already known
@@ -1,4 +1,5 @@
-from .ltl_nodes import build_tree
+import numpy
+from .ltl_nodes import build_tree, parse_formula
 
 
 class ModelChecker(object):
@@ -11,13 +12,7 @@ class ModelChecker(object):
         self.roots.append(root)
 
         if states is not None:
-            # Downsample here for speed
-            states = states[::5]
-            for t, s in enumerate(states):
-                tf = self.update(s, (t == (len(states)-1)))
-                if tf is not None:
-                    break
-            self.truth = tf
+            self.truth = check_formula(self.formula_str, states)
         else:
             self.truth = None
 
@@ -32,31 +27,358 @@ class ModelChecker(object):
         return self.truth
 
 
-def transient_formula(var_id):
-    fstr = 'F[%s,1,1] & FG([%s,0,0])' % (var_id, var_id)
+def check_formula(formula, states):
+    """Return the truth of a formula over a complete trajectory.
+
+    Parameters
+    ----------
+    formula : str or ltl_nodes.LtlFormula
+        The LTL formula string or an already parsed formula.
+    states : numpy.ndarray or dict
+        The trajectory, indexable by variable name to get the array of
+        values of that variable over time (e.g. a record array).
+
+    Returns
+    -------
+    truth : bool or None
+        The truth of the formula at the first time point, or None if the
+        trajectory is empty.
+    """
+    formula = _get_formula(formula)
+    values = eval_array(formula, states)
+    if len(values) == 0:
+        return None
+    return bool(values[0])
+
+
+def check_formulas(formulas, states):
+    """Return the truth of each formula on each of a set of trajectories.
+
+    Subformulas shared between the formulas (for instance the atomic
+    propositions of the suggestion patterns) are only evaluated once.
+
+    Parameters
+    ----------
+    formulas : list[str or ltl_nodes.LtlFormula]
+        A list of LTL formula strings or already parsed formulas.
+    states : numpy.ndarray or dict
+        The stacked trajectories with time as the last axis, e.g. a
+        (num_sim x T) matrix. A plain (non-record) array is taken to be the
+        values of the single variable referred to by the formulas,
+        otherwise states is indexed by variable name to get the
+        (num_sim x T) matrix of that variable.
+
+    Returns
+    -------
+    truths : numpy.ndarray
+        A boolean array of shape (len(formulas), num_sim), the truth of each
+        formula on each trajectory at its first time point.
+    """
+    cache = {}
+    truths = []
+    for formula in formulas:
+        values = eval_array(_get_formula(formula), states, cache)
+        if values.shape[-1] == 0:
+            raise ValueError('Cannot check formulas on empty trajectories.')
+        truths.append(values[..., 0])
+    return numpy.array(truths, dtype=bool)
+
+
+def eval_array(formula, states, cache=None):
+    """Return the truth of a parsed formula at every time point of states.
+
+    Each temporal operator is evaluated over the whole trajectory at once:
+    F and G are backward scans (suffix any/all) along the last (time) axis
+    over the truth values of their child and boolean operators are
+    elementwise. If a cache dict is given, the values of subformulas are
+    stored in and reused from it.
+    """
+    if cache is not None:
+        if formula not in cache:
+            cache[formula] = _eval_formula_array(formula, states, cache)
+        return cache[formula]
+    return _eval_formula_array(formula, states, cache)
+
+
+def _eval_formula_array(formula, states, cache):
+    if formula.op == 'atomic':
+        var_id, lb, ub = formula.args
+        vals = _get_values(states, var_id)
+        res = numpy.ones(vals.shape, dtype=bool)
+        if lb is not None:
+            res &= (vals >= lb)
+        if ub is not None:
+            res &= (vals <= ub)
+        return res
+    children = [eval_array(child, states, cache) for child in formula.args]
+    if formula.op == '!':
+        return ~children[0]
+    elif formula.op == '&':
+        return children[0] & children[1]
+    elif formula.op == '|':
+        return children[0] | children[1]
+    elif formula.op == 'F' and formula.bounds is not None:
+        counts, sizes = _window_counts(children[0], formula.bounds)
+        return counts > 0
+    elif formula.op == 'G' and formula.bounds is not None:
+        counts, sizes = _window_counts(children[0], formula.bounds)
+        return counts == sizes
+    elif formula.op == 'F':
+        return _suffix_any(children[0])
+    elif formula.op == 'G':
+        return _suffix_all(children[0])
+    elif formula.op == 'U':
+        return _until(children[0], children[1])
+    raise ValueError('Cannot evaluate formula %s' % str(formula))
+
+
+def check_formulas_partial(formulas, states, is_complete=False,
+                           states_upper=None):
+    """Return the truth of formulas on trajectories as far as it is decided.
+
+    This allows checking formulas while trajectories are still being
+    generated: a formula is decided on a trajectory prefix if it has the
+    same truth on every continuation of the prefix.
+
+    Parameters
+    ----------
+    formulas : list[str or ltl_nodes.LtlFormula]
+        A list of LTL formula strings or already parsed formulas.
+    states : numpy.ndarray or dict
+        The stacked trajectories (prefixes) with time as the last axis, as
+        in check_formulas.
+    is_complete : Optional[bool]
+        If True, the trajectories are complete, and all formulas are
+        decided. Default: False
+    states_upper : Optional[numpy.ndarray or dict]
+        If given, the values of variables are only known to be between
+        those in states and those in states_upper.
+
+    Returns
+    -------
+    truths : numpy.ndarray
+        An int8 array of shape (len(formulas), num_sim) which is 1 where a
+        formula is decided to be true, 0 where it is decided to be false
+        and -1 where it isn't decided yet.
+    """
+    cache = {}
+    truths = []
+    for formula in formulas:
+        is_true, is_false = eval_partial_array(_get_formula(formula), states,
+                                               states_upper, is_complete,
+                                               cache)
+        if is_true.shape[-1] == 0:
+            truths.append(-numpy.ones(is_true.shape[:-1], dtype=numpy.int8))
+            continue
+        truths.append(numpy.where(is_true[..., 0], 1,
+                                  numpy.where(is_false[..., 0], 0, -1)))
+    return numpy.array(truths, dtype=numpy.int8)
+
+
+def eval_partial_array(formula, states, states_upper, is_complete, cache):
+    """Return two arrays telling where a formula is decided to be true and
+    where it is decided to be false on the trajectory prefixes in states."""
+    if formula not in cache:
+        cache[formula] = _eval_partial_formula_array(formula, states,
+                                                     states_upper,
+                                                     is_complete, cache)
+    return cache[formula]
+
+
+def _eval_partial_formula_array(formula, states, states_upper, is_complete,
+                                cache):
+    if formula.op == 'atomic':
+        var_id, lb, ub = formula.args
+        vals_lower = _get_values(states, var_id)
+        if states_upper is None:
+            vals_upper = vals_lower
+        else:
+            vals_upper = _get_values(states_upper, var_id)
+        is_true = numpy.ones(vals_lower.shape, dtype=bool)
+        is_false = numpy.zeros(vals_lower.shape, dtype=bool)
+        if lb is not None:
+            is_true &= (vals_lower >= lb)
+            is_false |= (vals_upper < lb)
+        if ub is not None:
+            is_true &= (vals_upper <= ub)
+            is_false |= (vals_lower > ub)
+        return is_true, is_false
+    children = [eval_partial_array(child, states, states_upper, is_complete,
+                                   cache)
+                for child in formula.args]
+    if formula.op == '!':
+        is_true, is_false = children[0]
+        return is_false, is_true
+    elif formula.op == '&':
+        (t1, f1), (t2, f2) = children
+        return t1 & t2, f1 | f2
+    elif formula.op == '|':
+        (t1, f1), (t2, f2) = children
+        return t1 | t2, f1 & f2
+    elif formula.op in ('F', 'G') and formula.bounds is not None:
+        # Windows going beyond the end of a prefix can only be cut to the
+        # last time point once the trajectory is complete
+        is_true, is_false = children[0]
+        true_counts, sizes = _window_counts(is_true, formula.bounds,
+                                            is_complete)
+        false_counts, _ = _window_counts(is_false, formula.bounds,
+                                         is_complete)
+        if is_complete:
+            in_prefix = numpy.ones(sizes.shape, dtype=bool)
+        else:
+            num_times = is_true.shape[-1]
+            in_prefix = (numpy.arange(num_times) + formula.bounds[1] <
+                         num_times)
+        if formula.op == 'F':
+            return true_counts > 0, in_prefix & (false_counts == sizes)
+        return in_prefix & (true_counts == sizes), false_counts > 0
+    elif formula.op == 'F':
+        # Eventually can only be falsified once the trajectory is complete
+        is_true, is_false = children[0]
+        if is_complete:
+            return _suffix_any(is_true), _suffix_all(is_false)
+        return _suffix_any(is_true), numpy.zeros(is_false.shape, dtype=bool)
+    elif formula.op == 'G':
+        # Globally can only be verified once the trajectory is complete
+        is_true, is_false = children[0]
+        if is_complete:
+            return _suffix_all(is_true), _suffix_any(is_false)
+        return numpy.zeros(is_true.shape, dtype=bool), _suffix_any(is_false)
+    elif formula.op == 'U':
+        # Until is falsified where its first argument is decided false
+        # before its second argument can be true
+        (t1, f1), (t2, f2) = children
+        num_times = f1.shape[-1]
+        next_f1 = _next_index(f1)
+        next_not_f2 = _next_index(~f2)
+        is_false = (next_f1 < num_times) & (next_not_f2 > next_f1)
+        if is_complete:
+            is_false |= (next_not_f2 == num_times)
+        return _until(t1, t2), is_false
+    raise ValueError('Cannot evaluate formula %s' % str(formula))
+
+
+def _get_values(states, var_id):
+    if isinstance(states, numpy.ndarray) and states.dtype.names is None:
+        return states
+    return numpy.asarray(states[var_id])
+
+
+def _suffix_any(values):
+    return numpy.logical_or.accumulate(values[..., ::-1], axis=-1)[..., ::-1]
+
+
+def _suffix_all(values):
+    return numpy.logical_and.accumulate(values[..., ::-1], axis=-1)[..., ::-1]
+
+
+def _window_counts(values, bounds, cut_to_last=True):
+    """Return the number of True values in the window of time points given
+    by bounds from each time point, and the size of each window.
+
+    Window sums are differences of a cumulative sum along the time axis. If
+    cut_to_last is True, windows going beyond the last time point are cut
+    to the last time point, otherwise to the time points there are.
+    """
+    num_times = values.shape[-1]
+    times = numpy.arange(num_times)
+    if cut_to_last:
+        starts = numpy.minimum(times + bounds[0], num_times - 1)
+    else:
+        starts = numpy.minimum(times + bounds[0], num_times)
+    ends = numpy.minimum(times + bounds[1], num_times - 1) + 1
+    ends = numpy.maximum(ends, starts)
+    cumsum = numpy.zeros(values.shape[:-1] + (num_times + 1,), dtype=int)
+    numpy.cumsum(values, axis=-1, out=cumsum[..., 1:])
+    counts = cumsum[..., ends] - cumsum[..., starts]
+    return counts, ends - starts
+
+
+def _next_index(values):
+    """Return the index of the next time point at which values is True from
+    each time point on, or the number of time points if there is none."""
+    num_times = values.shape[-1]
+    idx = numpy.where(values, numpy.arange(num_times), num_times)
+    return numpy.minimum.accumulate(idx[..., ::-1], axis=-1)[..., ::-1]
+
+
+def _until(values1, values2):
+    # values2 becomes True before (or when) values1 first becomes False
+    next_true2 = _next_index(values2)
+    return (next_true2 < values2.shape[-1]) & \
+        (next_true2 <= _next_index(~values1))
+
+
+def _get_formula(formula):
+    if isinstance(formula, str):
+        return parse_formula(formula)
+    return formula
+
+
+# The formulas of patterns can be restricted to a window (lb, ub) of time
+# points, within which they are checked as if the trajectory ended at ub.
+# Eventually always on a trajectory ending at ub only depends on the value at
+# ub.
+
+def transient_formula(var_id, window=None):
+    if window is None:
+        fstr = 'F[%s,1,1] & FG([%s,0,0])' % (var_id, var_id)
+    else:
+        lb, ub = window
+        fstr = 'F{%d,%d}[%s,1,1] & G{%d,%d}[%s,0,0]' % (lb, ub, var_id,
+                                                      ub, ub, var_id)
     return fstr
 
 
-def sustained_formula(var_id):
-    fstr = 'FG[%s,1,1]' % var_id
+def sustained_formula(var_id, window=None):
+    return eventual_formula(var_id, 1, window)
+
+
+def noact_formula(var_id, window=None):
+    return always_formula(var_id, 0, window)
+
+
+def always_formula(var_id, value, window=None):
+    fstr = 'G%s[%s,%d,%d]' % (_window_str(window), var_id, value, value)
     return fstr
 
 
-def noact_formula(var_id):
-    fstr = 'G[%s,0,0]' % var_id
+def eventual_formula(var_id, value, window=None):
+    if window is None:
+        fstr = 'FG[%s,%d,%d]' % (var_id, value, value)
+    else:
+        fstr = 'G{%d,%d}[%s,%d,%d]' % (window[1], window[1], var_id, value,
+                                       value)
     return fstr
 
 
-def always_formula(var_id, value):
-    fstr = 'G[%s,%d,%d]' % (var_id, value, value)
+def sometime_formula(var_id, value, window=None):
+    fstr = 'F%s[%s,%d,%d]' % (_window_str(window), var_id, value, value)
     return fstr
 
 
-def eventual_formula(var_id, value):
-    fstr = 'FG[%s,%d,%d]' % (var_id, value, value)
+def until_formula(var_id1, value1, var_id2, value2, window=None):
+    """Return the formula of the first variable having a value until the
+    second one has a value.
+
+    With a window, the trajectory has to end at the end of the window as
+    until can't be bounded.
+    """
+    fstr = '[%s,%d,%d] U [%s,%d,%d]' % (var_id1, value1, value1,
+                                        var_id2, value2, value2)
+    if window is not None:
+        fstr = 'F{%d,%d}(%s)' % (window[0], window[0], fstr)
     return fstr
 
 
-def sometime_formula(var_id, value):
-    fstr = 'F[%s,%d,%d]' % (var_id, value, value)
+def _window_str(window):
+    if window is None:
+        return ''
+    return '{%d,%d}' % window
+
+
+def and_formula(fstrs):
+    if len(fstrs) == 1:
+        return fstrs[0]
+    fstr = ' & '.join(['(%s)' % fs for fs in fstrs])
     return fstr
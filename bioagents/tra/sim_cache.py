@@ -0,0 +1,124 @@
+"""A persistent on-disk cache of simulation results."""
+
+import os
+import numpy
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger('sim_cache')
+
+# The version of simulation results, part of every cache key. It has to be
+# increased whenever a change to the simulators or to the way models are
+# simulated changes the results, so that older results aren't reused.
+SIM_CACHE_VERSION = 1
+
+
+class SimulationCache(object):
+    """Store simulation trajectories as .npy files in a folder.
+
+    Each trajectory is saved as a record array with a '[T]' field for time
+    points and a field for each observable, and is loaded back as a
+    read-only memory map so that only the observables that are used are
+    read from disk. When the total size of the cached files goes above
+    max_bytes, the least recently used files are removed.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The folder in which trajectories are saved. It is created if it
+        doesn't exist.
+    max_bytes : Optional[int]
+        The maximal total size of cached files. Default: 500 MB
+    """
+    def __init__(self, cache_dir, max_bytes=500 * 2**20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, key):
+        """Return the (tspan, yobs) trajectory stored under a key or None."""
+        path = self._get_path(key)
+        try:
+            values = numpy.load(path, mmap_mode='r')
+            # Mark the file as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        obs_names = [name for name in values.dtype.names if name != '[T]']
+        return values['[T]'], values[obs_names]
+
+    def put(self, key, tspan, yobs):
+        """Store a (tspan, yobs) trajectory under a key."""
+        obs_names = list(yobs.dtype.names)
+        values = numpy.zeros(len(tspan), dtype=[('[T]', float)] +
+                             [(name, float) for name in obs_names])
+        values['[T]'] = tspan
+        for name in obs_names:
+            values[name] = yobs[name]
+        path = self._get_path(key)
+        # Save under a temporary name so that a cached file only exists once
+        # it is complete
+        tmp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(tmp_path, 'wb') as fh:
+            numpy.save(fh, values)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self._evict()
+
+    def clear(self):
+        """Remove all the cached trajectories."""
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.npy'):
+                os.remove(os.path.join(self.cache_dir, fname))
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, '%s.npy' % key)
+
+    def _evict(self):
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.info('Removing cached simulation %s' % path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def get_sim_key(model_hash, max_time, plot_period, seed, mode):
+    """Return the cache key of a simulation.
+
+    Parameters
+    ----------
+    model_hash : str
+        A hash of the simulated model including its parameter values, see
+        tra.get_model_hash.
+    max_time : float
+        The time until which the model is simulated.
+    plot_period : float
+        The period at which simulation output is sampled.
+    seed : int or None
+        The random seed of a stochastic simulation, None for deterministic
+        simulations.
+    mode : str
+        The simulator used, e.g. 'ode' or 'kappa'.
+    """
+    key_str = '%d|%s|%r|%r|%r|%s' % (SIM_CACHE_VERSION, model_hash,
+                                     float(max_time), float(plot_period),
+                                     seed, mode)
+    return hashlib.md5(key_str.encode('utf-8')).hexdigest()
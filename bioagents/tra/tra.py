@@ -1,17 +1,29 @@
 from bioagents.tra import kappa_client
-__all__ = ['TRA', 'get_ltl_from_pattern', 'apply_condition',
+from bioagents.tra.kappa_client import SimulatorError
+__all__ = ['TRA', 'get_ltl_from_pattern', 'get_joint_ltl_from_pattern',
+           'get_qualitative_value', 'get_joint_patterns', 'apply_condition',
            'get_create_observable', 'pysb_to_kappa', 'get_sim_result',
+           'stack_observable', 'run_kappa_simulation', 'get_sat_interval',
+           'sat_rates_resolved', 'decide_sat_rate',
+           'get_model_structure_hash',
+           'get_condition_params', 'set_kappa_params', 'SimResultDecoder',
+           'discretize_values', 'discretize_partial', 'get_window_values',
+           'FormulaStopCheck',
+           'get_model_hash', 'is_sim_complete', 'get_sim_grid',
            'get_all_patterns', 'TemporalPattern', 'TimeInterval',
            'InvalidTemporalPatternError', 'InvalidTimeIntervalError',
            'MolecularCondition', 'MolecularQuantity',
            'MolecularQuantityReference', 'InvalidMolecularConditionError',
            'InvalidMolecularQuantityError',
            'InvalidMolecularQuantityRefError', 'SimulatorError']
-import os
+import re
 import numpy
+import hashlib
 import logging
-from time import sleep
+import itertools
+from collections import OrderedDict
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 import sympy.physics.units as units
 import indra.statements as ist
 import indra.assemblers.pysb_assembler as pa
@@ -20,133 +32,231 @@ from pysb import Observable
 from pysb.integrate import Solver
 from pysb.export.kappa import KappaExporter
 import bioagents.tra.model_checker as mc
-import matplotlib
-from bioagents import BioagentException
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.patches import Rectangle
+from bioagents import BioagentException, get_cache_dir
+from bioagents.tra.figure_renderer import FigureRenderer
+from bioagents.tra.sim_cache import SimulationCache, get_sim_key
 
 
 logger = logging.getLogger('TRA')
 
+# The seed from which the seeds of the replicate simulations of models are
+# drawn when simulations are cached, fixed so that cached simulations are
+# reused across restarts
+REPLICATE_SEED = 1
+
 
 class TRA(object):
-    def __init__(self, use_kappa=True, use_kappa_rest=False):
+    def __init__(self, use_kappa=True, use_kappa_rest=False, sim_workers=1,
+                 seed=None, adaptive_sampling=True, min_sim=2, max_sim=16,
+                 sim_timeout=600.0, early_stop=True, sim_cache_dir=None,
+                 sim_cache_size=500 * 2**20, fig_dir=None):
         kappa_mode_label = 'rest' if use_kappa_rest else 'standard'
+        self.sim_pool = None
+        self.kappa = None
+        self.kappa_pool = None
+        # The number of seconds after which a Kappa simulation is abandoned
+        self.sim_timeout = sim_timeout
+        # Whether Kappa simulations are stopped as soon as the truth of the
+        # given pattern is decided on their output so far. This only applies
+        # to Kappa: ODE mode runs a single deterministic simulation with a
+        # solver compiled for the whole time grid, which is always run to
+        # the end and cached.
+        self.early_stop = early_stop
+        # Figures are rendered in the background, by default in the user
+        # cache folder
+        if fig_dir is None:
+            fig_dir = get_cache_dir('figures')
+        self.renderer = FigureRenderer(fig_dir)
+        # ODE solvers by model structure, in least recently used order
+        self.ode_solvers = OrderedDict()
+        self.max_ode_solvers = 16
+        self.random_state = numpy.random.RandomState(seed)
+        # The seed of the i-th simulation of any model if simulations are
+        # cached, so that simulation results can be reused from the cache
+        self.replicate_state = numpy.random.RandomState(
+            REPLICATE_SEED if seed is None else seed)
+        self.replicate_seeds = []
+        if sim_cache_dir is not None:
+            self.sim_cache = SimulationCache(sim_cache_dir, sim_cache_size)
+            logger.info('Caching simulation results in %s.' % sim_cache_dir)
+        else:
+            self.sim_cache = None
+        # The number of simulations is increased from min_sim up to max_sim
+        # until satisfaction rates are resolved with respect to the decision
+        # thresholds if adaptive sampling is used
+        self.adaptive_sampling = adaptive_sampling
+        self.min_sim = min_sim
+        self.max_sim = max_sim
         if not use_kappa:
             self.ode_mode = True
             logger.info('Using ODE mode in TRA.')
         else:
             self.ode_mode = False
             try:
-                self.kappa = kappa_client.KappaRuntime('TRA_simulations',
-                                                       use_rest=use_kappa_rest)
+                # Standard Kappa runtimes are taken from the pool shared
+                # within the process, one is started here to make sure
+                # Kappa can be used
+                if use_kappa_rest:
+                    self.kappa = kappa_client.KappaRuntime('TRA_simulations',
+                                                           use_rest=True)
+                else:
+                    self.kappa_pool = kappa_client.get_runtime_pool()
+                    with self.kappa_pool.session():
+                        pass
                 logger.info('Using kappa %s.' % kappa_mode_label)
             except Exception as e:
                 logger.error('Could not use kappa %s.' % kappa_mode_label)
                 logger.exception(e)
                 self.ode_mode = True
+            # Independent stochastic simulations can be run in parallel,
+            # each worker process holding its own standard Kappa runtime
+            if not self.ode_mode and not use_kappa_rest and sim_workers > 1:
+                self.sim_pool = ProcessPoolExecutor(max_workers=sim_workers)
+                logger.info('Running simulations on %d workers.' %
+                            sim_workers)
         return
 
     def check_property(self, model, pattern, conditions=None):
-        # TODO: handle multiple entities (observables) in pattern
+        """Return the rate at which simulations satisfy a pattern.
+
+        All the entities of the pattern are observed in the same
+        simulations, and the pattern has to hold jointly for them.
+
+        Returns
+        -------
+        sat_rate : float
+            The fraction of simulations satisfying the pattern (or the
+            suggested pattern if no pattern type was given).
+        num_sim : int
+            The number of simulations performed.
+        suggestion : str or None
+            A suggested pattern that is satisfied by most simulations, if
+            the given pattern is rarely satisfied.
+        fig_path : str
+            The path to the figure showing the simulation results.
+        sat_interval : tuple(float, float)
+            The Wilson score confidence interval of sat_rate.
+        """
         # TODO: set max_time based on some model property if not given
-        # TODO: make number of simulations and number of time points adaptive
 
-        # Make an observable for the simulations
-        logger.info('Trying to make an observable for: %s',
-                    pattern.entities[0])
-        obs = get_create_observable(model, pattern.entities[0])
+        # Make an observable for each entity of the pattern
+        if not pattern.entities:
+            raise InvalidTemporalPatternError('Pattern has no entities.')
+        logger.info('Trying to make observables for: %s', pattern.entities)
+        observables = [get_create_observable(model, entity)
+                       for entity in pattern.entities]
+        obs_names = [obs.name for obs in observables]
+
+        # Set the time limit for the simulations. The time limit of the
+        # pattern is checked with time-bounded operators, so that a pattern
+        # can be checked on simulations shared with other time limits. An
+        # until pattern can't be bounded that way and needs simulations
+        # ending at the time limit.
+        max_time, plot_period, window = \
+            get_sim_grid(pattern.time_limit,
+                         shared=(pattern.pattern_type != 'until'))
 
         # Make pattern
-        fstr = get_ltl_from_pattern(pattern, obs)
+        fstr = get_joint_ltl_from_pattern(pattern, observables, window)
         given_pattern = (fstr is not None)
 
-        # Set the time limit for the simulations
-        if pattern.time_limit is None:
-            max_time = 10000.0
-        elif pattern.time_limit.ub > 0:
-            max_time = pattern.time_limit.get_ub_seconds()
-        # The numer of time points to get output at
-        num_times = 100
-        # The periof at which the output is sampled
-        plot_period = int(1.0*max_time / num_times)
-        if pattern.time_limit and pattern.time_limit.lb > 0:
-            min_time = pattern.time_limit.get_lb_seconds()
-            min_time_idx = int(num_times * (1.0*min_time / max_time))
-        else:
-            min_time_idx = 0
-
-        # The number of independent simulations to perform
-        num_sim = 2
-        # Run simulations
-        results = self.run_simulations(model, conditions, num_sim,
-                                       min_time_idx, max_time,
-                                       plot_period)
+        # We check the given pattern and all the suggestion patterns on all
+        # the simulations at once
+        all_patterns = get_joint_patterns(obs_names, window)
+        formulas = [fs for fs, _ in all_patterns]
+        if given_pattern:
+            formulas = [fstr] + formulas
 
-        results_copy = deepcopy(results)
-        yobs_list = [yobs for _, yobs in results]
+        # The number of independent simulations to perform. ODE simulations
+        # are deterministic so a single one is run and there is nothing to
+        # resolve by adding more.
+        if self.ode_mode:
+            num_sim = 1
+        else:
+            num_sim = self.min_sim
+        adaptive = self.adaptive_sampling and not self.ode_mode
+        # Kappa simulations can be stopped once the given pattern is
+        # decided, the suggestion patterns need complete simulations however
+        if given_pattern and self.early_stop and not self.ode_mode:
+            stop_check = FormulaStopCheck([fstr], obs_names, window)
+        else:
+            stop_check = None
+        results = []
+        seeds = []
+        while True:
+            # Run simulations
+            new_seeds = self.get_replicate_seeds(len(results),
+                                                 num_sim - len(results))
+            results += self.run_simulations(model, conditions,
+                                            len(new_seeds), max_time,
+                                            plot_period, new_seeds,
+                                            stop_check)
+            seeds += new_seeds
+            truths, thresholds = self.check_results(model, results,
+                                                    obs_names, formulas,
+                                                    window)
+            if stop_check is not None and \
+                    numpy.count_nonzero(truths[0]) < 0.3 * num_sim:
+                # A suggestion may be needed so simulations that were
+                # stopped early are run again to the end with their seed
+                logger.info('Completing simulations stopped early.')
+                stop_check = None
+                results = self.complete_simulations(
+                    model, conditions, results, seeds, max_time,
+                    plot_period)
+                truths, thresholds = self.check_results(model, results,
+                                                        obs_names, formulas,
+                                                        window)
+            if not adaptive or num_sim >= self.max_sim or \
+                    sat_rates_resolved(truths, given_pattern):
+                break
+            num_sim = min(2 * num_sim, self.max_sim)
+            logger.info('Satisfaction rates not resolved, increasing the '
+                        'number of simulations to %d.' % num_sim)
 
-        # Discretize observations
-        # WARNING: yobs is changed by discretize_obs in place
-        thresholds = [self.discretize_obs(model, yobs, obs.name)
-                      for yobs in yobs_list]
+        fig_path = self.plot_results(results, pattern.entities, obs_names,
+                                     [thresholds[name][0]
+                                      for name in obs_names])
 
-        fig_path = self.plot_results(results_copy, pattern.entities[0],
-                                     obs.name, thresholds[0])
-        # We check for the given pattern
         if given_pattern:
-            truths = []
-            for yobs in yobs_list:
-                # Run model checker on the given pattern
-                MC = mc.ModelChecker(fstr, yobs)
-                logger.info('Main property %s' % MC.truth)
-                truths.append(MC.truth)
-            sat_rate = numpy.count_nonzero(truths) / (1.0*num_sim)
+            logger.info('Main property %s' % truths[0])
+            num_sat = numpy.count_nonzero(truths[0])
+            sat_rate = num_sat / (1.0*num_sim)
+            sat_interval = get_sat_interval(num_sat, num_sim)
             make_suggestion = (sat_rate < 0.3)
             if make_suggestion:
                 logger.info('MAKING SUGGESTION with sat rate %.2f.' % sat_rate)
+            truths = truths[1:]
         else:
             make_suggestion = True
 
         # If no suggestion is to be made, we return
         if not make_suggestion:
-            return sat_rate, num_sim, None, fig_path
+            return sat_rate, num_sim, None, fig_path, sat_interval
 
-        # Run model checker on all patterns
-        all_patterns = get_all_patterns(obs.name)
-        for fs, pat in all_patterns:
+        # Look for a suggestion among all patterns
+        for (fs, pat), pat_truths in zip(all_patterns, truths):
             logger.info('Testing pattern: %s' % pat)
-            truths = []
-            for yobs in yobs_list:
-                MC = mc.ModelChecker(fs, yobs)
-                logger.info('Property %s' % MC.truth)
-                truths.append(MC.truth)
-            sat_rate_new = numpy.count_nonzero(truths) / (1.0*num_sim)
+            logger.info('Property %s' % pat_truths)
+            num_sat_new = numpy.count_nonzero(pat_truths)
+            sat_rate_new = num_sat_new / (1.0*num_sim)
             if sat_rate_new > 0.5:
                 if not given_pattern:
-                    return sat_rate_new, num_sim, pat, fig_path
+                    sat_interval = get_sat_interval(num_sat_new, num_sim)
+                    return sat_rate_new, num_sim, pat, fig_path, sat_interval
                 else:
-                    return sat_rate, num_sim, pat, fig_path
+                    return sat_rate, num_sim, pat, fig_path, sat_interval
 
     def compare_conditions(self, model, condition_agent, target_agent):
-        obs = get_create_observable(model, target_agent)
-        cond_quant = MolecularQuantityReference('total', condition_agent)
-        all_results = []
-        time_ul = 10000
-        nt = 101
-        plot_period = time_ul / (nt - 1)
-        ts = numpy.linspace(0, time_ul, nt)
-        mults = [0.0, 100.0]
-        for mult in mults:
-            condition = MolecularCondition('multiple', cond_quant, mult)
-            results = self.run_simulations(model, [condition], 1, 0,
-                                           time_ul, plot_period)
-            obs_values = results[0][1][obs.name]
-            all_results.append(obs_values)
+        sweep = self.sweep_conditions(model, [condition_agent],
+                                      target_agent, [[0.0, 100.0]])
+        ts = sweep['ts']
+        all_results = sweep['values']
         # Plotting
         fig_path = self.plot_compare_conditions(ts, all_results, target_agent,
-                                                obs.name)
-        diff = numpy.sum(all_results[-1][:len(ts)] - all_results[0][:len(ts)])
+                                                sweep['obs_name'])
+        diff = numpy.sum(all_results[-1] - all_results[0])
         logger.info('TRA condition difference: %.2f' % diff)
         # If there is a decrease in the observable, we return True
         if abs(diff) < 0.01:
@@ -155,228 +265,633 @@ class TRA(object):
             res = 'decrease' if (diff < 0) else 'increase'
         return res, fig_path
 
-    def plot_compare_conditions(self, ts, results, agent, obs_name):
-        plt.figure()
-        plt.ion()
-        plt.plot(ts, results[0][:len(ts)], label='Without condition')
-        plt.plot(ts, results[-1][:len(ts)], label='With condition')
-        plt.xlabel('Time (s)')
-        plt.ylabel('Amount (molecules)')
-        agent_str = english_assembler._assemble_agent_str(agent)
-        plt.title('Simulation results for %s' % agent_str)
-        plt.legend()
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        fig_path = os.path.join(dir_path, '%s.png' % obs_name)
-        plt.savefig(fig_path)
-        return fig_path
-
-    def plot_results(self, results, agent, obs_name, thresh=50):
-        plt.figure()
-        plt.ion()
-        max_val_lim = max(max(numpy.max(results[0][1][obs_name]), 101.0),
-                          thresh)
-        max_time = max([result[0][-1] for result in results])
-        lr = matplotlib.patches.Rectangle((0, 0), max_time, thresh, color='red',
-                                          alpha=0.1)
-        hr = matplotlib.patches.Rectangle((0, thresh), max_time,
-                                          max_val_lim-thresh,
-                                          color='green', alpha=0.1)
-        ax = plt.gca()
-        ax.add_patch(lr)
-        ax.add_patch(hr)
-        if thresh + 5 < max_val_lim:
-            plt.text(10, thresh + 5, 'High', fontsize=10)
-        plt.text(10, thresh - 5, 'Low')
-        for tspan, yobs in results:
-            plt.plot(tspan, yobs[obs_name])
-        plt.ylim(-1, max_val_lim)
-        plt.xlim(-100, 10100)
-        plt.xlabel('Time (s)')
-        plt.ylabel('Amount (molecules)')
-        agent_str = english_assembler._assemble_agent_str(agent)
-        plt.title('Simulation results for %s' % agent_str)
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        fig_path = os.path.join(dir_path, '%s.png' % obs_name)
-        plt.savefig(fig_path)
-        return fig_path
-
-    def run_simulations(self, model, conditions, num_sim, min_time_idx,
-                        max_time, plot_period):
-        self.sol = None
-        results = []
-        for i in range(num_sim):
-            # Apply molecular condition to model
+    def sweep_conditions(self, model, condition_agents, target_agent, mults,
+                         max_time=10000.0, num_times=101):
+        """Simulate the amount of a target agent over a grid of multipliers
+        of the total amounts of condition agents.
+
+        All the conditions are simulated as one batch: in ODE mode, the
+        parameter values of all the conditions are integrated by a single
+        call of the same solver, and Kappa simulations are run in parallel
+        if a simulation pool is available, one after the other otherwise.
+
+        Parameters
+        ----------
+        model : pysb.Model
+            The model to simulate.
+        condition_agents : list[indra.statements.Agent]
+            The agents whose amounts are multiplied.
+        target_agent : indra.statements.Agent
+            The agent whose amount is observed.
+        mults : list[list[float]]
+            For each condition agent, the list of multipliers to apply to
+            its amount. The conditions are the Cartesian product of these.
+        max_time : Optional[float]
+            The time until which simulations are run. Default: 10000
+        num_times : Optional[int]
+            The number of time points at which the target is observed.
+            Default: 101
+
+        Returns
+        -------
+        sweep : dict
+            A dict with the list of multiplier tuples for each condition
+            ('mults'), the time points ('ts'), the (conditions x time) array
+            of target amounts ('values'), the area under the curve ('auc')
+            and final value ('final') of each condition and the name of the
+            target observable ('obs_name').
+        """
+        obs = get_create_observable(model, target_agent)
+        cond_quants = [MolecularQuantityReference('total', agent)
+                       for agent in condition_agents]
+        plot_period = max_time / (num_times - 1)
+        ts = numpy.linspace(0, max_time, num_times)
+        grid = list(itertools.product(*mults))
+        # All conditions are simulated with the same seed
+        seed = self.get_replicate_seeds(0, 1)[0]
+        sims = []
+        for grid_mults in grid:
+            conditions = [MolecularCondition('multiple', cond_quant, mult)
+                          for cond_quant, mult in zip(cond_quants, grid_mults)]
             try:
-                model_sim = self.condition_model(model, conditions)
+                model_sim, param_values = \
+                    self.condition_model(model, conditions)
             except MissingMonomerError:
-                raise MissingMonomerError
+                raise
             except Exception as e:
                 logger.exception(e)
                 msg = 'Applying molecular condition failed.'
                 raise InvalidMolecularConditionError(msg)
-            # Run a simulation
-            logger.info('Starting simulation %d' % (i+1))
-            if not self.ode_mode:
-                try:
-                    tspan, yobs = self.simulate_kappa(model_sim, max_time,
-                                                      plot_period)
-                except Exception as e:
-                    logger.exception(e)
-                    raise SimulatorError('Kappa simulation failed.')
-            else:
-                tspan, yobs = self.simulate_odes(model_sim, max_time,
-                                                 plot_period)
-            # Get and plot observable
-            start_idx = min(min_time_idx, len(yobs))
-            yobs_from_min = yobs[start_idx:]
-            tspan = tspan[start_idx:]
-            results.append((tspan, yobs_from_min))
+            sims.append((model_sim, param_values, seed))
+        results = self.simulate_batch(sims, max_time, plot_period)
+        values = stack_observable([yobs for _, yobs in results], obs.name,
+                                  num_times)
+        auc = numpy.sum(0.5 * (values[:, 1:] + values[:, :-1]) *
+                        numpy.diff(ts), axis=1)
+        sweep = {'mults': grid, 'ts': ts, 'values': values,
+                 'auc': auc, 'final': values[:, -1], 'obs_name': obs.name}
+        return sweep
+
+    def plot_sweep_conditions(self, sweep, condition_agents, target_agent):
+        cond_strs = [english_assembler._assemble_agent_str(agent)
+                     for agent in condition_agents]
+        labels = [', '.join(['%s x%g' % (cond_str, mult) for cond_str, mult
+                             in zip(cond_strs, grid_mults)])
+                  for grid_mults in sweep['mults']]
+        agent_str = english_assembler._assemble_agent_str(target_agent)
+        return self.renderer.prepare('%s_sweep' % sweep['obs_name'],
+                                     _draw_sweep_conditions, sweep['ts'],
+                                     sweep['values'], labels, agent_str)
+
+    def plot_compare_conditions(self, ts, results, agent, obs_name):
+        agent_str = english_assembler._assemble_agent_str(agent)
+        return self.renderer.prepare(obs_name, _draw_compare_conditions, ts,
+                                     results[0], results[-1], agent_str)
+
+    def plot_results(self, results, agents, obs_names, threshs):
+        """Render the simulation results of each observable in its own
+        panel."""
+        agent_strs = [english_assembler._assemble_agent_str(agent)
+                      for agent in agents]
+        obs_results = [[(numpy.asarray(tspan), numpy.asarray(yobs[obs_name]))
+                        for tspan, yobs in results]
+                       for obs_name in obs_names]
+        return self.renderer.prepare('_'.join(obs_names), _draw_results,
+                                     obs_results, agent_strs,
+                                     [float(thresh) for thresh in threshs])
+
+    def check_results(self, model, results, obs_names, formulas,
+                      window=None):
+        """Return the truth of each formula on each simulation result and
+        the discretization thresholds of each simulation by observable.
+
+        If a window of output time points is given, the thresholds are
+        computed from the values of the observables within the window.
+        """
+        yobs_list = [yobs for _, yobs in results]
+        states = {}
+        thresholds = {}
+        for obs_name in obs_names:
+            obs_values = stack_observable(yobs_list, obs_name)
+            states[obs_name], thresholds[obs_name] = \
+                self.discretize_obs(model, obs_values, window)
+        truths = mc.check_formulas(formulas, states)
+        return truths, thresholds
+
+    def complete_simulations(self, model, conditions, results, seeds,
+                             max_time, plot_period):
+        """Return the results with simulations that were stopped before
+        max_time replaced by complete runs with the same seed."""
+        stopped = [i for i, (tspan, _) in enumerate(results)
+                   if not is_sim_complete(tspan, max_time, plot_period)]
+        if not stopped:
+            return results
+        rerun = self.run_simulations(model, conditions, len(stopped),
+                                     max_time, plot_period,
+                                     [seeds[i] for i in stopped])
+        results = list(results)
+        for i, result in zip(stopped, rerun):
+            results[i] = result
         return results
 
-    def discretize_obs(self, model, yobs, obs_name):
+    def run_simulations(self, model, conditions, num_sim, max_time,
+                        plot_period, seeds=None, stop_check=None):
+        # Apply molecular condition to model
+        try:
+            model_sim, param_values = self.condition_model(model,
+                                                           conditions)
+        except MissingMonomerError:
+            raise MissingMonomerError
+        except Exception as e:
+            logger.exception(e)
+            msg = 'Applying molecular condition failed.'
+            raise InvalidMolecularConditionError(msg)
+        if seeds is None:
+            seeds = self.get_seeds(num_sim)
+        # Run the simulations
+        return self.simulate_batch([(model_sim, param_values, seed)
+                                    for seed in seeds],
+                                   max_time, plot_period, stop_check)
+
+    def get_seeds(self, num_sim):
+        """Return a random seed for each of a number of simulations.
+
+        If the TRA was given a seed, the sequence of simulation seeds is
+        deterministic.
+        """
+        seeds = self.random_state.randint(1, 2**31 - 1, num_sim)
+        return [int(s) for s in seeds]
+
+    def get_replicate_seeds(self, start, num_sim):
+        """Return the seeds of simulations start to start + num_sim of a
+        model.
+
+        If simulations are cached, these are the same for every model
+        simulated by any TRA with the same seed, so that repeated questions
+        about a model can reuse cached simulations, including those of
+        earlier runs of the agent. Otherwise, new seeds are drawn so that
+        repeated questions get independent simulations.
+        """
+        if self.sim_cache is None:
+            return self.get_seeds(num_sim)
+        end = start + num_sim
+        if end > len(self.replicate_seeds):
+            seeds = self.replicate_state.randint(
+                1, 2**31 - 1, end - len(self.replicate_seeds))
+            self.replicate_seeds += [int(s) for s in seeds]
+        return self.replicate_seeds[start:end]
+
+    def discretize_obs(self, model, obs_values, window=None):
+        """Return the discretized values of an observable in a set of
+        simulations, and the threshold used for each simulation.
+
+        Parameters
+        ----------
+        model : pysb.Model
+            The simulated model.
+        obs_values : numpy.ndarray
+            The (num_sim x T) values of the observable.
+        window : Optional[tuple(int, int)]
+            The first and last time points of the values the thresholds
+            are computed from. By default, all the values are used.
+
+        Returns
+        -------
+        obs_disc : numpy.ndarray
+            A (num_sim x T) uint8 array which is 1 where the observable is
+            above the threshold of its simulation and 0 elsewhere.
+        thresholds : numpy.ndarray
+            The threshold used for each simulation.
+        """
         # TODO: This needs to be done in a model/observable-dependent way
-        default_total_val = 100
-        start_val = yobs[obs_name][0]
-        max_val = numpy.max(yobs[obs_name])
-        min_val = numpy.min(yobs[obs_name])
-        # If starts low, discretize wrt total value
-        if start_val < 1e-5:
-            thresh = 0.3 * default_total_val
-        # If starts high, discretize wrt range with a certain minimum
-        else:
-            thresh = start_val + max(0.5*(max_val - min_val),
-                                     default_total_val * 0.10)
-        for i, v in enumerate(yobs[obs_name]):
-            yobs[obs_name][i] = 1 if v > thresh else 0
-        return thresh
+        return discretize_values(obs_values, window=window)
 
     def condition_model(self, model, conditions):
+        """Return the model to simulate under the given conditions along with
+        the parameter values overriding those of the model.
+
+        The model is only copied if a condition can't be expressed as a
+        parameter override, i.e. if it sets the amount of a monomer that has
+        no initial condition in the model.
+        """
         # Set up simulation conditions
-        if conditions:
+        if not conditions:
+            return model, {}
+        try:
+            return model, get_condition_params(model, conditions)
+        except KeyError:
             model_sim = deepcopy(model)
             for condition in conditions:
                 apply_condition(model_sim, condition)
-        else:
-            model_sim = model
-        return model_sim
+            return model_sim, {}
 
-    def simulate_kappa(self, model_sim, max_time, plot_period):
+    def simulate_kappa(self, model_sim, max_time, plot_period, seed=None,
+                       param_values=None, stop_check=None):
         # Export kappa model
-        kappa_model = pysb_to_kappa(model_sim)
-        # Start simulation
-        self.kappa.compile(code_list=[kappa_model])
-        self.kappa.start_sim(plot_period=plot_period,
-                         pause_condition="[T] > %d" % max_time)
-        while True:
-            sleep(0.2)
-            status_json = self.kappa.sim_status()
-            is_running = status_json.get('simulation_progress_is_running')
-            if not is_running:
-                break
-            else:
-                if status_json.get('time_percentage') is not None:
-                    logger.info(
-                        'Sim time percentage: %d' %
-                        status_json.get('simulation_progress_time_percentage')
-                        )
-        tspan, yobs = get_sim_result(self.kappa.sim_plot())
-        self.kappa.reset_project()
-        return tspan, yobs
+        kappa_model = pysb_to_kappa(model_sim, param_values)
+        if self.kappa_pool is None:
+            return run_kappa_simulation(self.kappa, kappa_model, max_time,
+                                        plot_period, seed, self.sim_timeout,
+                                        stop_check)
+        with self.kappa_pool.session(kappa_model) as kappa:
+            return run_kappa_simulation(kappa, kappa_model, max_time,
+                                        plot_period, seed, self.sim_timeout,
+                                        stop_check)
+
+    def simulate_batch(self, sims, max_time, plot_period, stop_check=None):
+        """Run a batch of simulations and return their results in order.
+
+        If the TRA has a simulation cache, results are taken from it where
+        available and the results of complete simulations are added to it.
+
+        Parameters
+        ----------
+        sims : list[tuple]
+            A list of (model_sim, param_values, seed) tuples, one for each
+            simulation to run.
+        max_time : float
+            The time until which the simulations are run.
+        plot_period : float
+            The period at which simulation output is sampled.
+        stop_check : Optional[function]
+            A picklable function taking the observables of a running Kappa
+            simulation and returning True if the simulation can be stopped,
+            see FormulaStopCheck. ODE simulations are always run to the end.
+
+        Returns
+        -------
+        results : list[tuple]
+            A (tspan, yobs) tuple for each simulation.
+        """
+        if self.sim_cache is None:
+            return self._run_batch(sims, max_time, plot_period, stop_check)
+        mode = 'ode' if self.ode_mode else 'kappa'
+        model_hashes = {}
+        keys = []
+        results = []
+        for model_sim, param_values, seed in sims:
+            if id(model_sim) not in model_hashes:
+                model_hashes[id(model_sim)] = \
+                    get_model_structure_hash(model_sim)
+            model_hash = get_model_hash(model_sim, param_values,
+                                        model_hashes[id(model_sim)])
+            # ODE simulations don't depend on the seed
+            key = get_sim_key(model_hash, max_time, plot_period,
+                              None if self.ode_mode else seed, mode)
+            keys.append(key)
+            results.append(self.sim_cache.get(key))
+        missing = [i for i, result in enumerate(results) if result is None]
+        logger.info('Found %d of %d simulations in cache.' %
+                    (len(sims) - len(missing), len(sims)))
+        new_results = self._run_batch([sims[i] for i in missing], max_time,
+                                      plot_period, stop_check)
+        for i, (tspan, yobs) in zip(missing, new_results):
+            results[i] = (tspan, yobs)
+            # Simulations that were stopped early are not cached
+            if is_sim_complete(tspan, max_time, plot_period):
+                self.sim_cache.put(keys[i], tspan, yobs)
+        return results
 
-    def simulate_odes(self, model_sim, max_time, plot_period):
+    def _run_batch(self, sims, max_time, plot_period, stop_check=None):
+        if self.ode_mode:
+            # Simulations of the same model, only differing by their
+            # parameter values, are run by a single solver call
+            groups = OrderedDict()
+            for i, (model_sim, _, _) in enumerate(sims):
+                groups.setdefault(id(model_sim), (model_sim, []))[1].append(i)
+            results = [None] * len(sims)
+            for model_sim, idxs in groups.values():
+                logger.info('Starting %d ODE simulations' % len(idxs))
+                group_results = \
+                    self.simulate_odes_batch(model_sim, max_time,
+                                             plot_period,
+                                             [sims[i][1] for i in idxs])
+                for i, result in zip(idxs, group_results):
+                    results[i] = result
+            return results
+        try:
+            if self.sim_pool is None:
+                results = []
+                for i, (model_sim, param_values, seed) in enumerate(sims):
+                    logger.info('Starting simulation %d' % (i+1))
+                    results.append(self.simulate_kappa(model_sim, max_time,
+                                                       plot_period, seed,
+                                                       param_values,
+                                                       stop_check))
+                return results
+            # Each distinct model is only exported once, parameter
+            # overrides are then set in the exported Kappa model
+            kappa_exports = {}
+            futures = []
+            for model_sim, param_values, seed in sims:
+                if id(model_sim) not in kappa_exports:
+                    kappa_exports[id(model_sim)] = pysb_to_kappa(model_sim)
+                kappa_model = set_kappa_params(kappa_exports[id(model_sim)],
+                                               param_values)
+                futures.append(self.sim_pool.submit(
+                    _run_kappa_simulation_worker, kappa_model, max_time,
+                    plot_period, seed, self.sim_timeout, stop_check))
+            logger.info('Started %d simulations in parallel' % len(sims))
+            return [future.result() for future in futures]
+        except Exception as e:
+            logger.exception(e)
+            raise SimulatorError('Kappa simulation failed.')
+
+    def simulate_odes(self, model_sim, max_time, plot_period,
+                      param_values=None):
+        return self.simulate_odes_batch(model_sim, max_time, plot_period,
+                                        [param_values])[0]
+
+    def simulate_odes_batch(self, model_sim, max_time, plot_period,
+                            param_values_list):
+        """Return the ODE simulations of a model for each of a list of
+        parameter overrides, run by a single solver call."""
         ts = numpy.linspace(0, max_time, int(1.0*max_time/plot_period) + 1)
-        if self.sol is None:
-            self.sol = Solver(model_sim, ts)
-        self.sol.run()
-        return ts, self.sol.yobs
-
-
-def get_ltl_from_pattern(pattern, obs):
+        sol = self.get_ode_solver(model_sim, ts)
+        # The solver may have been generated for another model with the
+        # same structure so parameter values are always passed explicitly
+        param_array = numpy.array(
+            [[(param_values or {}).get(p.name, p.value)
+              for p in model_sim.parameters]
+             for param_values in param_values_list])
+        sol.run(param_values=param_array)
+        # The observables of a single simulation aren't in a list
+        yobs = sol.yobs
+        if len(param_values_list) == 1:
+            yobs = [yobs]
+        # The solver reuses its output arrays between runs
+        return [(ts, sim_yobs.copy()) for sim_yobs in yobs]
+
+    def get_ode_solver(self, model_sim, ts):
+        """Return an ODE solver for the model, reusing a cached one if a
+        model with the same structure was simulated before."""
+        key = (get_model_structure_hash(model_sim), ts[-1], len(ts))
+        sol = self.ode_solvers.get(key)
+        if sol is None:
+            logger.info('Generating ODE solver for model.')
+            sol = Solver(model_sim, ts)
+            self.ode_solvers[key] = sol
+            if len(self.ode_solvers) > self.max_ode_solvers:
+                self.ode_solvers.popitem(last=False)
+        else:
+            self.ode_solvers.move_to_end(key)
+        return sol
+
+
+def _draw_sweep_conditions(fig, ts, values, labels, agent_str):
+    ax = fig.gca()
+    for label, cond_values in zip(labels, values):
+        ax.plot(ts, cond_values, label=label)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Amount (molecules)')
+    ax.set_title('Simulation results for %s' % agent_str)
+    ax.legend()
+
+
+def _draw_compare_conditions(fig, ts, values_without, values_with,
+                             agent_str):
+    ax = fig.gca()
+    ax.plot(ts, values_without, label='Without condition')
+    ax.plot(ts, values_with, label='With condition')
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Amount (molecules)')
+    ax.set_title('Simulation results for %s' % agent_str)
+    ax.legend()
+
+
+def _draw_results(fig, obs_results, agent_strs, threshs):
+    for i, (results, agent_str, thresh) in \
+            enumerate(zip(obs_results, agent_strs, threshs)):
+        ax = fig.add_subplot(len(obs_results), 1, i + 1)
+        _draw_obs_results(ax, results, agent_str, thresh)
+    fig.tight_layout()
+
+
+def _draw_obs_results(ax, results, agent_str, thresh):
+    max_val_lim = max(max(numpy.max(results[0][1]), 101.0), thresh)
+    max_time = max([tspan[-1] for tspan, _ in results])
+    lr = Rectangle((0, 0), max_time, thresh, color='red', alpha=0.1)
+    hr = Rectangle((0, thresh), max_time, max_val_lim-thresh,
+                   color='green', alpha=0.1)
+    ax.add_patch(lr)
+    ax.add_patch(hr)
+    if thresh + 5 < max_val_lim:
+        ax.text(10, thresh + 5, 'High', fontsize=10)
+    ax.text(10, thresh - 5, 'Low')
+    for tspan, obs_values in results:
+        ax.plot(tspan, obs_values)
+    ax.set_ylim(-1, max_val_lim)
+    ax.set_xlim(-100, 10100)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Amount (molecules)')
+    ax.set_title('Simulation results for %s' % agent_str)
+
+
+def run_kappa_simulation(kappa, kappa_model, max_time, plot_period,
+                         seed=None, timeout=None, stop_check=None):
+    """Run a Kappa simulation on a KappaRuntime and return its results.
+
+    If a stop_check function is given, it is called with the observables
+    output so far every time the running simulation is polled, and the
+    simulation is stopped as soon as it returns True.
+    """
+    # Start simulation, the model is only parsed if the runtime didn't
+    # parse it last
+    kappa.load_model(kappa_model)
+    kappa.start_sim(plot_period=plot_period,
+                    pause_condition="[T] > %d" % max_time,
+                    seed=seed)
+    decoder = SimResultDecoder()
+
+    def poll(status_json):
+        _log_sim_progress(status_json)
+        if stop_check is None:
+            return False
+        decoder.update(kappa.sim_plot())
+        if decoder.legend is None:
+            return False
+        _, yobs = decoder.get_result()
+        if stop_check(yobs):
+            logger.info('Stopping simulation at time %g' %
+                        decoder.get_values()[-1, 0])
+            return True
+        return False
+    try:
+        kappa.run_to_completion(timeout=timeout, callback=poll)
+        decoder.update(kappa.sim_plot())
+    except Exception:
+        kappa.reset_project()
+        raise
+    tspan, yobs = decoder.get_result()
+    kappa.delete_sim()
+    return tspan, yobs
+
+
+def _log_sim_progress(status_json):
+    time_percentage = \
+        status_json.get('simulation_progress_time_percentage')
+    if time_percentage is not None:
+        logger.info('Sim time percentage: %d' % time_percentage)
+
+
+def _run_kappa_simulation_worker(kappa_model, max_time, plot_period, seed,
+                                 timeout, stop_check=None):
+    # Each worker process has its own runtime pool
+    with kappa_client.get_runtime_pool(1).session(kappa_model) as kappa:
+        return run_kappa_simulation(kappa, kappa_model, max_time,
+                                    plot_period, seed, timeout, stop_check)
+
+
+class FormulaStopCheck(object):
+    """Decide if a running simulation can be stopped because the truth of
+    all of a set of formulas is decided on its output so far.
+
+    Instances are picklable so that they can be sent to simulation pool
+    workers.
+
+    Parameters
+    ----------
+    formulas : list[str]
+        The LTL formulas to be checked on the simulation.
+    obs_names : list[str]
+        The names of the observables the formulas refer to.
+    window : Optional[tuple(int, int)]
+        The window of output time points the formulas refer to, from which
+        observables are discretized. By default, the whole simulation.
+    """
+    def __init__(self, formulas, obs_names, window=None):
+        self.formulas = formulas
+        self.obs_names = obs_names
+        self.window = window
+
+    def __call__(self, yobs):
+        if self.window is not None and len(yobs) <= self.window[0]:
+            return False
+        lower = {}
+        upper = {}
+        for obs_name in self.obs_names:
+            obs_values = numpy.asarray(yobs[obs_name], dtype=float)[None, :]
+            lower[obs_name], upper[obs_name] = \
+                discretize_partial(obs_values, window=self.window)
+        truths = mc.check_formulas_partial(self.formulas, lower,
+                                           states_upper=upper)
+        return bool(numpy.all(truths >= 0))
+
+
+def get_ltl_from_pattern(pattern, obs, window=None):
     if not pattern.pattern_type:
         return None
     if pattern.pattern_type == 'transient':
-        fstr = mc.transient_formula(obs.name)
+        fstr = mc.transient_formula(obs.name, window)
     elif pattern.pattern_type == 'sustained':
-        fstr = mc.sustained_formula(obs.name)
+        fstr = mc.sustained_formula(obs.name, window)
     elif pattern.pattern_type == 'no_change':
-        fstr = mc.noact_formula(obs.name)
+        fstr = mc.noact_formula(obs.name, window)
     elif pattern.pattern_type == 'always_value':
-        if not pattern.value.quant_type == 'qualitative':
-            msg = 'Cannot handle always value of "%s" type.' % \
-                pattern.value.quant_type
-            raise InvalidTemporalPatternError(msg)
-        if pattern.value.value == 'low':
-            val = 0
-        elif pattern.value.value == 'high':
-            val = 1
-        else:
-            msg = 'Cannot handle always value of "%s".' % \
-                pattern.value.value
-            raise InvalidTemporalPatternError(msg)
-        fstr = mc.always_formula(obs.name, val)
+        val = get_qualitative_value(pattern.value, 'always')
+        fstr = mc.always_formula(obs.name, val, window)
     elif pattern.pattern_type == 'eventual_value':
-        if not pattern.value.quant_type == 'qualitative':
-            msg = 'Cannot handle eventual value of "%s" type.' % \
-                pattern.value.quant_type
-            raise InvalidTemporalPatternError(msg)
-        if pattern.value.value == 'low':
-            val = 0
-        elif pattern.value.value == 'high':
-            val = 1
-        else:
-            msg = 'Cannot handle eventual value of "%s".' % \
-                pattern.value.value
-            raise InvalidTemporalPatternError(msg)
-        fstr = mc.eventual_formula(obs.name, val)
+        val = get_qualitative_value(pattern.value, 'eventual')
+        fstr = mc.eventual_formula(obs.name, val, window)
     elif pattern.pattern_type == 'sometime_value':
-        if not pattern.value.quant_type == 'qualitative':
-            msg = 'Cannot handle sometime value of "%s" type.' % \
-                pattern.value.quant_type
-            raise InvalidTemporalPatternError(msg)
-        if pattern.value.value == 'low':
-            val = 0
-        elif pattern.value.value == 'high':
-            val = 1
-        else:
-            msg = 'Cannot handle sometime value of "%s".' % \
-                pattern.value.value
-            raise InvalidTemporalPatternError(msg)
-        fstr = mc.sometime_formula(obs.name, val)
+        val = get_qualitative_value(pattern.value, 'sometime')
+        fstr = mc.sometime_formula(obs.name, val, window)
     else:
         msg = 'Unknown pattern %s' % pattern.pattern_type
         raise InvalidTemporalPatternError(msg)
     return fstr
 
 
+def get_joint_ltl_from_pattern(pattern, observables, window=None):
+    """Return the LTL formula of a pattern about one or more observables.
+
+    An until pattern relates the values of its first and second entities,
+    any other pattern has to hold for each of the observables. If a window
+    of time points is given, the pattern is checked within it, see
+    get_sim_grid.
+    """
+    if not pattern.pattern_type:
+        return None
+    if pattern.pattern_type == 'until':
+        if len(observables) != 2:
+            msg = 'Until pattern needs two entities, got %d.' % \
+                len(observables)
+            raise InvalidTemporalPatternError(msg)
+        val1 = get_qualitative_value(pattern.value, 'until')
+        val2 = get_qualitative_value(pattern.until_value, 'until')
+        return mc.until_formula(observables[0].name, val1,
+                                observables[1].name, val2, window)
+    return mc.and_formula([get_ltl_from_pattern(pattern, obs, window)
+                           for obs in observables])
+
+
+def get_qualitative_value(value, pattern_name):
+    """Return the discretized (0 or 1) value of a qualitative quantity."""
+    if not value.quant_type == 'qualitative':
+        msg = 'Cannot handle %s value of "%s" type.' % \
+            (pattern_name, value.quant_type)
+        raise InvalidTemporalPatternError(msg)
+    if value.value == 'low':
+        return 0
+    elif value.value == 'high':
+        return 1
+    msg = 'Cannot handle %s value of "%s".' % (pattern_name, value.value)
+    raise InvalidTemporalPatternError(msg)
+
+
 def apply_condition(model, condition):
-    agent = condition.quantity.entity
     try:
-        monomer = model.monomers[pa._n(agent.name)]
+        param_values = get_condition_params(model, [condition])
     except KeyError:
-        raise MissingMonomerError('%s is not in the model ' % agent.name)
-    site_pattern = pa.get_site_pattern(agent)
-    # TODO: handle modified patterns
-    if site_pattern:
-        logger.warning('Cannot handle initial conditions on' +
-                       ' modified monomers.')
-    if condition.condition_type == 'exact':
-        ic_name = monomer.name + '_0'
-        if condition.value.quant_type == 'number':
+        # Setting an exact amount can add a missing initial condition
+        if condition.condition_type == 'exact' and \
+                condition.value.quant_type == 'number':
+            agent = condition.quantity.entity
+            monomer = model.monomers[pa._n(agent.name)]
             pa.set_base_initial_condition(model, monomer,
                                           condition.value.value)
-        else:
-            logger.warning('Cannot handle non-number initial conditions')
-    elif condition.condition_type == 'multiple':
+            return
+        raise
+    for ic_name, value in param_values.items():
+        model.parameters[ic_name].value = value
+
+
+def get_condition_params(model, conditions):
+    """Return the initial condition parameter values imposed by a list of
+    molecular conditions, without changing the model.
+
+    A KeyError is raised if a condition refers to a monomer that doesn't
+    have an initial condition parameter in the model.
+    """
+    param_values = {}
+    for condition in conditions:
+        agent = condition.quantity.entity
+        try:
+            monomer = model.monomers[pa._n(agent.name)]
+        except KeyError:
+            raise MissingMonomerError('%s is not in the model ' % agent.name)
+        site_pattern = pa.get_site_pattern(agent)
+        # TODO: handle modified patterns
+        if site_pattern:
+            logger.warning('Cannot handle initial conditions on' +
+                           ' modified monomers.')
         # TODO: refer to annotations for the IC name
         ic_name = monomer.name + '_0'
-        model.parameters[ic_name].value *= condition.value
-    elif condition.condition_type == 'decrease':
-        ic_name = monomer.name + '_0'
-        model.parameters[ic_name].value *= 0.9
-    elif condition.condition_type == 'increase':
-        ic_name = monomer.name + '_0'
-        model.parameters[ic_name].value *= 1.1
-    logger.info('New initial condition: %s' % model.parameters[ic_name])
+        value = param_values.get(ic_name, model.parameters[ic_name].value)
+        if condition.condition_type == 'exact':
+            if condition.value.quant_type == 'number':
+                value = condition.value.value
+            else:
+                logger.warning('Cannot handle non-number initial conditions')
+        elif condition.condition_type == 'multiple':
+            value *= condition.value
+        elif condition.condition_type == 'decrease':
+            value *= 0.9
+        elif condition.condition_type == 'increase':
+            value *= 1.1
+        param_values[ic_name] = value
+        logger.info('New initial condition: %s = %s' % (ic_name, value))
+    return param_values
 
 
 def get_create_observable(model, agent):
@@ -397,66 +912,390 @@ def get_create_observable(model, agent):
     return obs
 
 
-def pysb_to_kappa(model):
+def get_model_structure_hash(model):
+    """Return a hash of the structure of a PySB model.
+
+    The hash depends on the monomers, rules, observables, expressions,
+    initial condition patterns and the names and order of parameters but
+    not on parameter values, so that models differing only in parameter
+    values or initial amounts have the same hash.
+    """
+    parts = [repr(m) for m in model.monomers]
+    for rule in model.rules:
+        rates = [rate.name for rate in (rule.rate_forward, rule.rate_reverse)
+                 if rate is not None]
+        parts.append('%s: %s %s' % (rule.name, rule.rule_expression, rates))
+    parts += ['%s: %s' % (obs.name, obs.reaction_pattern)
+              for obs in model.observables]
+    parts += ['%s: %s' % (expr.name, expr.expr) for expr in model.expressions]
+    parts += ['%s: %s' % (initial.pattern, initial.value.name)
+              for initial in model.initials]
+    parts += [param.name for param in model.parameters]
+    model_str = '\n'.join(parts)
+    return hashlib.md5(model_str.encode('utf-8')).hexdigest()
+
+
+def get_model_hash(model, param_values=None, structure_hash=None):
+    """Return a hash of a PySB model including its parameter values.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The model to hash.
+    param_values : Optional[dict]
+        Values overriding those of the model's parameters, by name.
+    structure_hash : Optional[str]
+        The structure hash of the model, if already known.
+    """
+    if structure_hash is None:
+        structure_hash = get_model_structure_hash(model)
+    if param_values is None:
+        param_values = {}
+    parts = [structure_hash]
+    parts += ['%s: %r' % (param.name,
+                          float(param_values.get(param.name, param.value)))
+              for param in model.parameters]
+    model_str = '\n'.join(parts)
+    return hashlib.md5(model_str.encode('utf-8')).hexdigest()
+
+
+def get_sim_grid(time_limit, shared=True, default_max_time=10000.0,
+                 num_times=100):
+    """Return the time horizon and output period of simulations for a time
+    limit, and the window of output time points the time limit refers to.
+
+    If shared is True, time limits are checked within simulations of the
+    default length, so that simulations (and their cached results) can be
+    shared by questions about different time limits. This is only done if
+    the default output period is at most twice that of simulations ending
+    at the upper bound of the time limit, otherwise, or if shared is
+    False, the time limit gets simulations ending at its upper bound with
+    num_times output time points.
+
+    Returns
+    -------
+    max_time : float
+        The time until which to simulate.
+    plot_period : float
+        The period at which simulation output is sampled.
+    window : tuple(int, int) or None
+        The first and last output time points of the time limit, None if
+        there is no time limit.
+
+    Raises
+    ------
+    InvalidTimeIntervalError
+        If the lower bound of the time limit is not before its upper
+        bound.
+    """
+    if time_limit is None:
+        return default_max_time, default_max_time / num_times, None
+    if time_limit.lb is not None and time_limit.lb > 0:
+        min_time = float(time_limit.get_lb_seconds())
+    else:
+        min_time = 0.0
+    if time_limit.ub is not None and time_limit.ub > 0:
+        max_time = float(time_limit.get_ub_seconds())
+        if min_time >= max_time:
+            msg = 'Time limit starts at %g s, not before its end at %g s' % \
+                (min_time, max_time)
+            raise InvalidTimeIntervalError(msg)
+    elif min_time >= default_max_time:
+        # Time limits without an upper bound past the default horizon are
+        # checked over a default horizon after their lower bound
+        max_time = min_time + default_max_time
+    else:
+        max_time = default_max_time
+    plot_period = default_max_time / num_times
+    own_plot_period = max(int(max_time / num_times), 1)
+    if shared and max_time <= default_max_time and \
+            plot_period <= 2 * own_plot_period:
+        window = (int(min_time / plot_period), int(max_time / plot_period))
+        return default_max_time, plot_period, window
+    plot_period = own_plot_period
+    window = (int(min_time / plot_period), int(max_time / plot_period))
+    return max_time, plot_period, window
+
+
+def is_sim_complete(tspan, max_time, plot_period):
+    """Return True if a simulation output reaches max_time."""
+    return len(tspan) > 0 and tspan[-1] >= max_time - plot_period
+
+
+def pysb_to_kappa(model, param_values=None):
     ke = KappaExporter(model)
     kappa_model = ke.export()
+    if param_values:
+        kappa_model = set_kappa_params(kappa_model, param_values)
     return kappa_model
 
 
+def set_kappa_params(kappa_model, param_values):
+    """Return a Kappa model with the values of the given parameters
+    overridden in their variable declarations."""
+    if not param_values:
+        return kappa_model
+
+    def set_value(match):
+        name = match.group(1)
+        if name not in param_values:
+            return match.group(0)
+        return "%%var: '%s' %r" % (name, float(param_values[name]))
+    return re.sub(r"^%var: '([^']+)' .*$", set_value, kappa_model,
+                  flags=re.MULTILINE)
+
+
 def get_sim_result(kappa_plot):
-    values = kappa_plot['series']
-    i_t = kappa_plot['legend'].index('[T]')
-    values.sort(key=lambda x: x[i_t])
-    nt = len(values)
-    obs_dict = {
-        j: key.encode('utf8') for j, key in enumerate(kappa_plot['legend'])
-        if key != '[T]'
-        }
-    yobs = numpy.ndarray(nt, zip(obs_dict.values(), [float]*len(obs_dict)))
-
-    tspan = []
-    for i, value in enumerate(values):
-        tspan.append(value[i_t])
-        for j, obs in obs_dict.items():
-            yobs[obs][i] = value[j]
-    return (tspan, yobs)
-
-
-def get_all_patterns(obs_name):
+    decoder = SimResultDecoder()
+    decoder.update(kappa_plot)
+    return decoder.get_result()
+
+
+class SimResultDecoder(object):
+    """Decode the plot output of a Kappa simulation, possibly incrementally.
+
+    Plots of a running simulation can be passed to update as they are
+    obtained, only the points that weren't seen before are kept.
+    """
+    def __init__(self):
+        self.legend = None
+        self.chunks = []
+        self.last_time = -numpy.inf
+
+    def update(self, kappa_plot):
+        """Add the new points of a (partial) plot and return their number."""
+        legend = kappa_plot['legend']
+        if self.legend is None:
+            self.legend = legend
+        elif legend != self.legend:
+            raise ValueError('Plot legend changed during simulation.')
+        i_t = legend.index('[T]')
+        values = numpy.asarray(kappa_plot['series'], dtype=float)
+        values = values.reshape(-1, len(legend))
+        values = values[values[:, i_t] > self.last_time]
+        if not len(values):
+            return 0
+        values = values[numpy.argsort(values[:, i_t], kind='mergesort')]
+        self.last_time = values[-1, i_t]
+        self.chunks.append(values)
+        return len(values)
+
+    def get_values(self):
+        """Return all the points decoded so far as a (T x columns) array."""
+        if not self.chunks:
+            num_cols = len(self.legend) if self.legend else 0
+            return numpy.zeros((0, num_cols))
+        if len(self.chunks) > 1:
+            self.chunks = [numpy.concatenate(self.chunks)]
+        return self.chunks[0]
+
+    def get_result(self):
+        """Return the time points and a record array view of the values of
+        each observable decoded so far."""
+        values = numpy.ascontiguousarray(self.get_values())
+        i_t = self.legend.index('[T]')
+        tspan = values[:, i_t]
+        # A record view on the columns of the observables, without copying
+        itemsize = values.dtype.itemsize
+        obs_cols = [(j, key) for j, key in enumerate(self.legend)
+                    if key != '[T]']
+        dtype = numpy.dtype({'names': [key for _, key in obs_cols],
+                             'formats': [values.dtype] * len(obs_cols),
+                             'offsets': [j * itemsize for j, _ in obs_cols],
+                             'itemsize': itemsize * len(self.legend)})
+        yobs = values.view(dtype).reshape(len(values))
+        return tspan, yobs
+
+
+def discretize_values(obs_values, default_total_val=100, window=None):
+    """Return the discretized values of an observable in a set of
+    simulations, and the threshold used for each simulation.
+
+    If the observable starts low, it is discretized with respect to a total
+    value, otherwise with respect to its range, with a certain minimum.
+    If a window of time points is given, the start and range of the
+    observable are taken within the window.
+    """
+    window_values = get_window_values(obs_values, window)
+    start_vals = window_values[:, 0]
+    max_vals = numpy.max(window_values, axis=1)
+    min_vals = numpy.min(window_values, axis=1)
+    thresholds = numpy.where(
+        start_vals < 1e-5, 0.3 * default_total_val,
+        start_vals + numpy.maximum(0.5*(max_vals - min_vals),
+                                   default_total_val * 0.10))
+    obs_disc = (obs_values > thresholds[:, None]).astype(numpy.uint8)
+    return obs_disc, thresholds
+
+
+def discretize_partial(obs_values, default_total_val=100, window=None):
+    """Return bounds of the discretized values of an observable given only
+    the start of its trajectories.
+
+    A threshold depending on the range of the observable can only grow as
+    the trajectory goes on, so values above the threshold of the start of
+    the trajectory may still turn out to be low in the end. The
+    trajectories have to reach the start of the window, if given.
+
+    Returns
+    -------
+    lower : numpy.ndarray
+        A uint8 array which is 1 where the observable is sure to be high.
+    upper : numpy.ndarray
+        A uint8 array which is 1 where the observable may be high.
+    """
+    upper, _ = discretize_values(obs_values, default_total_val, window)
+    fixed_threshold = (get_window_values(obs_values, window)[:, 0] < 1e-5)
+    lower = upper * fixed_threshold[:, None].astype(numpy.uint8)
+    return lower, upper
+
+
+def get_window_values(obs_values, window):
+    """Return the values of a (num_sim x T) matrix within a window of
+    time points, the window being cut to the last time point."""
+    if window is None or not obs_values.shape[1]:
+        return obs_values
+    lb = min(window[0], obs_values.shape[1] - 1)
+    return obs_values[:, lb:window[1] + 1]
+
+
+def stack_observable(yobs_list, obs_name, num_times=None):
+    """Return the values of an observable in a list of simulations as a
+    (num_sim x T) matrix.
+
+    Simulations that are shorter than T are padded by repeating their last
+    value, which leaves the truth of LTL formulas built from F, G and
+    boolean operators unchanged. T is the length of the longest simulation
+    unless num_times is given, in which case longer simulations are
+    truncated.
+    """
+    if num_times is None:
+        num_times = max(len(yobs) for yobs in yobs_list)
+    values = numpy.zeros((len(yobs_list), num_times))
+    for i, yobs in enumerate(yobs_list):
+        obs_values = yobs[obs_name][:num_times]
+        values[i, :len(obs_values)] = obs_values
+        if len(obs_values) and len(obs_values) < num_times:
+            values[i, len(obs_values):] = obs_values[-1]
+    return values
+
+
+def get_sat_interval(num_sat, num_sim, z=1.96):
+    """Return the Wilson score interval of a satisfaction rate.
+
+    The default z corresponds to a 95% confidence interval.
+    """
+    if num_sim == 0:
+        return (0.0, 1.0)
+    p = num_sat / (1.0*num_sim)
+    denom = 1 + z**2 / num_sim
+    center = (p + z**2 / (2.0*num_sim)) / denom
+    half_width = z * numpy.sqrt(p*(1-p) / num_sim +
+                                z**2 / (4.0*num_sim**2)) / denom
+    return (float(max(0.0, center - half_width)),
+            float(min(1.0, center + half_width)))
+
+
+def decide_sat_rate(num_sat, num_sim, threshold, delta=0.2, alpha=0.1,
+                    beta=0.1):
+    """Return the decision of a sequential probability ratio test of
+    whether a satisfaction rate is above a threshold.
+
+    A rate of at most threshold - delta is tested against a rate of at
+    least threshold + delta, rates in between being too close to the
+    threshold for the decision to matter. alpha and beta are the
+    probabilities of wrongly deciding that the rate is above and below
+    the threshold, respectively.
+
+    Returns
+    -------
+    decision : bool or None
+        True if the rate is above the threshold, False if it is below and
+        None if more simulations are needed to decide.
+    """
+    p0 = max(threshold - delta, 1e-3)
+    p1 = min(threshold + delta, 1 - 1e-3)
+    llr = num_sat * numpy.log(p1 / p0) + \
+        (num_sim - num_sat) * numpy.log((1 - p1) / (1 - p0))
+    if llr >= numpy.log((1 - beta) / alpha):
+        return True
+    elif llr <= numpy.log(beta / (1 - alpha)):
+        return False
+    return None
+
+
+def sat_rates_resolved(truths, given_pattern, **kwargs):
+    """Return True if the pattern decisions made by check_property are
+    resolved by sequential tests of the satisfaction rates.
+
+    The given pattern (the first row of truths, if given_pattern is True)
+    needs to be resolved with respect to the 0.3 threshold below which
+    a suggestion is made, then the suggestion patterns are resolved in
+    order with respect to the 0.5 threshold until one is found to be
+    satisfied. Keyword arguments are passed to decide_sat_rate.
+    """
+    num_sim = truths.shape[1]
+    if given_pattern:
+        num_sat = numpy.count_nonzero(truths[0])
+        decision = decide_sat_rate(num_sat, num_sim, 0.3, **kwargs)
+        if decision is not False:
+            return decision is True
+        truths = truths[1:]
+    for pat_truths in truths:
+        num_sat = numpy.count_nonzero(pat_truths)
+        decision = decide_sat_rate(num_sat, num_sim, 0.5, **kwargs)
+        if decision is not False:
+            return decision is True
+    return True
+
+
+def get_all_patterns(obs_name, window=None):
     patterns = []
     for val_num, val_str in zip((0, 1), ('low', 'high')):
-        fstr = mc.always_formula(obs_name, val_num)
+        fstr = mc.always_formula(obs_name, val_num, window)
         pattern = (
             '(:type "always_value" '
             ':value (:type "qualitative" :value "%s"))' % val_str
             )
         patterns.append((fstr, pattern))
     for val_num, val_str in zip((0, 1), ('low', 'high')):
-        fstr = mc.eventual_formula(obs_name, val_num)
+        fstr = mc.eventual_formula(obs_name, val_num, window)
         pattern = (
             '(:type "eventual_value" '
             ':value (:type "qualitative" :value "%s"))' % val_str
             )
         patterns.append((fstr, pattern))
-    fstr = mc.transient_formula(obs_name)
+    fstr = mc.transient_formula(obs_name, window)
     pattern = '(:type "transient")'
     patterns.append((fstr, pattern))
-    fstr = mc.sustained_formula(obs_name)
+    fstr = mc.sustained_formula(obs_name, window)
     pattern = '(:type "sustained")'
     patterns.append((fstr, pattern))
     for val_num, val_str in zip((0, 1), ('low', 'high')):
-        fstr = mc.sometime_formula(obs_name, val_num)
+        fstr = mc.sometime_formula(obs_name, val_num, window)
         pattern = (
             '(:type "sometime_value" '
             ':value (:type "qualitative" :value "%s"))' % val_str
             )
         patterns.append((fstr, pattern))
-    fstr = mc.noact_formula(obs_name)
+    fstr = mc.noact_formula(obs_name, window)
     pattern = '(:type "no_change")'
     patterns.append((fstr, pattern))
     return patterns
 
 
+def get_joint_patterns(obs_names, window=None):
+    """Return the suggestion patterns with formulas requiring each pattern
+    to hold for all the given observables."""
+    obs_patterns = [get_all_patterns(obs_name, window)
+                    for obs_name in obs_names]
+    patterns = []
+    for same_patterns in zip(*obs_patterns):
+        fstr = mc.and_formula([fs for fs, _ in same_patterns])
+        patterns.append((fstr, same_patterns[0][1]))
+    return patterns
+
+
 # #############################################################
 # Classes for representing time intervals and temporal patterns
 # #############################################################
@@ -469,12 +1308,20 @@ class TemporalPattern(object):
         self.time_limit = time_limit
         # TODO: handle extra arguments by pattern type
         if self.pattern_type in \
-           ('always_value', 'eventual_value', 'sometime_value'):
+           ('always_value', 'eventual_value', 'sometime_value', 'until'):
             value = kwargs.get('value')
             if value is None:
                 msg = 'Missing molecular quantity'
                 raise InvalidTemporalPatternError(msg)
             self.value = value
+        # An until pattern is about the first entity having a value until
+        # the second entity has another value
+        if self.pattern_type == 'until':
+            until_value = kwargs.get('until_value')
+            if until_value is None:
+                msg = 'Missing molecular quantity'
+                raise InvalidTemporalPatternError(msg)
+            self.until_value = until_value
 
 
 class InvalidTemporalPatternError(BioagentException):
@@ -642,7 +1489,3 @@ class MissingMonomerError(BioagentException):
 
 class MissingMonomerSiteError(BioagentException):
     pass
-
-
-class SimulatorError(BioagentException):
-    pass
@@ -1,13 +1,18 @@
 import sys
 import json
+import hashlib
 import logging
+import tempfile
+import threading
+from collections import OrderedDict
 from kqml import KQMLList, KQMLPerformative
 from indra.assemblers import pysb_assembler, PysbAssembler
-from indra.statements import stmts_from_json, Activation, Inhibition, \
-    ActiveForm
+from indra.statements import stmts_from_json, stmts_to_json, Activation, \
+    Inhibition, ActiveForm
 from indra.sources.trips import processor as trips_processor
 from bioagents.tra import tra
-from bioagents import Bioagent, BioagentException
+from bioagents import Bioagent, BioagentException, get_cache_dir, \
+    share_model
 
 # This version of logging is coming from tra...
 logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
@@ -26,19 +31,62 @@ def get_bool_arg(arg_name, kwargs, default=True):
     return ret
 
 
+def get_str_arg(arg_name, kwargs, default=None):
+    "Get the string value of an argument from either argv or kwarg."
+    ret = default
+    argv = kwargs.get('argv', [])
+    if ('--%s' % arg_name) in argv:
+        idx = argv.index('--%s' % arg_name)
+        if idx + 1 < len(argv):
+            ret = argv[idx + 1]
+    if arg_name in kwargs.keys():
+        ret = kwargs.pop(arg_name)
+    return ret
+
+
+def get_int_arg(arg_name, kwargs, default=None):
+    "Get the integer value of an argument from either argv or kwarg."
+    ret = default
+    argv = kwargs.get('argv', [])
+    if ('--%s' % arg_name) in argv:
+        idx = argv.index('--%s' % arg_name)
+        if idx + 1 < len(argv):
+            ret = int(argv[idx + 1])
+    if arg_name in kwargs.keys():
+        ret = int(kwargs.pop(arg_name))
+    return ret
+
+
 class TRA_Module(Bioagent):
     name = "TRA"
-    tasks = ['SATISFIES-PATTERN', 'MODEL-COMPARE-CONDITIONS']
+    tasks = ['SATISFIES-PATTERN', 'MODEL-COMPARE-CONDITIONS',
+             'MODEL-SWEEP-CONDITIONS']
 
     def __init__(self, **kwargs):
         use_kappa = get_bool_arg('use_kappa', kwargs, default=False)
         use_kappa_rest = get_bool_arg('use_kappa_rest', kwargs, default=False)
+        sim_workers = get_int_arg('sim_workers', kwargs, default=1)
 
         # Instantiate a singleton TRA agent
         if not use_kappa:
             logger.warning('You have chosen to not use Kappa.')
 
-        self.tra = tra.TRA(use_kappa, use_kappa_rest)
+        # Simulation results are cached in the user cache folder by default
+        # so that repeated questions about a model don't need new
+        # simulations, except in tests, where figures are also kept apart
+        sim_cache_dir = get_str_arg('sim_cache_dir', kwargs,
+                                    default=get_cache_dir('sim_cache'))
+        fig_dir = get_str_arg('fig_dir', kwargs)
+        if kwargs.get('testing'):
+            sim_cache_dir = None
+            fig_dir = fig_dir or tempfile.mkdtemp()
+        self.tra = tra.TRA(use_kappa, use_kappa_rest, sim_workers,
+                           sim_cache_dir=sim_cache_dir, fig_dir=fig_dir)
+        # Figures are displayed from the rendering thread so sending
+        # messages needs to be synchronized
+        self.send_lock = threading.Lock()
+        # The figures to display once the reply to a request is sent
+        self.display_figures = []
         return super(TRA_Module, self).__init__(**kwargs)
 
     def respond_satisfies_pattern(self, content):
@@ -84,7 +132,7 @@ class TRA_Module(Bioagent):
                 return reply_content
 
         try:
-            sat_rate, num_sim, suggestion, fig_path = \
+            sat_rate, num_sim, suggestion, fig_path, sat_interval = \
                 self.tra.check_property(model, pattern, conditions)
         except tra.MissingMonomerError as e:
             logger.exception(e)
@@ -94,6 +142,10 @@ class TRA_Module(Bioagent):
             logger.exception(e)
             reply_content = self.make_failure('MODEL_MISSING_MONOMER_SITE')
             return reply_content
+        except tra.InvalidTimeIntervalError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_TIME_LIMIT')
+            return reply_content
         except tra.SimulatorError as e:
             logger.exception(e)
             reply_content = self.make_failure('KAPPA_FAILURE')
@@ -103,12 +155,14 @@ class TRA_Module(Bioagent):
             reply_content = self.make_failure('INVALID_PATTERN')
             return reply_content
 
-        self.send_display_figure(fig_path)
+        self.display_figures.append(fig_path)
 
         reply = KQMLList('SUCCESS')
         content = KQMLList()
         content.set('satisfies-rate', '%.1f' % sat_rate)
         content.set('num-sim', '%d' % num_sim)
+        content.set('satisfies-rate-interval',
+                    KQMLList(['%.2f' % bound for bound in sat_interval]))
         if suggestion:
             sugg = KQMLList.from_string(suggestion)
             content.set('suggestion', sugg)
@@ -150,12 +204,94 @@ class TRA_Module(Bioagent):
             reply_content = self.make_failure('KAPPA_FAILURE')
             return reply_content
 
-        self.send_display_figure(fig_path)
+        self.display_figures.append(fig_path)
 
         reply = KQMLList('SUCCESS')
         reply.set('result', result)
         return reply
 
+    def respond_model_sweep_conditions(self, content):
+        """Return response content to model-sweep-conditions request.
+
+        The request has a list of EKB descriptions of condition agents
+        (:agents), the EKB description of the affected agent (:affected) and
+        the list of multipliers (:multipliers) applied to the amount of each
+        condition agent. Every combination of multipliers is simulated.
+        """
+        agents_lst = content.get('agents')
+        target_agent_ekb = content.gets('affected')
+        mults_lst = content.get('multipliers')
+        model_indra_str = content.gets('model')
+        try:
+            stmts = decode_indra_stmts(model_indra_str)
+            model = assemble_model(stmts)
+        except Exception as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_MODEL')
+            return reply_content
+        try:
+            condition_agents = [
+                get_single_molecular_entity(agent_ekb.string_value())
+                for agent_ekb in agents_lst]
+            target_agent = get_single_molecular_entity(target_agent_ekb)
+            mults = [float(mult.to_string()) for mult in mults_lst]
+        except Exception as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_PATTERN')
+            return reply_content
+        try:
+            sweep = self.tra.sweep_conditions(model, condition_agents,
+                                              target_agent,
+                                              [mults] * len(condition_agents))
+            fig_path = self.tra.plot_sweep_conditions(sweep, condition_agents,
+                                                      target_agent)
+        except tra.MissingMonomerError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('MODEL_MISSING_MONOMER')
+            return reply_content
+        except tra.MissingMonomerSiteError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('MODEL_MISSING_MONOMER_SITE')
+            return reply_content
+        except tra.InvalidMolecularConditionError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_CONDITION')
+            return reply_content
+        except tra.SimulatorError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('KAPPA_FAILURE')
+            return reply_content
+
+        self.display_figures.append(fig_path)
+
+        reply = KQMLList('SUCCESS')
+        conditions = KQMLList([KQMLList(['%g' % mult for mult in grid_mults])
+                               for grid_mults in sweep['mults']])
+        reply.set('conditions', conditions)
+        reply.set('auc', KQMLList(['%.2f' % auc for auc in sweep['auc']]))
+        reply.set('final-value',
+                  KQMLList(['%.2f' % val for val in sweep['final']]))
+        return reply
+
+    def receive_request(self, msg, content):
+        """Handle request messages and respond.
+
+        The figures of the response are rendered and displayed once the
+        reply has been sent.
+        """
+        self.display_figures = []
+        super(TRA_Module, self).receive_request(msg, content)
+        for fig_path in self.display_figures:
+            self.tra.renderer.add_done_callback(fig_path,
+                                                self.send_display_figure)
+        self.display_figures = []
+
+    def send(self, msg):
+        with self.send_lock:
+            return super(TRA_Module, self).send(msg)
+
+    def wait_for_background(self):
+        self.tra.renderer.wait_all()
 
     def send_display_figure(self, path):
         msg = KQMLPerformative('tell')
@@ -172,22 +308,44 @@ def decode_indra_stmts(stmts_json_str):
     return stmts
 
 
+# Assembled models by statement content, in least recently used order
+_assembled_models = OrderedDict()
+_max_assembled_models = 16
+
+
 def assemble_model(stmts):
+    """Return a PySB model assembled from statements, with default initial
+    amounts set.
+
+    Assembled models are cached by the content of the statements, since the
+    same model is sent with every question about it. A new model sharing
+    the components of the cached model is returned, so that the caller can
+    add components, e.g. observables, to it without changing the cached
+    model. The shared components themselves are not to be changed, which
+    is why the TRA applies conditions as parameter overrides or to a copy
+    of the model.
+    """
+    key = get_stmts_hash(stmts)
+    model = _assembled_models.get(key)
+    if model is None:
+        model = _assemble_model(stmts)
+        _assembled_models[key] = model
+        if len(_assembled_models) > _max_assembled_models:
+            _assembled_models.popitem(last=False)
+    else:
+        logger.info('Reusing assembled model.')
+        _assembled_models.move_to_end(key)
+    return share_model(model)
+
+
+def _assemble_model(stmts):
     pa = PysbAssembler(policies='one_step')
     pa.add_statements(stmts)
     model = pa.make_model()
     pa.add_default_initial_conditions(100.0)
 
-    try:
-        targeted_agents = get_targeted_agents(stmts)
-        no_upstream_active_agents = get_no_upstream_active_agents(stmts)
-    except:
-        targeted_agents = []
-        no_upstream_active_agents = []
-    try:
-        chemical_agents = get_chemical_agents(stmts)
-    except:
-        chemical_agents = []
+    targeted_agents, no_upstream_active_agents, chemical_agents = \
+        classify_agents(stmts)
 
     for m in model.monomers:
         try:
@@ -209,46 +367,75 @@ def assemble_model(stmts):
     return model
 
 
-def get_targeted_agents(stmts):
-    """Return agents that are inhibited while not being activated by anything.
+def get_stmts_hash(stmts):
+    """Return a hash of the content of a list of statements.
+
+    Statement UUIDs and the links between statements are left out since
+    they don't affect assembly.
+    """
+    stmts_json = stmts_to_json(stmts)
+    for stmt_json in stmts_json:
+        for key in ('id', 'supports', 'supported_by'):
+            stmt_json.pop(key, None)
+    stmts_str = json.dumps(stmts_json, sort_keys=True)
+    return hashlib.md5(stmts_str.encode('utf-8')).hexdigest()
+
+
+def classify_agents(stmts):
+    """Return the sets of targeted agents, active agents with nothing
+    upstream and chemical agents in a single pass over the statements.
+
+    See get_targeted_agents, get_no_upstream_active_agents and
+    get_chemical_agents. Statements and agents that can't be classified
+    are logged and left out, without affecting the others.
     """
     has_act = set()
     has_inh = set()
+    is_active = set()
+    has_upstream = set()
+    chemicals = set()
     for stmt in stmts:
-        if isinstance(stmt, Activation):
-            has_act.add(stmt.obj.name)
-        elif isinstance(stmt, Inhibition):
-            has_inh.add(stmt.obj.name)
-    inh_not_act = list(has_inh - has_act)
-    return inh_not_act
+        try:
+            if isinstance(stmt, Activation):
+                has_act.add(stmt.obj.name)
+                has_upstream.add(stmt.obj.name)
+            elif isinstance(stmt, Inhibition):
+                has_inh.add(stmt.obj.name)
+            elif isinstance(stmt, ActiveForm):
+                has_upstream.add(stmt.agent.name)
+            agents = stmt.agent_list()
+        except Exception as e:
+            logger.warning('Could not classify the agents of %s.' % stmt)
+            logger.exception(e)
+            continue
+        for agent in agents:
+            if agent is None:
+                continue
+            try:
+                if agent.activity is not None and agent.activity.is_active:
+                    is_active.add(agent.name)
+                if 'CHEBI' in agent.db_refs or 'PC' in agent.db_refs:
+                    chemicals.add(pysb_assembler._n(agent.name))
+            except Exception as e:
+                logger.warning('Could not classify agent %s.' % agent)
+                logger.exception(e)
+    return has_inh - has_act, is_active - has_upstream, chemicals
+
+
+def get_targeted_agents(stmts):
+    """Return agents that are inhibited while not being activated by anything.
+    """
+    return list(classify_agents(stmts)[0])
 
 
 def get_no_upstream_active_agents(stmts):
     """Return agents that are active but there's nothing upstream.
     """
-    has_act = set()
-    has_upstream = set()
-    for stmt in stmts:
-        if isinstance(stmt, Activation):
-            has_upstream.add(stmt.obj.name)
-        elif isinstance(stmt, ActiveForm):
-            has_upstream.add(stmt.agent.name)
-        for agent in stmt.agent_list():
-            if agent is not None:
-                if agent.activity is not None and agent.activity.is_active:
-                    has_act.add(agent.name)
-    act_no_ups = list(has_act - has_upstream)
-    return act_no_ups
+    return list(classify_agents(stmts)[1])
 
 
 def get_chemical_agents(stmts):
-    chemicals = set()
-    for stmt in stmts:
-        for agent in stmt.agent_list():
-            if agent is not None and ('CHEBI' in agent.db_refs or
-                                      'PC' in agent.db_refs):
-                chemicals.add(pysb_assembler._n(agent.name))
-    return list(chemicals)
+    return list(classify_agents(stmts)[2])
 
 
 def get_molecular_entity(lst):
@@ -335,7 +522,13 @@ def get_temporal_pattern(lst):
         value = get_molecular_quantity(value_lst)
     else:
         value = None
-    tp = tra.TemporalPattern(pattern_type, entities, time_limit, value=value)
+    until_value_lst = lst.get('until-value')
+    if until_value_lst is not None:
+        until_value = get_molecular_quantity(until_value_lst)
+    else:
+        until_value = None
+    tp = tra.TemporalPattern(pattern_type, entities, time_limit, value=value,
+                             until_value=until_value)
     return tp
 
 